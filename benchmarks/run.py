@@ -0,0 +1,335 @@
+import os
+import io
+import sys
+import json
+import time
+import uuid
+import shutil
+import random
+import argparse
+import platform
+import tempfile
+import threading
+
+# Benchmarks drive the app through the Flask test client and print a JSON report,
+# compare two runs with --baseline to flag regressions, e.g.
+#   python benchmarks/run.py --output before.json
+#   python benchmarks/run.py --baseline before.json --output after.json
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+MiB = 1024 * 1024
+PASSWORD = 'benchmark'
+TAG_POOL = 100
+TAGS_PER_FILE = 3
+
+def parse_sizes(value):
+    return [int(float(v) * MiB) for v in value.split(',') if v]
+
+def parse_ints(value):
+    return [int(float(v)) for v in value.split(',') if v]
+
+def summarize(samples):
+    samples = sorted(samples)
+    if not samples:
+        return {'count': 0}
+    return {
+        'count': len(samples),
+        'mean_ms': sum(samples) / len(samples) * 1000,
+        'p50_ms': samples[len(samples) // 2] * 1000,
+        'p95_ms': samples[min(len(samples) - 1, int(len(samples) * 0.95))] * 1000,
+        'max_ms': samples[-1] * 1000,
+    }
+
+def timed(fn, repeat):
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        samples.append(time.perf_counter() - start)
+    return samples
+
+def check(response, *codes):
+    if response.status_code not in codes:
+        raise RuntimeError('{} {}: {}'.format(response.request.method, response.request.path, response.data[:200]))
+    return response
+
+def wait_for_job(job_id):
+    from src import jobs
+    job = jobs.pool.get(job_id)
+    if job:
+        job.event.wait()
+
+def open_store(client, name):
+    check(client.post('/api/session', json={'name': name, 'password': PASSWORD}), 201)
+    check(client.post('/api/store', json={'session_name': name}), 200)
+
+def write_random_file(path, size):
+    with open(path, 'wb') as f:
+        remaining = size
+        block = os.urandom(min(size, MiB))
+        while remaining > 0:
+            f.write(block[:remaining])
+            remaining -= len(block)
+
+def bench_encrypter(args, workdir):
+    from src.encrypter import FileEncrypter
+    key = os.urandom(32)
+    results = []
+    for size in args.file_sizes:
+        plain = os.path.join(workdir, 'plain')
+        write_random_file(plain, size)
+        # files are written as v4, which goes an auth chunk at a time whatever the
+        # configured chunk size, so only the thread count is varied
+        for threads in args.cipher_threads:
+            fe = FileEncrypter(key, threads=threads)
+            encrypted = os.path.join(workdir, 'encrypted')
+            decrypted = os.path.join(workdir, 'decrypted')
+            encrypt = timed(lambda: fe.encrypt_file(plain, encrypted), args.repeat)
+            decrypt = timed(lambda: fe.decrypt_file(encrypted, decrypted), args.repeat)
+            results.append({
+                'file_size': size,
+                'threads': threads,
+                'encrypt_mbps': size / min(encrypt) / 1e6,
+                'decrypt_mbps': size / min(decrypt) / 1e6,
+            })
+            # truncating a large earlier output would be timed with the next run
+            os.remove(encrypted)
+            os.remove(decrypted)
+    return results
+
+def bench_upload(args, client):
+    name = 'bench-upload'
+    open_store(client, name)
+    results = []
+    for size in args.upload_sizes:
+        for chunk_size in args.chunk_sizes:
+            total_chunks = max(1, -(-size // chunk_size))
+            data = os.urandom(min(size, chunk_size))
+            chunk_samples = []
+            totals = []
+            for _ in range(args.repeat):
+                file_id = check(client.post('/api/store/metadata/file', json={
+                    'session_name': name, 'name': 'upload', 'tags': [], 'filetype': 'bin'}), 200).data.decode()
+                start = time.perf_counter()
+                for chunk in range(total_chunks):
+                    offset = chunk * chunk_size
+                    body = data[:min(chunk_size, size - offset)]
+                    chunk_start = time.perf_counter()
+                    response = check(client.post('/api/store/file', data={
+                        'metadata': json.dumps({
+                            'session_name': name,
+                            'chunk': chunk,
+                            'chunk_offset': offset,
+                            'total_chunks': total_chunks,
+                            'file_size': size,
+                            'file_id': file_id,
+                        }),
+                        'file': (io.BytesIO(body), 'upload.bin'),
+                    }, content_type='multipart/form-data'), 200, 202)
+                    chunk_samples.append(time.perf_counter() - chunk_start)
+                if response.status_code == 202:
+                    # chunks off the auth chunk grid are read back by a job to finish the upload
+                    wait_for_job(response.get_json()['job']['id'])
+                totals.append(time.perf_counter() - start)
+                check(client.delete('/api/store/file/' + file_id, json={'session_name': name}), 200)
+            results.append({
+                'file_size': size,
+                'chunk_size': chunk_size,
+                'chunks': total_chunks,
+                'chunk_latency': summarize(chunk_samples),
+                'upload_mbps': size / min(totals) / 1e6,
+            })
+    return results
+
+def seed_metadata(session, file_count):
+    from src.metadata import encrypt_metadata
+    from src.util import get_metadata_path
+    rng = random.Random(file_count)
+    tags = ['tag{}'.format(i) for i in range(TAG_POOL)]
+    files = {}
+    for i in range(file_count):
+        file_id = str(uuid.UUID(int=rng.getrandbits(128)))
+        files[file_id] = {
+            'id': file_id,
+            'name': 'file{}'.format(i),
+            'tags': rng.sample(tags, TAGS_PER_FILE),
+            'filetype': 'bin',
+        }
+    encrypt_metadata(get_metadata_path(session), {'files': files, 'tags': tags}, session['file_encrypter'])
+    with session['metadata_lock']:
+        session['metadata'] = None
+        session['tag_index'] = None
+        session['store_stats'] = None
+    return list(files)
+
+def bench_metadata(args, client):
+    from src.session import get_session
+    results = []
+    for file_count in args.file_counts:
+        name = 'bench-metadata-{}'.format(file_count)
+        open_store(client, name)
+        file_ids = seed_metadata(get_session(name), file_count)
+        rng = random.Random(0)
+        # fewer passes over the largest stores, a full listing of 1M entries is slow
+        repeat = max(3, args.repeat * 1000 // max(file_count, 1000))
+        base = '/api/store/metadata/file?session_name={}'.format(name)
+        load = timed(lambda: check(client.get(base + '&limit=1'), 200), 1)
+        results.append({
+            'file_count': file_count,
+            'load': summarize(load),
+            'list_all': summarize(timed(lambda: check(client.get(base), 200), repeat)),
+            'list_page': summarize(timed(lambda: check(client.get(base + '&limit=100'), 200), args.repeat * 10)),
+            'filter_tag': summarize(timed(lambda: check(client.get(base + '&tags=tag1&limit=100'), 200), args.repeat * 10)),
+            'filter_tags': summarize(timed(lambda: check(client.get(base + '&tags=tag1,tag2'), 200), args.repeat * 10)),
+            'patch': summarize(timed(lambda: check(client.patch(
+                '/api/store/metadata/file/' + rng.choice(file_ids),
+                json={'session_name': name, 'name': 'patched'}), 200), args.repeat * 10)),
+            'tag_rename': summarize(timed(lambda: (
+                check(client.put('/api/store/metadata/tag/tag3', json={'session_name': name, 'new_tag': 'renamed'}), 200),
+                check(client.put('/api/store/metadata/tag/renamed', json={'session_name': name, 'new_tag': 'tag3'}), 200),
+            ), repeat)),
+        })
+    return results
+
+def bench_sessions(args, app):
+    results = []
+    for count in args.session_counts:
+        names = ['bench-sessions-{}-{}'.format(count, i) for i in range(count)]
+        for name in names:
+            open_store(app.test_client(), name)
+        samples = [[] for _ in names]
+        errors = []
+
+        def worker(i, name):
+            client = app.test_client()
+            base = '/api/store/metadata/file'
+            try:
+                for op in range(args.session_ops):
+                    start = time.perf_counter()
+                    if op % 2:
+                        check(client.get(base + '?session_name={}&limit=100'.format(name)), 200)
+                    else:
+                        check(client.post(base, json={
+                            'session_name': name, 'name': 'file{}'.format(op), 'tags': ['a'], 'filetype': 'bin'}), 200)
+                    samples[i].append(time.perf_counter() - start)
+            except Exception as e:
+                errors.append(str(e))
+
+        threads = [threading.Thread(target=worker, args=(i, name)) for i, name in enumerate(names)]
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - start
+        results.append({
+            'sessions': count,
+            'ops': count * args.session_ops,
+            'ops_per_second': count * args.session_ops / elapsed,
+            'latency': summarize([s for session_samples in samples for s in session_samples]),
+            'errors': errors,
+        })
+    return results
+
+def _metric_values(report):
+    # Flattens a report into {path: value} for the throughput and latency numbers worth comparing
+    values = {}
+    for section, rows in report['results'].items():
+        for row in rows:
+            label = ','.join('{}={}'.format(k, row[k]) for k in ('file_size', 'chunk_size', 'threads', 'file_count', 'sessions') if k in row)
+            for key, value in row.items():
+                if key.endswith('_mbps') or key == 'ops_per_second':
+                    values['{}[{}].{}'.format(section, label, key)] = (value, True)
+                elif isinstance(value, dict) and 'p50_ms' in value:
+                    values['{}[{}].{}.p50_ms'.format(section, label, key)] = (value['p50_ms'], False)
+    return values
+
+def compare(report, baseline, threshold):
+    current = _metric_values(report)
+    regressions = []
+    for path, (old, higher_is_better) in _metric_values(baseline).items():
+        if path not in current or not old:
+            continue
+        new = current[path][0]
+        change = (new - old) / old
+        if (change < -threshold) if higher_is_better else (change > threshold):
+            regressions.append({'metric': path, 'baseline': old, 'current': new, 'change': change})
+    return regressions
+
+def default_cipher_threads():
+    # powers of two up to the core count, and the core count
+    cpus = os.cpu_count() or 1
+    return sorted({1 << i for i in range(cpus.bit_length()) if 1 << i <= cpus} | {cpus})
+
+def main():
+    parser = argparse.ArgumentParser(description='encrypted-file-store benchmarks')
+    parser.add_argument('--suites', default='encrypter,upload,metadata,sessions')
+    parser.add_argument('--file-sizes', type=parse_sizes, default=parse_sizes('1,16,128'), help='MiB')
+    parser.add_argument('--upload-sizes', type=parse_sizes, default=parse_sizes('1,16'), help='MiB')
+    parser.add_argument('--chunk-sizes', type=parse_sizes, default=parse_sizes('0.0625,1,8'),
+                        help='upload suite chunk sizes, MiB')
+    parser.add_argument('--cipher-threads', type=parse_ints, default=default_cipher_threads(),
+                        help='encrypter suite thread counts')
+    parser.add_argument('--file-counts', type=parse_ints, default=parse_ints('1000,10000,100000'),
+                        help='metadata sizes, up to 1000000')
+    parser.add_argument('--session-counts', type=parse_ints, default=parse_ints('1,2,4,8'))
+    parser.add_argument('--session-ops', type=int, default=200)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--config', default='{}', help='JSON app config overrides')
+    parser.add_argument('--output', help='write the report here instead of stdout')
+    parser.add_argument('--baseline', help='earlier report to check for regressions')
+    parser.add_argument('--threshold', type=float, default=0.2, help='relative change counted as a regression')
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='efs-bench-')
+    os.environ['DATA_FILEPATH'] = os.path.join(workdir, 'data')
+    os.mkdir(os.environ['DATA_FILEPATH'])
+    os.environ.setdefault('LOG_LEVEL', 'WARNING')
+    exit_code = 0
+    try:
+        from src import create_app
+        config = dict({'TESTING': True}, **json.loads(args.config))
+        app = create_app(config)
+        suites = args.suites.split(',')
+        results = {}
+        if 'encrypter' in suites:
+            results['encrypter'] = bench_encrypter(args, workdir)
+        if 'upload' in suites:
+            results['upload'] = bench_upload(args, app.test_client())
+        if 'metadata' in suites:
+            results['metadata'] = bench_metadata(args, app.test_client())
+        if 'sessions' in suites:
+            results['sessions'] = bench_sessions(args, app)
+        report = {
+            'timestamp': time.time(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpus': os.cpu_count(),
+            'config': config,
+            'args': {k: v for k, v in vars(args).items() if k not in ('output', 'baseline')},
+            'results': results,
+        }
+        if args.baseline:
+            with open(args.baseline) as f:
+                report['regressions'] = compare(report, json.load(f), args.threshold)
+            exit_code = 1 if report['regressions'] else 0
+        output = json.dumps(report, indent=2)
+        if args.output:
+            with open(args.output, 'w') as f:
+                f.write(output)
+        else:
+            print(output)
+    except Exception:
+        import traceback
+        traceback.print_exc()
+        exit_code = 2
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+        sys.stdout.flush()
+        # the session timers are not daemon threads
+        os._exit(exit_code)
+
+if __name__ == '__main__':
+    main()
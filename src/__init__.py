@@ -1,39 +1,126 @@
 import os
 import json
+import time
 import logging
 import sys
+import hmac
 
-from flask import Flask
+from flask import Flask, Response, request, g
 from flask_cors import CORS
 from werkzeug.exceptions import HTTPException
 
 def create_app(test_config=None):
     logging.basicConfig(format='[%(asctime)s][%(levelname)s] - %(message)s',
                         stream=sys.stdout,
-                        level=logging.DEBUG)
+                        level=os.environ.get('LOG_LEVEL', 'DEBUG').upper())
     app = Flask(__name__, instance_relative_config=True)
     app.config['CORS_SUPPORTS_CREDENTIALS'] = True
     CORS(app)
     app.config['MAX_CONTENT_LENGTH'] = 50 * 1024 * 1024 * 1024
     logging.info('MAX_CONTENT_LENGTH: {}'.format(app.config['MAX_CONTENT_LENGTH']))
+    # False writes metadata through to disk on every mutation, True batches writes
+    # and flushes every METADATA_FLUSH_INTERVAL seconds and on session expiry
+    app.config['METADATA_WRITE_BACK'] = False
+    app.config['METADATA_FLUSH_INTERVAL'] = 30
+    # Mutations are appended to an encrypted journal, folded into a new snapshot
+    # once this many ops have accumulated
+    app.config['METADATA_COMPACT_OPS'] = 1000
+    # 'json' keeps the snapshot as one encrypted document, 'packed' stores records in
+    # separately encrypted blocks so single-file lookups skip loading the whole store.
+    # Existing snapshots are migrated to the configured format when next loaded.
+    app.config['METADATA_FORMAT'] = 'json'
+    # GET /api/store/file/<file_id> decrypts straight into the response instead of
+    # staging a plaintext copy under decrypted/, overridable with ?stream=
+    app.config['STREAM_DOWNLOADS'] = False
+    # Decrypted copies are sent with send_file, which gunicorn passes to os.sendfile.
+    # Behind nginx, set this to an internal location aliased to DATA_FILEPATH to
+    # have nginx send them through X-Accel-Redirect, or set Flask's USE_X_SENDFILE
+    # for servers that support X-Sendfile.
+    app.config['X_ACCEL_REDIRECT_PREFIX'] = None
+    # Encrypt/decrypt jobs share one bounded pool of worker threads
+    app.config['JOB_WORKERS'] = os.cpu_count() or 1
+    # Codec uploads are compressed with before encryption unless the upload asks
+    # for another: None/'none', 'zlib', 'lzma' or 'zstd' (needs zstandard).
+    # Already compressed filetypes and data that doesn't shrink are stored as is.
+    app.config['COMPRESSION_CODEC'] = None
+    # Uploads with identical content are stored once per store under blobs/,
+    # keyed by a keyed hash of their plaintext and shared by the file records
+    app.config['DEDUPLICATION'] = True
+    # Size of the single reusable buffer each encrypt/decrypt operation on files
+    # stored before authentication tags works through, tagged files go 1 MiB at a time
+    app.config['ENCRYPTION_CHUNK_SIZE'] = 1024 * 1024
+    # Threads a file larger than one chunk is encrypted or decrypted with, each
+    # working on its own chunk of it
+    app.config['ENCRYPTION_THREADS'] = os.cpu_count() or 1
+    # Stores of logged in sessions are scrubbed in the background once their last
+    # scrub is older than SCRUB_INTERVAL seconds, None only scrubs on request.
+    # Scrubs run one at a time and read at most SCRUB_RATE MB/s between them, None
+    # for no limit.
+    app.config['SCRUB_INTERVAL'] = 24 * 60 * 60
+    app.config['SCRUB_RATE'] = 32
+    # Total bytes of decrypted plaintext copies kept on disk before LRU eviction
+    app.config['DECRYPTED_CACHE_BYTES'] = 10 * 1024 * 1024 * 1024
+    # scrypt cost for keys of newly created stores, paid once per login
+    app.config['SCRYPT_N'] = 2 ** 15
+    app.config['SCRYPT_R'] = 8
+    app.config['SCRYPT_P'] = 1
+    # 'memory' keeps sessions, jobs and uploads in this process, 'sqlite' shares them
+    # with every worker process through STATE_DB_PATH. Session keys are stored
+    # there wrapped with SESSION_SECRET, which all workers must be given.
+    app.config['STATE_BACKEND'] = os.environ.get('STATE_BACKEND', 'memory')
+    app.config['STATE_DB_PATH'] = os.environ.get('STATE_DB_PATH', os.path.join(app.instance_path, 'state.db'))
+    app.config['SESSION_SECRET'] = os.environ.get('SESSION_SECRET', None)
+    # Event streams a worker process serves at once, each holds one of its threads
+    # for as long as the client is connected. None for no limit.
+    app.config['EVENT_STREAMS'] = 8
+    # Bearer token scrapers send to /metrics, which is disabled while unset
+    app.config['METRICS_TOKEN'] = os.environ.get('METRICS_TOKEN', None)
+    # Root log level, the LOG_LEVEL environment variable also applies before config loads
+    app.config['LOG_LEVEL'] = os.environ.get('LOG_LEVEL', 'DEBUG')
 
     if test_config is None:
         app.config.from_pyfile('config.py', silent=True)
     else:
         app.config.from_mapping(test_config)
+    logging.getLogger().setLevel(app.config['LOG_LEVEL'].upper())
 
     try:
         os.makedirs(app.instance_path)
     except OSError:
         pass
 
+    from . import state
+    state.init_backend(app.config['STATE_BACKEND'], app.config['STATE_DB_PATH'], app.config['SESSION_SECRET'])
+
     from . import session
     app.register_blueprint(session.bp)
-    session.create_session_clear_timer()
+    from . import events
+    events.init_streams(app.config['EVENT_STREAMS'])
+    session.start_session_expiry()
+    if app.config['METADATA_WRITE_BACK'] and not state.backend:
+        session.create_metadata_flush_timer(app.config['METADATA_FLUSH_INTERVAL'])
+
+    from . import cache
+    app.register_blueprint(cache.bp)
+    cache.init_cache(app.config['DECRYPTED_CACHE_BYTES'])
+
+    from . import jobs
+    app.register_blueprint(jobs.bp)
+    jobs.init_pool(app.config['JOB_WORKERS'])
 
     from . import store
     app.register_blueprint(store.bp)
 
+    from . import scrub
+    app.register_blueprint(scrub.bp)
+    rate = app.config['SCRUB_RATE']
+    scrub.init_rate_limit(rate * 1024 * 1024 if rate else None)
+    if app.config['SCRUB_INTERVAL']:
+        scrub.create_scrub_timer(app.config['SCRUB_INTERVAL'])
+
+    from . import metrics
+    from .error import MetricsDisabled, MetricsUnauthorized
+
     @app.errorhandler(HTTPException)
     def handle_exception(e):
         response = e.get_response()
@@ -45,8 +132,31 @@ def create_app(test_config=None):
         response.content_type = "application/json"
         return response
 
+    @app.before_request
+    def start_timer():
+        g.request_start = time.time()
+
+    @app.after_request
+    def record_latency(response):
+        if 'request_start' in g:
+            metrics.request_latency.observe(time.time() - g.request_start,
+                                            endpoint=request.endpoint or 'unknown',
+                                            method=request.method,
+                                            status=response.status_code)
+        return response
+
     @app.route('/heartbeat')
     def heartbeat():
         return 'heartbeat'
 
+    @app.route('/metrics')
+    def metrics_endpoint():
+        token = app.config['METRICS_TOKEN']
+        if not token:
+            raise MetricsDisabled()
+        given = request.headers.get('Authorization', '')
+        if not hmac.compare_digest(given.encode('utf-8'), 'Bearer {}'.format(token).encode('utf-8')):
+            raise MetricsUnauthorized()
+        return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
     return app
@@ -0,0 +1,34 @@
+import os
+import logging
+
+from .util import *
+from .metadata import get_blob_refs
+
+# Deduplicated file contents. Each distinct plaintext in a store is kept once as
+# blobs/<content id> and file records point at it with their 'blob' field, so the
+# records are the reference counts, kept in the session's tag index as the records
+# change. Everything here runs under the session's
+# metadata_lock, which keeps a blob from being dropped while an upload of the
+# same content is deciding to reuse it.
+
+def store_blob(session, part_path, blob):
+    # Moves a finished upload into place as blob, or drops it when the store
+    # already holds the same content. Returns the blob's path.
+    path = get_blob_path(session['name'], blob)
+    if os.path.exists(path):
+        os.remove(part_path)
+        logging.info('deduplicated upload into blob {}'.format(blob))
+        return path
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    os.replace(part_path, path)
+    return path
+
+def release_blob(session, blob):
+    # Called after the records dropping a reference were applied to metadata
+    if not blob or get_blob_refs(session['tag_index'], blob):
+        return False
+    try:
+        os.remove(get_blob_path(session['name'], blob))
+    except FileNotFoundError:
+        pass
+    return True
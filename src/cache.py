@@ -0,0 +1,129 @@
+import os
+import time
+import logging
+from collections import OrderedDict
+from threading import Lock
+
+from flask import Blueprint, request
+
+from . import metrics
+
+bp = Blueprint('cache', __name__, url_prefix='/api/cache')
+
+decrypted_cache = None
+
+class DecryptedFileCache:
+    # Tracks plaintext copies under each store's decrypted/ folder in LRU order
+    # and deletes the least recently used ones once their total size exceeds
+    # the byte budget. Entries are reserved while their decrypt job runs and
+    # only become servable, and evictable, once it completes.
+    def __init__(self, budget):
+        self.budget = budget
+        self.entries = OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = Lock()
+
+    def get(self, session_name, file_id, count=True):
+        with self.lock:
+            entry = self.entries.get((session_name, file_id), None)
+            if entry is None or entry['pending']:
+                if count:
+                    self.misses += 1
+                return None
+            if count:
+                self.hits += 1
+                entry['last_access'] = time.time()
+                self.entries.move_to_end((session_name, file_id))
+            return entry['path']
+
+    def reserve(self, session_name, file_id, path):
+        with self.lock:
+            self._remove((session_name, file_id))
+            self.entries[(session_name, file_id)] = {
+                'path': path,
+                'size': 0,
+                'pending': True,
+                'last_access': time.time(),
+            }
+
+    def complete(self, session_name, file_id):
+        with self.lock:
+            entry = self.entries.get((session_name, file_id), None)
+            if entry is None:
+                return
+            entry['size'] = os.path.getsize(entry['path'])
+            entry['pending'] = False
+            self.bytes += entry['size']
+            self.entries.move_to_end((session_name, file_id))
+            self._evict(keep=(session_name, file_id))
+
+    def discard(self, session_name, file_id):
+        with self.lock:
+            self._remove((session_name, file_id))
+
+    def clear_session(self, session_name):
+        with self.lock:
+            for key in [key for key in self.entries if key[0] == session_name]:
+                self._remove(key)
+
+    def stats(self, session_name=None):
+        with self.lock:
+            stats = {
+                'budget': self.budget,
+                'bytes': self.bytes,
+                'entries': sum(1 for entry in self.entries.values() if not entry['pending']),
+                'pending': sum(1 for entry in self.entries.values() if entry['pending']),
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
+            if session_name:
+                stats['session_bytes'] = sum(
+                    entry['size'] for key, entry in self.entries.items() if key[0] == session_name)
+            return stats
+
+    def _remove(self, key):
+        # must hold self.lock
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            return
+        self.bytes -= entry['size']
+        try:
+            os.remove(entry['path'])
+        except OSError:
+            pass
+
+    def _evict(self, keep):
+        # must hold self.lock, never evicts pending entries or the one just added
+        for key in list(self.entries):
+            if self.bytes <= self.budget:
+                break
+            if key == keep or self.entries[key]['pending']:
+                continue
+            logging.info('evicting decrypted copy {}'.format(self.entries[key]['path']))
+            self._remove(key)
+            self.evictions += 1
+
+def _cache_gauge(key):
+    def gauge():
+        if decrypted_cache is None:
+            return []
+        return [({}, decrypted_cache.stats()[key])]
+    return gauge
+
+metrics.register(metrics.Gauge('efs_decrypted_cache_bytes', 'Bytes of decrypted plaintext copies on disk', _cache_gauge('bytes')))
+metrics.register(metrics.Gauge('efs_decrypted_cache_entries', 'Decrypted plaintext copies on disk', _cache_gauge('entries')))
+
+def init_cache(budget):
+    global decrypted_cache
+    if decrypted_cache is None:
+        decrypted_cache = DecryptedFileCache(budget)
+    return decrypted_cache
+
+@bp.route('', methods=['GET'])
+def cache_endpoint():
+    if request.method == 'GET':
+        return decrypted_cache.stats(request.args.get('session_name', None)), 200
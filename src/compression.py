@@ -0,0 +1,107 @@
+import zlib
+import lzma
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Codecs a stored file can be compressed with before encryption. The id is
+# written to the file header so compressed files decrypt without metadata.
+CODEC_IDS = {'zlib': 1, 'lzma': 2, 'zstd': 3}
+CODEC_NAMES = {codec_id: name for name, codec_id in CODEC_IDS.items()}
+
+# Compressing these again only costs time
+ALREADY_COMPRESSED_FILETYPES = {
+    '7z', 'aac', 'apk', 'avi', 'br', 'bz2', 'docx', 'epub', 'flac', 'gif', 'gz',
+    'heic', 'jar', 'jpeg', 'jpg', 'lz4', 'm4a', 'm4v', 'mkv', 'mov', 'mp3', 'mp4',
+    'odp', 'ods', 'odt', 'ogg', 'opus', 'png', 'pptx', 'rar', 'tgz', 'txz', 'webm',
+    'webp', 'xlsx', 'xz', 'zip', 'zst',
+}
+
+# A file is only compressed when a sample of its start shrinks below this ratio,
+# and only kept compressed when the whole file does
+SAMPLE_SIZE = 1024 * 1024
+MIN_RATIO = 0.9
+
+def available_codecs():
+    return [name for name in CODEC_IDS if name != 'zstd' or zstandard is not None]
+
+def choose_codec(codec, filetype):
+    # Returns the codec to compress a file with, or None to store it as is
+    if not codec or codec == 'none':
+        return None
+    if codec not in available_codecs():
+        raise ValueError('unsupported codec {}'.format(codec))
+    if str(filetype).lower().lstrip('.') in ALREADY_COMPRESSED_FILETYPES:
+        return None
+    return codec
+
+def compressobj(codec):
+    if codec == 'zlib':
+        return zlib.compressobj(6)
+    if codec == 'lzma':
+        return lzma.LZMACompressor(preset=6)
+    if codec == 'zstd' and zstandard is not None:
+        return zstandard.ZstdCompressor(level=3).compressobj()
+    raise ValueError('unsupported codec {}'.format(codec))
+
+def is_worth_compressing(codec, sample):
+    if not sample:
+        return False
+    compressor = compressobj(codec)
+    compressed = len(compressor.compress(sample)) + len(compressor.flush())
+    return compressed < len(sample) * MIN_RATIO
+
+class _ChunkReader:
+    # file-like view over an iterable of chunks for zstandard's stream_reader
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.buf = b''
+
+    def read(self, size=-1):
+        while not self.buf:
+            try:
+                self.buf = bytes(next(self.chunks))
+            except StopIteration:
+                return b''
+        if size < 0 or size >= len(self.buf):
+            data, self.buf = self.buf, b''
+        else:
+            data, self.buf = self.buf[:size], self.buf[size:]
+        return data
+
+def decompress_chunks(codec, chunks, max_length):
+    # Yields the decompressed stream in pieces of at most max_length bytes, so a
+    # highly compressed chunk never expands in memory all at once
+    if codec == 'zlib':
+        decompressor = zlib.decompressobj()
+        for chunk in chunks:
+            data = chunk
+            while data:
+                out = decompressor.decompress(data, max_length)
+                if out:
+                    yield out
+                data = decompressor.unconsumed_tail
+        out = decompressor.flush()
+        if out:
+            yield out
+    elif codec == 'lzma':
+        decompressor = lzma.LZMADecompressor()
+        for chunk in chunks:
+            out = decompressor.decompress(chunk, max_length)
+            if out:
+                yield out
+            while not decompressor.needs_input and not decompressor.eof:
+                out = decompressor.decompress(b'', max_length)
+                if out:
+                    yield out
+    elif codec == 'zstd' and zstandard is not None:
+        reader = zstandard.ZstdDecompressor().stream_reader(_ChunkReader(chunks))
+        while True:
+            out = reader.read(max_length)
+            if not out:
+                break
+            yield out
+    else:
+        raise ValueError('unsupported codec {}'.format(codec))
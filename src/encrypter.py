@@ -1,68 +1,661 @@
 from Crypto.Cipher import AES
-from hashlib import sha256
-import os, random, struct, json, base64
+from hashlib import sha256, scrypt
+import os, struct, json, base64, hmac
 import logging
 import time
+from collections import deque
+from contextlib import closing
+from concurrent.futures import ThreadPoolExecutor, wait
+from threading import Lock
 
-from .error import InvalidPassword
+from . import metrics, compression
+
+# On-disk layouts, all starting with the '<Q' original size:
+#   legacy: size | iv (16) | AES-CBC ciphertext padded to 16 bytes
+#   v2:     size | version (1) | magic (3) | nonce (8) | AES-CTR ciphertext, unpadded
+#   v3:     v2 with codec (1) | original size (8) after the nonce, the ciphertext
+#           is of the compressed plaintext and size is its length
+#   v4:     v3 with codec 0 for uncompressed data, followed by a trailer of one
+#           HMAC tag per AUTH_CHUNK_SIZE bytes of ciphertext, over the nonce, chunk
+#           index and chunk, and a last tag over the header and the chunk tags.
+#           Every file is now written as v4 and its tags are checked before any
+#           chunk is decrypted, earlier versions are still read unchecked.
+# A v2/v3/v4 header is only trusted when the file length also matches, since a legacy
+# iv is random and could start with the same bytes.
+SIZE_HEADER = struct.Struct('<Q')
+VERSION_HEADER = struct.Struct('<B3s')
+FORMAT_MAGIC = b'EFS'
+FORMAT_LEGACY_CBC = 1
+FORMAT_CTR = 2
+FORMAT_CTR_COMPRESSED = 3
+FORMAT_CTR_AUTH = 4
+CBC_IV_SIZE = 16
+CTR_NONCE_SIZE = 8
+CTR_HEADER_SIZE = SIZE_HEADER.size + VERSION_HEADER.size + CTR_NONCE_SIZE
+CODEC_HEADER = struct.Struct('<BQ')
+COMPRESSED_HEADER_SIZE = CTR_HEADER_SIZE + CODEC_HEADER.size
+BLOCK_SIZE = AES.block_size
+RECORD_NONCE_SIZE = 12
+RECORD_TAG_SIZE = 16
+AUTH_CHUNK_SIZE = 1024*1024
+AUTH_TAG_SIZE = sha256().digest_size
+AUTH_CONTEXT = b'encrypted-file-store auth'
+CHUNK_INDEX = struct.Struct('<Q')
+
+def auth_trailer_size(size):
+    return (-(-size // AUTH_CHUNK_SIZE) + 1) * AUTH_TAG_SIZE
+
+def has_chunk_tags(size, tags):
+    # Whether tags as returned by write_encrypted_stream cover every auth chunk of
+    # a size byte file, so finish_encrypted_file has nothing to read back
+    return all(tags.get(index, (None,))[0] == min(AUTH_CHUNK_SIZE, size - index * AUTH_CHUNK_SIZE)
+               for index in range(-(-size // AUTH_CHUNK_SIZE)))
+
+def _auth_pieces(offset, length):
+    # (offset, length) pieces of [offset, offset + length) split at auth chunk boundaries
+    pieces = []
+    end = offset + length
+    while offset < end:
+        n = min(end, (offset // AUTH_CHUNK_SIZE + 1) * AUTH_CHUNK_SIZE) - offset
+        pieces.append((offset, n))
+        offset += n
+    return pieces
+
+class IntegrityError(ValueError):
+    # chunk is None when the header, tag table or whole file failed to check out
+    def __init__(self, message, chunk=None):
+        super().__init__(message)
+        self.chunk = chunk
+
+class FileHeader:
+    def __init__(self, version, size, iv, data_offset, codec=None, original_size=None):
+        self.version = version
+        self.size = size
+        self.iv = iv
+        self.data_offset = data_offset
+        self.codec = codec
+        self.original_size = size if original_size is None else original_size
+
+DEFAULT_CHUNK_SIZE = 1024*1024
+
+# Large CTR files are split into CHUNK_SIZE segments that threads of a shared pool
+# read and encrypt from their own counter offset, while the calling thread writes
+# the finished segments out in order, so reads, cipher work and writes of one file
+# overlap across cores. pycryptodome releases the GIL while it encrypts. Legacy
+# CBC and compressed files are still processed sequentially. At most
+# MAX_PENDING_CHUNKS segments of one file are in flight, so an operation's memory
+# stays bounded however many threads there are.
+MAX_PENDING_CHUNKS = 8
+_cipher_pools = {}
+_cipher_pools_lock = Lock()
+
+def _cipher_pool(threads):
+    with _cipher_pools_lock:
+        pool = _cipher_pools.get(threads, None)
+        if pool is None:
+            pool = ThreadPoolExecutor(threads, thread_name_prefix='CipherThread')
+            _cipher_pools[threads] = pool
+        return pool
+
+# Keys are derived once per session from the password and the store's keyinfo
+# header, a plaintext JSON file holding the KDF parameters, salt and a check
+# value that lets a wrong password be rejected at login. Stores created before
+# keyinfo existed use an unsalted sha256 of the password.
+KDF_SCRYPT = 'scrypt'
+KDF_LEGACY_SHA256 = 'sha256'
+KEY_CHECK_CONTEXT = b'encrypted-file-store key check'
+
+def new_keyinfo(n, r, p):
+    return {
+        'kdf': KDF_SCRYPT,
+        'salt': base64.b64encode(os.urandom(16)).decode('ascii'),
+        'n': n,
+        'r': r,
+        'p': p,
+    }
+
+def legacy_keyinfo():
+    return {'kdf': KDF_LEGACY_SHA256}
+
+def derive_key(password, keyinfo):
+    password = password.encode('utf-8')
+    if keyinfo['kdf'] == KDF_LEGACY_SHA256:
+        return sha256(password).digest()
+    n, r, p = keyinfo['n'], keyinfo['r'], keyinfo['p']
+    return scrypt(password, salt=base64.b64decode(keyinfo['salt']), n=n, r=r, p=p,
+                  maxmem=256 * n * r + 1024 * 1024, dklen=32)
+
+def get_key_check(key):
+    return base64.b64encode(hmac.new(key, KEY_CHECK_CONTEXT, sha256).digest()).decode('ascii')
+
+def check_key(key, keyinfo):
+    if 'check' not in keyinfo:
+        return True
+    return hmac.compare_digest(get_key_check(key), keyinfo['check'])
+
+def read_keyinfo(path):
+    if not os.path.exists(path):
+        return None
+    with open(path, 'r') as f:
+        return json.load(f)
+
+def write_keyinfo(path, keyinfo):
+    with open(path + '.tmp', 'w') as f:
+        json.dump(keyinfo, f)
+    os.replace(path + '.tmp', path)
+
+# Content ids identify a stored file's plaintext within a store without revealing
+# it: the plaintext is split into CONTENT_BLOCK_SIZE blocks, each block gets an
+# HMAC under a key derived from the store key, and the id is an HMAC over the
+# size and the block digests. Blocks are independent so the digests can be
+# taken while chunks of an upload arrive in any order.
+CONTENT_ID_CONTEXT = b'encrypted-file-store content id'
+CONTENT_BLOCK_SIZE = 1024*1024
 
 class FileEncrypter:
-    def __init__(self, password):
-        self.password = password.encode('utf-8')
-        self.CHUNK_SIZE = 64*1024*1024
+    def __init__(self, key, chunk_size=DEFAULT_CHUNK_SIZE, threads=1):
+        self.key = key
+        self.content_key = hmac.new(key, CONTENT_ID_CONTEXT, sha256).digest()
+        self.auth_key = hmac.new(key, AUTH_CONTEXT, sha256).digest()
+        # Peak memory per operation on a file from before v4 is one buffer of this
+        # size, which has to be a whole number of AES blocks for CBC, or two per
+        # thread when the file is split across threads. v4 files are always read
+        # and written a whole AUTH_CHUNK_SIZE chunk at a time, since that's what
+        # a tag covers.
+        self.CHUNK_SIZE = max(BLOCK_SIZE, chunk_size - chunk_size % BLOCK_SIZE)
+        self.threads = max(1, threads)
+
+    def _read_header(self, in_file, authenticated=False):
+        # authenticated is set for files whose record says they were stored as v4,
+        # anything else in their place has been swapped or tampered with
+        header = self._parse_header(in_file)
+        if authenticated and header.version != FORMAT_CTR_AUTH:
+            metrics.integrity_failures.inc(kind='header')
+            raise IntegrityError('file is stored without authentication tags, its record says with')
+        return header
+
+    def _parse_header(self, in_file):
+        file_len = os.fstat(in_file.fileno()).st_size
+        size = SIZE_HEADER.unpack(in_file.read(SIZE_HEADER.size))[0]
+        version, magic = VERSION_HEADER.unpack(in_file.read(VERSION_HEADER.size))
+        if version == FORMAT_CTR and magic == FORMAT_MAGIC and file_len == CTR_HEADER_SIZE + size:
+            return FileHeader(FORMAT_CTR, size, in_file.read(CTR_NONCE_SIZE), CTR_HEADER_SIZE)
+        trailer = auth_trailer_size(size) if version == FORMAT_CTR_AUTH else 0
+        # a truncated or extended v4 file must not be mistaken for a legacy one
+        if version == FORMAT_CTR_AUTH and magic == FORMAT_MAGIC and file_len != COMPRESSED_HEADER_SIZE + size + trailer:
+            metrics.integrity_failures.inc(kind='header')
+            raise IntegrityError('file length {} does not match its header'.format(file_len))
+        if version in (FORMAT_CTR_COMPRESSED, FORMAT_CTR_AUTH) and magic == FORMAT_MAGIC \
+                and file_len == COMPRESSED_HEADER_SIZE + size + trailer:
+            nonce = in_file.read(CTR_NONCE_SIZE)
+            codec_id, original_size = CODEC_HEADER.unpack(in_file.read(CODEC_HEADER.size))
+            codec = compression.CODEC_NAMES.get(codec_id, codec_id) if codec_id else None
+            return FileHeader(version, size, nonce, COMPRESSED_HEADER_SIZE, codec, original_size)
+        in_file.seek(SIZE_HEADER.size)
+        return FileHeader(FORMAT_LEGACY_CBC, size, in_file.read(CBC_IV_SIZE), SIZE_HEADER.size + CBC_IV_SIZE)
+
+    def _decryptor(self, in_file, header, offset=0):
+        # Positions in_file and returns a cipher producing plaintext from the
+        # 16 byte block containing offset, along with how many leading bytes to drop
+        key = self.key
+        block = offset // BLOCK_SIZE
+        if header.version != FORMAT_LEGACY_CBC:
+            in_file.seek(header.data_offset + block * BLOCK_SIZE)
+            decryptor = AES.new(key, AES.MODE_CTR, nonce=header.iv, initial_value=block)
+        else:
+            # CBC decryption of a block only needs the previous ciphertext block as iv
+            if block == 0:
+                iv = header.iv
+                in_file.seek(header.data_offset)
+            else:
+                in_file.seek(header.data_offset + (block - 1) * BLOCK_SIZE)
+                iv = in_file.read(BLOCK_SIZE)
+            decryptor = AES.new(key, AES.MODE_CBC, iv)
+        return decryptor, offset - block * BLOCK_SIZE
+
+    def _is_parallel(self, length):
+        return self.threads > 1 and length > self.CHUNK_SIZE
+
+    def _map_ordered(self, fn, args):
+        # Yields fn(arg) for every arg in args in order. With several threads the
+        # pool works through a window of args ahead while the caller writes out
+        # the results, fn must not depend on the ones before it. args may be a
+        # generator, it is only read as far as the window reaches. Callers close
+        # the generator before the files fn reads, abandoning it waits out the
+        # window's running calls and drops the rest.
+        if self.threads == 1 or (hasattr(args, '__len__') and len(args) < 2):
+            for arg in args:
+                yield fn(arg)
+            return
+        pool = _cipher_pool(self.threads)
+        window = min(self.threads * 2, MAX_PENDING_CHUNKS)
+        pending = deque()
+        try:
+            for arg in args:
+                pending.append(pool.submit(fn, arg))
+                if len(pending) >= window:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+        finally:
+            for future in pending:
+                future.cancel()
+            wait(pending)
+
+    def _ctr_segments(self, nonce, read, stream_offset, length):
+        # CTR encryption and decryption are the same operation. Yields the transform
+        # of length bytes from read(pos, n), pos 0 being stream_offset bytes into the
+        # keystream, in CHUNK_SIZE segments and in order.
+        key = self.key
+        def transform(pos):
+            data = read(pos, min(self.CHUNK_SIZE, length - pos))
+            block, skip = divmod(stream_offset + pos, BLOCK_SIZE)
+            cipher = AES.new(key, AES.MODE_CTR, nonce=nonce, initial_value=block)
+            if skip:
+                cipher.encrypt(bytes(skip))
+            return cipher.encrypt(data)
+        return self._map_ordered(transform, range(0, length, self.CHUNK_SIZE))
+
+    def _chunk_tag(self, nonce, index, ciphertext):
+        tag = hmac.new(self.auth_key, nonce + CHUNK_INDEX.pack(index), sha256)
+        tag.update(ciphertext)
+        return tag.digest()
+
+    def _check_chunk(self, nonce, index, ciphertext, tag):
+        if not hmac.compare_digest(self._chunk_tag(nonce, index, ciphertext), tag):
+            metrics.integrity_failures.inc(kind='chunk')
+            raise IntegrityError('chunk {} failed authentication'.format(index), index)
+
+    def _seal(self, nonce, offset, data):
+        # Encrypts plaintext data that sits at offset and doesn't cross an auth
+        # chunk boundary, returns the ciphertext and its tag if data starts a chunk
+        block, skip = divmod(offset, BLOCK_SIZE)
+        cipher = AES.new(self.key, AES.MODE_CTR, nonce=nonce, initial_value=block)
+        if skip:
+            cipher.encrypt(bytes(skip))
+        ciphertext = cipher.encrypt(data)
+        if offset % AUTH_CHUNK_SIZE:
+            return ciphertext, None
+        return ciphertext, self._chunk_tag(nonce, offset // AUTH_CHUNK_SIZE, ciphertext)
+
+    def _auth_header(self, size, nonce, codec_id, original_size):
+        return SIZE_HEADER.pack(size) + VERSION_HEADER.pack(FORMAT_CTR_AUTH, FORMAT_MAGIC) + nonce \
+            + CODEC_HEADER.pack(codec_id, original_size)
+
+    def _trailer(self, header_bytes, tags):
+        tags = b''.join(tags)
+        return tags + hmac.new(self.auth_key, header_bytes + tags, sha256).digest()
+
+    def _read_tags(self, in_file, header):
+        # Returns the chunk tags of a v4 file once they and the header check out
+        count = -(-header.size // AUTH_CHUNK_SIZE)
+        fd = in_file.fileno()
+        header_bytes = os.pread(fd, header.data_offset, 0)
+        trailer = os.pread(fd, (count + 1) * AUTH_TAG_SIZE, header.data_offset + header.size)
+        tags, header_tag = trailer[:-AUTH_TAG_SIZE], trailer[-AUTH_TAG_SIZE:]
+        if not hmac.compare_digest(hmac.new(self.auth_key, header_bytes + tags, sha256).digest(), header_tag):
+            metrics.integrity_failures.inc(kind='header')
+            raise IntegrityError('file header failed authentication')
+        return [tags[i * AUTH_TAG_SIZE:(i + 1) * AUTH_TAG_SIZE] for i in range(count)]
+
+    def _open_chunks(self, in_file, header, first, last):
+        # Yields the plaintext of chunks [first, last) of a v4 file, each checked before it is decrypted
+        tags = self._read_tags(in_file, header)
+        fd = in_file.fileno()
+        key = self.key
+        def open_chunk(index):
+            offset = index * AUTH_CHUNK_SIZE
+            ciphertext = os.pread(fd, min(AUTH_CHUNK_SIZE, header.size - offset), header.data_offset + offset)
+            self._check_chunk(header.iv, index, ciphertext, tags[index])
+            return AES.new(key, AES.MODE_CTR, nonce=header.iv, initial_value=offset // BLOCK_SIZE).decrypt(ciphertext)
+        return self._map_ordered(open_chunk, range(first, last))
 
-    def encrypt_file(self, path, outpath):
+    def _write_sealed(self, out_file, nonce, read, length, progress=None):
+        # Encrypts length bytes from read(offset, n) into out_file, returns the chunk tags
+        tags = []
+        done = 0
+        seal = lambda piece: self._seal(nonce, piece[0], read(*piece))
+        with closing(self._map_ordered(seal, _auth_pieces(0, length))) as sealed:
+            for ciphertext, tag in sealed:
+                out_file.write(ciphertext)
+                tags.append(tag)
+                done += len(ciphertext)
+                if progress:
+                    progress(done, length)
+        return tags
+
+    def encrypt_file(self, path, outpath, progress=None):
         start = time.time()
-        key = sha256(self.password).digest()
-        iv = os.urandom(16)
-        encryptor = AES.new(key, AES.MODE_CBC, iv)
+        nonce = os.urandom(CTR_NONCE_SIZE)
         filesize = os.path.getsize(path)
         with open(path, 'rb') as in_file, open(outpath, 'wb') as out_file:
-            out_file.write(struct.pack('<Q', filesize))
-            out_file.write(iv)
+            header = self._auth_header(filesize, nonce, 0, filesize)
+            out_file.write(header)
+            in_fd = in_file.fileno()
+            tags = self._write_sealed(out_file, nonce, lambda offset, n: os.pread(in_fd, n, offset), filesize, progress)
+            out_file.write(self._trailer(header, tags))
+        elapsed = time.time() - start
+        metrics.observe_cipher('encrypt', filesize, elapsed)
+        logging.info('Encrypting for {} took {} seconds'.format(outpath, elapsed))
+
+    def create_encrypted_file(self, outpath, size):
+        # Starts a v4 file whose plaintext arrives later via write_encrypted_stream,
+        # returns the nonce that chunks must be encrypted with
+        nonce = os.urandom(CTR_NONCE_SIZE)
+        with open(outpath, 'wb') as out_file:
+            out_file.write(self._auth_header(max(size, 0), nonce, 0, max(size, 0)))
+            if size > 0:
+                out_file.truncate(COMPRESSED_HEADER_SIZE + size)
+        return nonce
+
+    def write_encrypted_stream(self, outpath, nonce, offset, in_file, content_blocks=False):
+        # Encrypts plaintext read from in_file until EOF into the file at outpath,
+        # starting offset bytes into its plaintext, one auth chunk at a time so only
+        # the pool's window of them is ever held in memory. Returns the length read,
+        # the tags of the auth chunks it starts as {index: (length, tag)} and, with
+        # content_blocks, the block_digests of what was read.
+        def pieces():
+            pos = offset
             while True:
-                chunk = in_file.read(self.CHUNK_SIZE)
-                if len(chunk) == 0:
-                    break
-                elif len(chunk) % 16 != 0:
-                    chunk += b' ' * (16 - len(chunk) % 16)
-                out_file.write(encryptor.encrypt(chunk))
-        logging.info('Encrypting for {} took {} seconds'.format(outpath, time.time() - start))
-
-    def decrypt_file(self, path, outpath):
+                want = AUTH_CHUNK_SIZE - pos % AUTH_CHUNK_SIZE
+                data = in_file.read(want)
+                # streams may return less than asked before EOF, a piece has to fill its chunk
+                while data and len(data) < want:
+                    more = in_file.read(want - len(data))
+                    if not more:
+                        break
+                    data += more
+                if not data:
+                    return
+                yield pos, data
+                pos += len(data)
+        return self._write_pieces(outpath, nonce, pieces(), content_blocks)
+
+    def _write_pieces(self, outpath, nonce, pieces, content_blocks):
+        # pieces are (offset, plaintext) that don't cross auth chunk boundaries
+        def seal(piece):
+            piece_offset, data = piece
+            ciphertext, tag = self._seal(nonce, piece_offset, data)
+            blocks = self.block_digests(piece_offset, data) if content_blocks else None
+            return piece_offset, ciphertext, tag, blocks
+        length = 0
+        tags = {}
+        blocks = {}
+        with open(outpath, 'r+b') as out_file:
+            fd = out_file.fileno()
+            for piece_offset, ciphertext, tag, piece_blocks in self._map_ordered(seal, pieces):
+                os.pwrite(fd, ciphertext, COMPRESSED_HEADER_SIZE + piece_offset)
+                length += len(ciphertext)
+                if tag is not None:
+                    tags[piece_offset // AUTH_CHUNK_SIZE] = (len(ciphertext), tag)
+                if piece_blocks:
+                    blocks.update(piece_blocks)
+        metrics.cipher_bytes.inc(length, op='encrypt_chunk')
+        return length, tags, blocks
+
+    def finish_encrypted_file(self, outpath, size, tags=None):
+        # Writes the final size and the trailer. tags are the ones write_encrypted_stream
+        # returned, chunks without one for their final length are read back and tagged.
+        tags = tags or {}
+        with open(outpath, 'r+b') as out_file:
+            out_file.seek(SIZE_HEADER.size + VERSION_HEADER.size)
+            nonce = out_file.read(CTR_NONCE_SIZE)
+            header = self._auth_header(size, nonce, 0, size)
+            out_file.seek(0)
+            out_file.write(header)
+            out_file.truncate(COMPRESSED_HEADER_SIZE + size)
+            fd = out_file.fileno()
+            def chunk_tag(index):
+                offset = index * AUTH_CHUNK_SIZE
+                length = min(AUTH_CHUNK_SIZE, size - offset)
+                known = tags.get(index, None)
+                if known is not None and known[0] == length:
+                    return known[1]
+                return self._chunk_tag(nonce, index, os.pread(fd, length, COMPRESSED_HEADER_SIZE + offset))
+            chunk_tags = list(self._map_ordered(chunk_tag, range(-(-size // AUTH_CHUNK_SIZE))))
+            out_file.seek(COMPRESSED_HEADER_SIZE + size)
+            out_file.write(self._trailer(header, chunk_tags))
+
+    def encrypt_bytes(self, data, outpath):
+        nonce = os.urandom(CTR_NONCE_SIZE)
+        view = memoryview(data)
+        with open(outpath, 'wb') as out_file:
+            header = self._auth_header(len(data), nonce, 0, len(data))
+            out_file.write(header)
+            tags = self._write_sealed(out_file, nonce, lambda offset, n: view[offset:offset + n], len(data))
+            out_file.write(self._trailer(header, tags))
+
+    def encrypt_record(self, data):
+        # Self-contained authenticated record: nonce | ciphertext | tag
+        key = self.key
+        encryptor = AES.new(key, AES.MODE_GCM, nonce=os.urandom(RECORD_NONCE_SIZE))
+        ciphertext, tag = encryptor.encrypt_and_digest(data)
+        return encryptor.nonce + ciphertext + tag
+
+    def decrypt_record(self, record):
+        # Raises ValueError if the record is truncated or was not written with this key
+        key = self.key
+        nonce = record[:RECORD_NONCE_SIZE]
+        ciphertext = record[RECORD_NONCE_SIZE:-RECORD_TAG_SIZE]
+        tag = record[-RECORD_TAG_SIZE:]
+        decryptor = AES.new(key, AES.MODE_GCM, nonce=nonce)
+        return decryptor.decrypt_and_verify(ciphertext, tag)
+
+    def decrypt_file(self, path, outpath, progress=None, authenticated=False):
         start = time.time()
         with open(path, 'rb') as in_file, open(outpath, 'wb') as out_file:
-            key = sha256(self.password).digest()
-            origsize = struct.unpack('<Q', in_file.read(struct.calcsize('Q')))[0]
-            iv = in_file.read(16)
-            decryptor = AES.new(key, AES.MODE_CBC, iv)
-            while True:
-                chunk = in_file.read(self.CHUNK_SIZE)
-                if len(chunk) == 0:
-                    break
-                out_file.write(decryptor.decrypt(chunk))
-            out_file.truncate(origsize)
-        logging.info('Decrypting for {} took {} seconds'.format(outpath, time.time() - start))
+            header = self._read_header(in_file, authenticated)
+            if header.codec:
+                with closing(self._decompress(in_file, header)) as chunks:
+                    for chunk in chunks:
+                        out_file.write(chunk)
+                        if progress:
+                            progress(out_file.tell(), header.original_size)
+            elif header.version == FORMAT_CTR_AUTH:
+                with closing(self._stream(in_file, header, 0, None)) as chunks:
+                    for chunk in chunks:
+                        out_file.write(chunk)
+                        if progress:
+                            progress(out_file.tell(), header.size)
+            elif header.version == FORMAT_CTR and self._is_parallel(header.size):
+                in_fd = in_file.fileno()
+                read = lambda pos, n: os.pread(in_fd, n, header.data_offset + pos)
+                with closing(self._ctr_segments(header.iv, read, 0, header.size)) as segments:
+                    for data in segments:
+                        out_file.write(data)
+                        if progress:
+                            progress(out_file.tell(), header.size)
+            else:
+                decryptor, _ = self._decryptor(in_file, header)
+                buf = memoryview(bytearray(self.CHUNK_SIZE))
+                while True:
+                    n = in_file.readinto(buf)
+                    if n == 0:
+                        break
+                    decryptor.decrypt(buf[:n], output=buf[:n])
+                    out_file.write(buf[:n])
+                    if progress:
+                        progress(min(out_file.tell(), header.size), header.size)
+                out_file.truncate(header.size)
+        elapsed = time.time() - start
+        metrics.observe_cipher('decrypt', header.original_size, elapsed)
+        logging.info('Decrypting for {} took {} seconds'.format(outpath, elapsed))
 
-    def decrypt_json(self, path):
+    def get_decrypted_size(self, path, authenticated=False):
         with open(path, 'rb') as in_file:
-            key = sha256(self.password).digest()
-            origsize = struct.unpack('<Q', in_file.read(struct.calcsize('Q')))[0]
-            iv = in_file.read(16)
-            decryptor = AES.new(key, AES.MODE_CBC, iv)
-            chunks = []
-            while True:
-                chunk = in_file.read(self.CHUNK_SIZE)
-                if len(chunk) == 0:
-                    break
-                chunks.append(decryptor.decrypt(chunk).decode('utf-8'))
-            json_str = ''.join(chunks)
-            json_str.strip()
-
-            metadata = None
+            return self._read_header(in_file, authenticated).original_size
+
+    def get_header(self, path):
+        with open(path, 'rb') as in_file:
+            return self._read_header(in_file)
+
+    def _stream(self, in_file, header, start, stop):
+        # Yields stored plaintext bytes [start, stop), only decrypting the blocks covering them
+        stop = header.size if stop is None else min(stop, header.size)
+        if header.version == FORMAT_CTR_AUTH:
+            pos = start - start % AUTH_CHUNK_SIZE
+            first, last = start // AUTH_CHUNK_SIZE, -(-stop // AUTH_CHUNK_SIZE)
+            with closing(self._open_chunks(in_file, header, first, last)) as chunks:
+                for data in chunks:
+                    chunk = data[max(start - pos, 0):stop - pos]
+                    pos += len(data)
+                    metrics.cipher_bytes.inc(len(chunk), op='decrypt_stream')
+                    yield chunk
+            return
+        if header.version != FORMAT_LEGACY_CBC and self._is_parallel(stop - start):
+            in_fd = in_file.fileno()
+            read = lambda pos, n: os.pread(in_fd, n, header.data_offset + start + pos)
+            with closing(self._ctr_segments(header.iv, read, start, stop - start)) as segments:
+                for chunk in segments:
+                    metrics.cipher_bytes.inc(len(chunk), op='decrypt_stream')
+                    yield chunk
+            return
+        decryptor, skip = self._decryptor(in_file, header, start)
+        remaining = stop - start
+        buf = memoryview(bytearray(self.CHUNK_SIZE))
+        while remaining > 0:
+            to_read = min(self.CHUNK_SIZE, skip + remaining)
+            n = in_file.readinto(buf[:to_read + (-to_read % BLOCK_SIZE)])
+            if n == 0:
+                break
+            decryptor.decrypt(buf[:n], output=buf[:n])
+            chunk = bytes(buf[skip:min(n, skip + remaining)])
+            metrics.cipher_bytes.inc(len(chunk), op='decrypt_stream')
+            skip = 0
+            remaining -= len(chunk)
+            yield chunk
+
+    def _decompress(self, in_file, header):
+        with closing(self._stream(in_file, header, 0, None)) as chunks:
+            yield from compression.decompress_chunks(header.codec, chunks, self.CHUNK_SIZE)
+
+    def decrypt_stream(self, path, start=0, stop=None, authenticated=False):
+        # Yields plaintext bytes [start, stop). A compressed file has to be
+        # decompressed from its start, the bytes in front of start are dropped.
+        with open(path, 'rb') as in_file:
+            header = self._read_header(in_file, authenticated)
+            if not header.codec:
+                yield from self._stream(in_file, header, start, stop)
+                return
+            stop = header.original_size if stop is None else min(stop, header.original_size)
+            pos = 0
+            with closing(self._decompress(in_file, header)) as chunks:
+                for chunk in chunks:
+                    if pos + len(chunk) > start:
+                        yield chunk[max(start - pos, 0):stop - pos]
+                    pos += len(chunk)
+                    if pos >= stop:
+                        break
+
+    def compress_file(self, path, outpath, codec, progress=None, authenticated=False):
+        # Rewrites the file at path as a v4 file compressed with codec, returns the compressed size
+        start = time.time()
+        nonce = os.urandom(CTR_NONCE_SIZE)
+        codec_id = compression.CODEC_IDS[codec]
+        compressor = compression.compressobj(codec)
+        with open(path, 'rb') as in_file, open(outpath, 'wb') as out_file:
+            header = self._read_header(in_file, authenticated)
+            out_file.write(self._auth_header(0, nonce, codec_id, header.original_size))
+            size = 0
+            done = 0
+            tags = []
+            pending = bytearray()
+            # the compressed stream is sealed a whole auth chunk at a time
+            def seal(final):
+                nonlocal size
+                while len(pending) >= AUTH_CHUNK_SIZE or (final and pending):
+                    ciphertext, tag = self._seal(nonce, size, bytes(pending[:AUTH_CHUNK_SIZE]))
+                    del pending[:AUTH_CHUNK_SIZE]
+                    out_file.write(ciphertext)
+                    tags.append(tag)
+                    size += len(ciphertext)
+            with closing(self.decrypt_stream(path, authenticated=authenticated)) as chunks:
+                for chunk in chunks:
+                    pending += compressor.compress(chunk)
+                    seal(False)
+                    done += len(chunk)
+                    if progress:
+                        progress(done, header.original_size)
+            pending += compressor.flush()
+            seal(True)
+            header_bytes = self._auth_header(size, nonce, codec_id, header.original_size)
+            out_file.write(self._trailer(header_bytes, tags))
+            out_file.seek(0)
+            out_file.write(header_bytes)
+        elapsed = time.time() - start
+        metrics.observe_cipher('compress', header.original_size, elapsed)
+        logging.info('Compressing {} with {} took {} seconds'.format(outpath, codec, elapsed))
+        return size
+
+    def verify_file(self, path, progress=None, authenticated=False):
+        # Checks every chunk tag of a v4 file without decrypting it and returns its
+        # header, progress gets the bytes checked. Earlier versions carry no tags.
+        with open(path, 'rb') as in_file:
+            header = self._read_header(in_file, authenticated)
+            if header.version != FORMAT_CTR_AUTH:
+                return header
+            fd = in_file.fileno()
+            for index, tag in enumerate(self._read_tags(in_file, header)):
+                offset = index * AUTH_CHUNK_SIZE
+                ciphertext = os.pread(fd, min(AUTH_CHUNK_SIZE, header.size - offset), header.data_offset + offset)
+                self._check_chunk(header.iv, index, ciphertext, tag)
+                if progress:
+                    progress(len(ciphertext))
+            return header
+
+    def block_digests(self, offset, data):
+        # Digests of the content blocks starting in plaintext data written at
+        # offset, as {block index: (length, digest)}. Data that doesn't start on a
+        # block boundary gives none, a block cut short by the end of data is
+        # recorded with its length and only counts if it is the file's last block.
+        if offset % CONTENT_BLOCK_SIZE:
+            return {}
+        first = offset // CONTENT_BLOCK_SIZE
+        data = memoryview(data)
+        return {
+            first + i: (len(block), hmac.new(self.content_key, block, sha256).digest())
+            for i, block in enumerate(data[pos:pos + CONTENT_BLOCK_SIZE]
+                                      for pos in range(0, len(data), CONTENT_BLOCK_SIZE))
+        }
+
+    def content_id(self, size, blocks):
+        # Returns None unless blocks has the digest of every block of a size byte plaintext
+        digests = []
+        for i in range(-(-size // CONTENT_BLOCK_SIZE)):
+            block = blocks.get(i, None)
+            if block is None or block[0] != min(CONTENT_BLOCK_SIZE, size - i * CONTENT_BLOCK_SIZE):
+                return None
+            digests.append(block[1])
+        return hmac.new(self.content_key, SIZE_HEADER.pack(size) + b''.join(digests), sha256).hexdigest()
+
+    def file_content_id(self, path):
+        size = self.get_decrypted_size(path)
+        blocks = {}
+        buf = bytearray()
+        for chunk in self.decrypt_stream(path):
+            buf += chunk
+            while len(buf) >= CONTENT_BLOCK_SIZE:
+                blocks.update(self.block_digests(len(blocks) * CONTENT_BLOCK_SIZE, buf[:CONTENT_BLOCK_SIZE]))
+                del buf[:CONTENT_BLOCK_SIZE]
+        if buf:
+            blocks.update(self.block_digests(len(blocks) * CONTENT_BLOCK_SIZE, buf))
+        return self.content_id(size, blocks)
+
+    def decrypt_json(self, path):
+        # Raises IntegrityError if the file fails its checks, or for files written
+        # before v4 if it doesn't decrypt to JSON
+        with metrics.metadata_decrypt_latency.time(format='json'), open(path, 'rb') as in_file:
+            header = self._read_header(in_file)
+            if header.version == FORMAT_CTR_AUTH:
+                json_bytes = b''.join(self._stream(in_file, header, 0, None))
+            else:
+                decryptor, _ = self._decryptor(in_file, header)
+                json_bytes = bytearray(header.size + (-header.size % BLOCK_SIZE))
+                n = in_file.readinto(json_bytes)
+                decryptor.decrypt(memoryview(json_bytes)[:n], output=memoryview(json_bytes)[:n])
+                del json_bytes[header.size:]
+
             try:
-                metadata = json.loads(json_str)
-            except Exception as e:
-                print(e)
-                raise InvalidPassword()
-            return metadata
+                return json.loads(json_bytes.decode('utf-8'))
+            except ValueError as e:
+                raise IntegrityError('metadata did not decrypt to JSON: {}'.format(e))
@@ -20,6 +20,14 @@ class NoFile(HTTPException):
     code = 400
     description = "no file attached"
 
+class MalformedUpload(HTTPException):
+    code = 400
+    description = "malformed multipart upload"
+
+class MetadataAfterFile(HTTPException):
+    code = 400
+    description = "the metadata field of an upload must come before its file part"
+
 class FileStoreDNE(HTTPException):
     code = 404
     description = "file store does not exist"
@@ -36,10 +44,6 @@ class InvalidPassword(HTTPException):
     code = 400
     description = 'invalid password on session'
 
-class FileIsBeingEncrypted(HTTPException):
-    code = 423
-    description = 'file is currently being encrypted'
-
 class FileIsBeingDecrypted(HTTPException):
     code = 423
     description = 'file is currently being decrypted'
@@ -51,6 +55,13 @@ class InvalidFileID(HTTPException):
         self.description = 'invalid file id: {}'.format(file_id)
         super().__init__()
 
+class InvalidJobID(HTTPException):
+    code = 404
+
+    def __init__(self, job_id):
+        self.description = 'invalid job id: {}'.format(job_id)
+        super().__init__()
+
 class InvalidTag(HTTPException):
     code = 400
 
@@ -58,9 +69,67 @@ class InvalidTag(HTTPException):
         self.description = 'tag does not exist: {}'.format(tag)
         super().__init__()
 
+class InvalidQuery(HTTPException):
+    code = 400
+
+    def __init__(self, name, value):
+        self.description = 'invalid value for {}: {}'.format(name, value)
+        super().__init__()
+
+class InvalidBatchOp(HTTPException):
+    code = 400
+
+    def __init__(self, op, missing=None):
+        if missing is None:
+            self.description = 'invalid batch operation: {}'.format(op)
+        else:
+            self.description = 'batch operation {} is missing {}'.format(op, missing)
+        super().__init__()
+
 class FileUploadError(HTTPException):
     code = 500
 
     def __init__(self, file_id, reason):
         self.description = 'failed to upload file {}: {}'.format(file_id, reason)
         super().__init__()
+
+class NoUpload(HTTPException):
+    code = 404
+
+    def __init__(self, file_id):
+        self.description = 'no upload in progress for file {}'.format(file_id)
+        super().__init__()
+
+class UploadFinalizing(HTTPException):
+    code = 409
+
+    def __init__(self, file_id):
+        self.description = 'upload of file {} is being finalized'.format(file_id)
+        super().__init__()
+
+class FileCorrupted(HTTPException):
+    code = 500
+
+    def __init__(self, file_id, reason):
+        self.description = 'stored file {} failed its integrity check: {}'.format(file_id, reason)
+        super().__init__()
+
+class MetadataCorrupted(HTTPException):
+    code = 500
+    description = 'metadata failed its integrity check'
+
+class NoScrubReport(HTTPException):
+    code = 404
+    description = 'store has not been scrubbed yet'
+
+class TooManyEventStreams(HTTPException):
+    code = 503
+    description = 'too many event streams are open, try again later'
+
+class MetricsDisabled(HTTPException):
+    code = 404
+    description = 'metrics are not enabled'
+
+class MetricsUnauthorized(HTTPException):
+    code = 401
+    description = 'metrics token missing or invalid'
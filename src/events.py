@@ -0,0 +1,122 @@
+import json
+import time
+import itertools
+from collections import deque
+from queue import Queue, Empty
+from threading import Lock, BoundedSemaphore
+
+from .error import TooManyEventStreams
+from . import state
+
+KEEPALIVE_INTERVAL = 15
+BACKLOG_SIZE = 256
+# How often streams of a shared session check the state backend for new events
+POLL_INTERVAL = 0.5
+
+# Every open stream holds a server thread for as long as the client stays
+# connected, so each worker process only serves EVENT_STREAMS of them at once
+stream_slots = None
+
+def init_streams(limit):
+    global stream_slots
+    stream_slots = BoundedSemaphore(limit) if limit else None
+
+def acquire_stream():
+    # Returns the function releasing the stream's slot
+    if stream_slots is None:
+        return lambda: None
+    if not stream_slots.acquire(blocking=False):
+        raise TooManyEventStreams()
+    return stream_slots.release
+
+class EventChannel:
+    # Fans job lifecycle events out to every subscriber of a session. A short
+    # backlog lets a reconnecting client pick up from its Last-Event-ID.
+    def __init__(self):
+        self.subscribers = []
+        self.backlog = deque(maxlen=BACKLOG_SIZE)
+        self.counter = itertools.count(1)
+        self.closed = False
+        self.lock = Lock()
+
+    def publish(self, kind, data):
+        with self.lock:
+            event = (next(self.counter), kind, data)
+            self.backlog.append(event)
+            for queue in self.subscribers:
+                queue.put(event)
+
+    def subscribe(self, last_event_id=None):
+        queue = Queue()
+        with self.lock:
+            if last_event_id is not None:
+                for event in self.backlog:
+                    if event[0] > last_event_id:
+                        queue.put(event)
+            if self.closed:
+                queue.put(None)
+            self.subscribers.append(queue)
+        return queue
+
+    def unsubscribe(self, queue):
+        with self.lock:
+            if queue in self.subscribers:
+                self.subscribers.remove(queue)
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+            for queue in self.subscribers:
+                queue.put(None)
+
+class SharedEventChannel:
+    # Events of sessions shared between worker processes are relayed through the
+    # state backend, so a stream on any worker sees the jobs of every worker.
+    # Streams end once the session is gone from the backend.
+    def __init__(self, session_name):
+        self.session_name = session_name
+
+    def publish(self, kind, data):
+        state.backend.put_event(self.session_name, kind, data)
+
+    def close(self):
+        pass
+
+def format_event(event):
+    event_id, kind, data = event
+    return 'id: {}\nevent: {}\ndata: {}\n\n'.format(event_id, kind, json.dumps(data))
+
+def stream_events(channel, last_event_id=None):
+    queue = channel.subscribe(last_event_id)
+    try:
+        yield 'retry: 3000\n\n'
+        while True:
+            try:
+                event = queue.get(timeout=KEEPALIVE_INTERVAL)
+            except Empty:
+                yield ': keepalive\n\n'
+                continue
+            if event is None:
+                return
+            yield format_event(event)
+    finally:
+        channel.unsubscribe(queue)
+
+def stream_shared_events(channel, last_event_id=None):
+    backend = state.backend
+    events, last_event_id = backend.get_events(channel.session_name, last_event_id)
+    yield 'retry: 3000\n\n'
+    idle = 0
+    while True:
+        for event in events:
+            yield format_event(event)
+        if events:
+            idle = 0
+        elif idle >= KEEPALIVE_INTERVAL:
+            if not backend.has_session(channel.session_name):
+                return
+            yield ': keepalive\n\n'
+            idle = 0
+        time.sleep(POLL_INTERVAL)
+        idle += POLL_INTERVAL
+        events, last_event_id = backend.get_events(channel.session_name, last_event_id)
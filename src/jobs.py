@@ -0,0 +1,354 @@
+import os
+import time
+import heapq
+import logging
+import itertools
+from threading import Thread, Condition, Event
+from uuid import uuid4
+
+from flask import Blueprint, request
+
+from .error import FileIsBeingDecrypted, InvalidJobID, MissingSessionName
+from .session import get_session
+from .metadata import save_metadata
+from . import cache, metrics, state, compression
+
+# Lower runs first, interactive decrypts jump ahead of bulk encrypts. Store scrubs
+# run one at a time on a pool of their own, a running job can't be preempted and
+# a long scrub would hold a worker away from decrypts for its whole length.
+DECRYPT_PRIORITY = 0
+ENCRYPT_PRIORITY = 10
+SCRUB_PRIORITY = 20
+
+bp = Blueprint('jobs', __name__, url_prefix='/api/jobs')
+
+pool = None
+scrub_pool = None
+
+class JobCancelled(Exception):
+    pass
+
+class Job:
+    def __init__(self, kind, priority, session, file_id, target, on_finish=None):
+        self.id = str(uuid4())
+        self.kind = kind
+        self.priority = priority
+        self.session_name = session['name']
+        self.events = session['events']
+        self.file_id = file_id
+        self.target = target
+        self.on_finish = on_finish
+        self.status = 'queued'
+        self.progress = 0.0
+        self.queued_time = time.time()
+        self.start_time = None
+        self.end_time = None
+        self.event = Event()
+        self.cancelled = Event()
+        self.result = None
+
+    def is_done(self):
+        return self.event.is_set()
+
+    def publish(self, kind):
+        job = self.to_dict()
+        self.events.publish(kind, job)
+        if state.backend:
+            # lets every worker report on the job
+            state.backend.put_job(job)
+
+    def update_progress(self, done, total):
+        # Passed to FileEncrypter as its progress callback so running jobs can be cancelled
+        if self.cancelled.is_set():
+            raise JobCancelled()
+        progress = done / total if total else 1.0
+        # only whole percent steps are worth an event
+        publish = int(progress * 100) != int(self.progress * 100)
+        self.progress = progress
+        if publish:
+            if state.backend and state.backend.is_job_cancel_requested(self.id):
+                self.cancelled.set()
+                raise JobCancelled()
+            self.publish('progress')
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'kind': self.kind,
+            'session_name': self.session_name,
+            'file_id': self.file_id,
+            'status': self.status,
+            'progress': self.progress,
+            'queued_time': self.queued_time,
+            'start_time': self.start_time,
+            'end_time': self.end_time,
+        }
+
+class JobPool:
+    def __init__(self, size, name='JobWorker'):
+        self.size = size
+        self.queue = []
+        self.jobs = {}
+        self.busy = 0
+        self.counter = itertools.count()
+        self.totals = {'done': 0, 'failed': 0, 'cancelled': 0}
+        self.cond = Condition()
+        self.workers = []
+        for i in range(size):
+            worker = Thread(target=self._work, name='{}-{}'.format(name, i), daemon=True)
+            worker.start()
+            self.workers.append(worker)
+
+    def submit(self, job):
+        with self.cond:
+            self.jobs[job.id] = job
+            heapq.heappush(self.queue, (job.priority, next(self.counter), job))
+            self.cond.notify()
+        job.publish('queued')
+        return job
+
+    def get(self, job_id):
+        with self.cond:
+            return self.jobs.get(job_id, None)
+
+    def cancel(self, job_id):
+        with self.cond:
+            job = self.jobs.get(job_id, None)
+            if job is None:
+                return None
+            job.cancelled.set()
+            if job.status != 'queued':
+                return job
+            # left in the heap, the worker that pops it drops it
+            self._finish(job, 'cancelled')
+        self._notify_finished(job)
+        return job
+
+    def stats(self):
+        with self.cond:
+            queued = {}
+            for _, _, job in self.queue:
+                if job.status == 'queued':
+                    queued[job.kind] = queued.get(job.kind, 0) + 1
+            return {
+                'workers': self.size,
+                'busy': self.busy,
+                'utilization': self.busy / self.size if self.size else 0,
+                'queue_depth': sum(queued.values()),
+                'queued': queued,
+                'totals': dict(self.totals),
+            }
+
+    def _finish(self, job, status):
+        # must hold self.cond
+        job.status = status
+        job.end_time = time.time()
+        self.totals[status] += 1
+        del self.jobs[job.id]
+
+    def _notify_finished(self, job):
+        if job.on_finish:
+            try:
+                job.on_finish(job)
+            except Exception as e:
+                logging.error('job {} cleanup failed'.format(job.id))
+                logging.error(e)
+        job.event.set()
+        job.publish(job.status)
+
+    def _work(self):
+        while True:
+            with self.cond:
+                while not self.queue:
+                    self.cond.wait()
+                _, _, job = heapq.heappop(self.queue)
+                if job.status != 'queued':
+                    continue
+                if state.backend and state.backend.is_job_cancel_requested(job.id):
+                    job.cancelled.set()
+                if job.cancelled.is_set():
+                    self._finish(job, 'cancelled')
+                    cancelled = True
+                else:
+                    cancelled = False
+                    job.status = 'running'
+                    job.start_time = time.time()
+                    self.busy += 1
+                    metrics.job_queue_wait.observe(job.start_time - job.queued_time, kind=job.kind)
+            if cancelled:
+                self._notify_finished(job)
+                continue
+            job.publish('running')
+            status = 'done'
+            try:
+                job.target(job)
+            except JobCancelled:
+                status = 'cancelled'
+            except Exception as e:
+                logging.error('failed to {}'.format(job.kind))
+                logging.error(e)
+                status = 'failed'
+            with self.cond:
+                self.busy -= 1
+                self._finish(job, status)
+            self._notify_finished(job)
+
+def _pool_gauge(key):
+    def gauge():
+        if pool is None:
+            return []
+        return [({}, pool.stats()[key])]
+    return gauge
+
+metrics.register(metrics.Gauge('efs_job_queue_depth', 'Jobs waiting for a worker', _pool_gauge('queue_depth')))
+metrics.register(metrics.Gauge('efs_job_workers_busy', 'Workers running a job', _pool_gauge('busy')))
+
+def init_pool(size):
+    global pool, scrub_pool
+    if pool is None:
+        pool = JobPool(size)
+        scrub_pool = JobPool(1, 'ScrubWorker')
+    return pool
+
+def get_decrypt_job(session, file_id):
+    with session['lock']:
+        return session['decrypt_jobs'].get(file_id, None)
+
+def add_decrypt_job(session, file_id, input_path, output_path, authenticated=False):
+    decrypt_job = get_decrypt_job(session, file_id)
+    if decrypt_job:
+        decrypt_job.event.wait()
+    def decrypt_file(job):
+        session['file_encrypter'].decrypt_file(input_path, output_path, job.update_progress, authenticated)
+    def on_finish(job):
+        with session['lock']:
+            if session['decrypt_jobs'].get(file_id, None) is job:
+                del session['decrypt_jobs'][file_id]
+        if job.status == 'done':
+            cache.decrypted_cache.complete(session['name'], file_id)
+        else:
+            cache.decrypted_cache.discard(session['name'], file_id)
+    job = Job('decrypt', DECRYPT_PRIORITY, session, file_id, decrypt_file, on_finish)
+    cache.decrypted_cache.reserve(session['name'], file_id, output_path)
+    with session['lock']:
+        session['decrypt_jobs'][file_id] = job
+    return pool.submit(job)
+
+def add_compress_job(session, file_id, path, codec, authenticated, is_current, on_done):
+    # Compresses a stored file or blob in the background. The uncompressed file stays
+    # servable until the compressed one replaces it, which is skipped if the file
+    # was replaced or deleted in the meantime, or is_current() says its records
+    # changed. on_done gets the new codec and size to record, both are called in
+    # the critical section that replaces the file. authenticated is what the
+    # file's record says, as for decrypting it.
+    def compress_file(job):
+        file_encrypter = session['file_encrypter']
+        try:
+            before = os.stat(path)
+        except FileNotFoundError:
+            return
+        sample = b''.join(file_encrypter.decrypt_stream(path, 0, compression.SAMPLE_SIZE, authenticated))
+        if not compression.is_worth_compressing(codec, sample):
+            return
+        tmp_path = path + '.compress'
+        try:
+            size = file_encrypter.compress_file(path, tmp_path, codec, job.update_progress, authenticated)
+            if size >= file_encrypter.get_decrypted_size(tmp_path) * compression.MIN_RATIO:
+                return
+            # under the metadata lock so a deleted blob isn't brought back
+            with session['metadata_lock']:
+                try:
+                    after = os.stat(path)
+                except FileNotFoundError:
+                    return
+                if (after.st_ino, after.st_mtime_ns) != (before.st_ino, before.st_mtime_ns) or not is_current():
+                    return
+                os.replace(tmp_path, path)
+                job.result = {'codec': codec, 'stored_size': os.path.getsize(path), 'authenticated': True}
+                on_done(job.result)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+    def on_finish(job):
+        if job.status == 'done' and job.result:
+            save_metadata(session)
+    job = Job('compress', ENCRYPT_PRIORITY, session, file_id, compress_file, on_finish)
+    return pool.submit(job)
+
+def add_finish_job(session, file_id, finish, on_cancel):
+    # Finishes an upload whose .part file has to be read back. on_cancel runs if the
+    # job is cancelled before it starts, so a retried last chunk can finish it.
+    def finish_upload(job):
+        finish()
+    def on_finish(job):
+        if job.start_time is None:
+            on_cancel()
+    job = Job('finish', ENCRYPT_PRIORITY, session, file_id, finish_upload, on_finish)
+    return pool.submit(job)
+
+def add_scrub_job(session, scrub, on_done):
+    # scrub(job) checks the whole store and returns its report, on_done gets it
+    with session['lock']:
+        scrub_job = session['scrub_job']
+        if scrub_job and not scrub_job.is_done():
+            return scrub_job
+        def on_finish(job):
+            if job.status == 'done' and job.result:
+                on_done(job.result)
+        def scrub_store(job):
+            job.result = scrub(job)
+        job = Job('scrub', SCRUB_PRIORITY, session, None, scrub_store, on_finish)
+        session['scrub_job'] = job
+    return scrub_pool.submit(job)
+
+def check_file_locked(session, file_id):
+    decrypt_job = get_decrypt_job(session, file_id)
+    if decrypt_job and not decrypt_job.is_done():
+        raise FileIsBeingDecrypted
+    if state.backend:
+        # decrypts running on other workers, finishing and compressing leave the file servable
+        if state.backend.get_active_job(session['name'], file_id, 'decrypt'):
+            raise FileIsBeingDecrypted
+
+@bp.route('', methods=['GET'])
+def jobs_endpoint():
+    if request.method == 'GET':
+        stats = pool.stats()
+        if 'session_name' in request.args:
+            session = get_session(request.args.get('session_name'))
+            if state.backend:
+                stats['jobs'] = state.backend.list_jobs(session['name'])
+            else:
+                with session['lock']:
+                    session_jobs = list(session['decrypt_jobs'].values())
+                stats['jobs'] = [job.to_dict() for job in session_jobs]
+        return stats, 200
+
+@bp.route('/<job_id>', methods=['GET', 'DELETE'])
+def job_endpoint(job_id):
+    session_name = request.args.get('session_name', None)
+    if request.method == 'DELETE' and request.is_json:
+        session_name = request.get_json().get('session_name', session_name)
+    if not session_name:
+        raise MissingSessionName()
+    session = get_session(session_name)
+    job_pool = pool if pool.get(job_id) else scrub_pool
+    job = job_pool.get(job_id)
+    if not job and state.backend:
+        return _shared_job_endpoint(session, job_id)
+    if not job or job.session_name != session['name']:
+        raise InvalidJobID(job_id)
+    if request.method == 'GET':
+        return job.to_dict(), 200
+    if request.method == 'DELETE':
+        job_pool.cancel(job_id)
+        return job.to_dict(), 200
+
+def _shared_job_endpoint(session, job_id):
+    # a job queued on another worker, which picks up the cancellation from the backend
+    job = state.backend.get_job(job_id)
+    if not job or job['session_name'] != session['name']:
+        raise InvalidJobID(job_id)
+    if request.method == 'DELETE':
+        state.backend.cancel_job(job_id)
+    return job, 200
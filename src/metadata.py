@@ -0,0 +1,509 @@
+import os
+import json
+import fcntl
+import struct
+import logging
+from threading import RLock
+
+from .error import InvalidPassword, MetadataCorrupted
+from .encrypter import IntegrityError, FORMAT_CTR_AUTH
+from .util import *
+from . import metrics
+from .stats import StoreStats
+from .metadata_format import is_packed_metadata, write_packed_metadata, read_packed_metadata, read_packed_file
+
+BASE_METADATA = {'files': {}, 'tags': []}
+
+# Metadata is persisted as an encrypted snapshot plus an append-only journal of
+# encrypted records next to it. Each record holds a JSON list of ops, and every
+# op carries a sequence number so ops already folded into the snapshot are
+# skipped on replay. Once the journal holds enough ops it is compacted into a
+# new snapshot and truncated.
+JOURNAL_RECORD_HEADER = struct.Struct('<I')
+
+# Snapshots are either one encrypted JSON document or the packed format from
+# metadata_format, whichever is read is rewritten in the session's configured
+# format on load.
+METADATA_FORMATS = ('json', 'packed')
+
+def encrypt_metadata(path, metadata, file_encrypter, metadata_format='json'):
+    with metrics.metadata_write_latency.time(kind='snapshot'):
+        if metadata_format == 'packed':
+            if isinstance(metadata, str):
+                metadata = json.loads(metadata)
+            write_packed_metadata(path + '.tmp', metadata, file_encrypter)
+        else:
+            if not isinstance(metadata, str):
+                metadata = json.dumps(metadata)
+            file_encrypter.encrypt_bytes(metadata.encode('utf-8'), path + '.tmp')
+        os.replace(path + '.tmp', path)
+
+def _integrity_error(session, e):
+    # Stores with a key check already had the password verified at login, and a
+    # chunk only fails once its header checked out under the key, so both mean
+    # the metadata itself was damaged. Older stores can't tell that from a wrong
+    # password.
+    if 'check' in session['keyinfo'] or e.chunk is not None:
+        logging.error('metadata for {} failed its integrity check: {}'.format(session['name'], e))
+        return MetadataCorrupted()
+    return InvalidPassword()
+
+def _read_snapshot(session):
+    path = get_metadata_path(session)
+    try:
+        if is_packed_metadata(path):
+            return read_packed_metadata(path, session['file_encrypter']), 'packed'
+        return session['file_encrypter'].decrypt_json(path), 'json'
+    except IntegrityError as e:
+        raise _integrity_error(session, e)
+
+def _add_tags(metadata, tags):
+    known_tags = set(metadata['tags'])
+    for tag in tags:
+        if tag not in known_tags:
+            metadata['tags'].append(tag)
+            known_tags.add(tag)
+
+# The tag index also holds the ids of the files sharing each blob, under keys no
+# tag name can collide with, so blob references are counted without a scan
+def _blob_key(blob):
+    return ('blob', blob)
+
+def build_tag_index(metadata):
+    tag_index = {tag: set() for tag in metadata['tags']}
+    for file_id, f_meta in metadata['files'].items():
+        for tag in f_meta['tags']:
+            tag_index.setdefault(tag, set()).add(file_id)
+        if f_meta.get('blob', None):
+            tag_index.setdefault(_blob_key(f_meta['blob']), set()).add(file_id)
+    return tag_index
+
+def get_blob_refs(tag_index, blob):
+    return tag_index.get(_blob_key(blob), set())
+
+def _index_file(tag_index, f_meta):
+    for tag in f_meta['tags']:
+        tag_index.setdefault(tag, set()).add(f_meta['id'])
+    if f_meta.get('blob', None):
+        tag_index.setdefault(_blob_key(f_meta['blob']), set()).add(f_meta['id'])
+
+def _unindex_file(tag_index, f_meta):
+    for tag in f_meta['tags']:
+        tag_index.get(tag, set()).discard(f_meta['id'])
+    if f_meta.get('blob', None):
+        file_ids = tag_index.get(_blob_key(f_meta['blob']), set())
+        file_ids.discard(f_meta['id'])
+        if not file_ids:
+            tag_index.pop(_blob_key(f_meta['blob']), None)
+
+def _remove_file_tag(tag_index, f_meta, tag):
+    f_meta['tags'].remove(tag)
+    # a patched file may carry duplicate tags
+    if tag in f_meta['tags']:
+        tag_index.setdefault(tag, set()).add(f_meta['id'])
+
+def _touched_files(tag_index, op):
+    if op['op'] == 'put_file':
+        return [op['file']['id']]
+    if op['op'] == 'delete_file':
+        return [op['id']]
+    return list(tag_index.get(op['tag'], ()))
+
+def apply_op(metadata, tag_index, op, stats=None):
+    # Ops are validated by the endpoints before being recorded, so replay is lenient.
+    # tag_index maps each tag to the ids of the files carrying it and is kept in step,
+    # as is stats when given.
+    if stats is None:
+        _apply_op(metadata, tag_index, op)
+        return
+    touched = _touched_files(tag_index, op)
+    for file_id in touched:
+        stats.remove(metadata['files'].get(file_id, None))
+    _apply_op(metadata, tag_index, op)
+    for file_id in touched:
+        stats.add(metadata['files'].get(file_id, None))
+
+def _apply_op(metadata, tag_index, op):
+    files = metadata['files']
+    if op['op'] == 'put_file':
+        f_meta = dict(op['file'], tags=list(op['file']['tags']))
+        if f_meta['id'] in files:
+            _unindex_file(tag_index, files[f_meta['id']])
+        files[f_meta['id']] = f_meta
+        _index_file(tag_index, f_meta)
+        _add_tags(metadata, f_meta['tags'])
+    elif op['op'] == 'delete_file':
+        f_meta = files.pop(op['id'], None)
+        if f_meta:
+            _unindex_file(tag_index, f_meta)
+    elif op['op'] == 'rename_tag':
+        # renaming a tag to itself would drop its index entry
+        if op['new_tag'] == op['tag']:
+            return
+        if op['tag'] in metadata['tags']:
+            metadata['tags'].remove(op['tag'])
+        _add_tags(metadata, [op['new_tag']])
+        new_tag_files = tag_index.setdefault(op['new_tag'], set())
+        for file_id in tag_index.pop(op['tag'], set()):
+            f_meta = files[file_id]
+            _remove_file_tag(tag_index, f_meta, op['tag'])
+            if op['new_tag'] not in f_meta['tags']:
+                f_meta['tags'].append(op['new_tag'])
+            new_tag_files.add(file_id)
+    elif op['op'] == 'delete_tag':
+        if op['tag'] in metadata['tags']:
+            metadata['tags'].remove(op['tag'])
+        for file_id in tag_index.pop(op['tag'], set()):
+            _remove_file_tag(tag_index, files[file_id], op['tag'])
+    else:
+        raise ValueError('unknown metadata op {}'.format(op['op']))
+
+def _copy_file(f_meta):
+    return dict(f_meta, tags=list(f_meta['tags'])) if f_meta else None
+
+def apply_op_with_undo(metadata, tag_index, op, stats=None):
+    # Applies op and returns what undo_op needs to put back the files and tags it changed
+    touched = _touched_files(tag_index, op)
+    undo = ({file_id: _copy_file(metadata['files'].get(file_id, None)) for file_id in touched},
+            list(metadata['tags']))
+    apply_op(metadata, tag_index, op, stats)
+    return undo
+
+def undo_op(metadata, tag_index, undo, stats=None):
+    saved_files, saved_tags = undo
+    for file_id, f_meta in saved_files.items():
+        current = metadata['files'].pop(file_id, None)
+        if current:
+            _unindex_file(tag_index, current)
+        if f_meta:
+            metadata['files'][file_id] = f_meta
+            _index_file(tag_index, f_meta)
+        if stats is not None:
+            stats.remove(current)
+            stats.add(f_meta)
+    metadata['tags'][:] = saved_tags
+
+def get_store_stats(session):
+    # must hold metadata_lock
+    if session['store_stats'] is None:
+        session['store_stats'] = StoreStats(session['metadata']['files'].values())
+    return session['store_stats']
+
+def filter_files(session, tags, exclude_tags):
+    # must hold metadata_lock
+    tag_index = session['tag_index']
+    files = session['metadata']['files']
+    if tags:
+        tag_sets = sorted((tag_index.get(tag, set()) for tag in tags), key=len)
+        file_ids = set(tag_sets[0]).intersection(*tag_sets[1:])
+    else:
+        file_ids = set(files)
+    for tag in exclude_tags:
+        file_ids -= tag_index.get(tag, set())
+    return {file_id: files[file_id] for file_id in file_ids}
+
+def get_tag_counts(session):
+    # must hold metadata_lock
+    tag_index = session['tag_index']
+    return {tag: len(tag_index.get(tag, ())) for tag in session['metadata']['tags']}
+
+def _read_journal(session, offset=0):
+    # Returns the ops recorded from offset on and the offset they end at
+    path = get_journal_path(session)
+    if not os.path.exists(path):
+        return [], 0
+    ops = []
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        valid_len = offset
+        while True:
+            header = f.read(JOURNAL_RECORD_HEADER.size)
+            if len(header) < JOURNAL_RECORD_HEADER.size:
+                break
+            length = JOURNAL_RECORD_HEADER.unpack(header)[0]
+            record = f.read(length)
+            if len(record) < length:
+                break
+            try:
+                ops.extend(json.loads(session['file_encrypter'].decrypt_record(record)))
+            except ValueError:
+                metrics.integrity_failures.inc(kind='metadata')
+                raise _integrity_error(session, IntegrityError('journal record at {} failed authentication'.format(valid_len)))
+            valid_len = f.tell()
+        if valid_len != os.fstat(f.fileno()).st_size:
+            # torn append from a crash, everything before it is intact
+            logging.warning('truncating partial journal record for {}'.format(session['name']))
+            os.truncate(path, valid_len)
+    return ops, valid_len
+
+def _append_journal(session, ops_json):
+    with metrics.metadata_write_latency.time(kind='journal'):
+        record = session['file_encrypter'].encrypt_record(ops_json.encode('utf-8'))
+        with open(get_journal_path(session), 'ab') as f:
+            f.write(JOURNAL_RECORD_HEADER.pack(len(record)) + record)
+            session['metadata_journal_offset'] = f.tell()
+
+def _stat(path):
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return (st.st_ino, st.st_mtime_ns, st.st_size)
+
+def _read_metadata(session):
+    # must hold metadata_lock, reads the snapshot and replays the journal over it
+    snapshot_stat = _stat(get_metadata_path(session))
+    metadata, snapshot_format = _read_snapshot(session)
+    seq = metadata.pop('journal_seq', 0)
+    tag_index = build_tag_index(metadata)
+    journal_ops, journal_offset = _read_journal(session)
+    for op in journal_ops:
+        if op['seq'] > seq:
+            apply_op(metadata, tag_index, op)
+            seq = op['seq']
+    session['metadata_seq'] = seq
+    session['metadata_journal_ops'] = len(journal_ops)
+    session['metadata_journal_offset'] = journal_offset
+    session['metadata_snapshot_stat'] = snapshot_stat
+    session['metadata_pending_ops'] = []
+    return metadata, tag_index, snapshot_format
+
+def _backfill_sizes(session):
+    # must hold metadata_lock. Records of files uploaded before sizes were kept
+    # get them from the stored file's header once, so stats and scrubs count
+    # them, records with no stored file were never uploaded
+    ops = []
+    for f_meta in session['metadata']['files'].values():
+        if 'size' in f_meta:
+            continue
+        path = get_stored_filepath(session['name'], f_meta)
+        try:
+            header = session['file_encrypter'].get_header(path)
+            stored_size = os.path.getsize(path)
+        except FileNotFoundError:
+            continue
+        except (IntegrityError, struct.error) as e:
+            # left for the scrub to report
+            logging.warning('could not read the size of {} in {}: {}'.format(f_meta['id'], session['name'], e))
+            continue
+        ops.append({
+            'op': 'put_file',
+            'file': dict(f_meta,
+                         size=header.original_size,
+                         stored_size=stored_size,
+                         codec=header.codec,
+                         authenticated=header.version == FORMAT_CTR_AUTH)
+        })
+    if ops:
+        record_metadata_ops(session, ops)
+        logging.info('recorded the sizes of {} files in {}'.format(len(ops), session['name']))
+    return bool(ops)
+
+def load_metadata(session):
+    # must not be called holding metadata_lock, a snapshot in the wrong format is migrated
+    snapshot_format = None
+    backfilled = False
+    with session['metadata_lock']:
+        if session['metadata'] is None:
+            session['metadata'], session['tag_index'], snapshot_format = _read_metadata(session)
+            session['store_stats'] = None
+            backfilled = _backfill_sizes(session)
+        metadata = session['metadata']
+    if snapshot_format and snapshot_format != session['metadata_format']:
+        with session['metadata_flush_lock'], session['metadata_lock']:
+            _compact_metadata(session)
+        logging.info('migrated metadata for {} from {} to {}'.format(
+            session['name'], snapshot_format, session['metadata_format']))
+    if backfilled:
+        save_metadata(session)
+    return metadata
+
+def _refresh_metadata(session):
+    # must hold metadata_lock, catches the cached metadata of a store shared with
+    # other worker processes up with the ops they appended since
+    if session['metadata'] is None:
+        return
+    journal_stat = _stat(get_journal_path(session))
+    journal_size = journal_stat[2] if journal_stat else 0
+    if _stat(get_metadata_path(session)) == session['metadata_snapshot_stat'] \
+            and journal_size >= session['metadata_journal_offset']:
+        if journal_size > session['metadata_journal_offset']:
+            ops, session['metadata_journal_offset'] = _read_journal(session, session['metadata_journal_offset'])
+            for op in ops:
+                if op['seq'] > session['metadata_seq']:
+                    apply_op(session['metadata'], session['tag_index'], op, session['store_stats'])
+                    session['metadata_seq'] = op['seq']
+            session['metadata_journal_ops'] += len(ops)
+        return
+    # compacted by another worker, reload in place since endpoints hold on to the dicts.
+    # Some read them without the lock, so they're never left empty in between.
+    metadata, tag_index, _ = _read_metadata(session)
+    for cached, loaded in ((session['metadata'], metadata), (session['tag_index'], tag_index)):
+        cached.update(loaded)
+        for key in cached.keys() - loaded.keys():
+            del cached[key]
+    session['store_stats'] = None
+
+class SharedMetadataLock:
+    # metadata_lock for stores shared between worker processes. The outermost
+    # acquire also takes an flock on the store, held until release, and refreshes
+    # the cached metadata, so ops are validated, applied and appended against the
+    # latest metadata and their sequence numbers never collide.
+    def __init__(self, session):
+        self.session = session
+        self.lock = RLock()
+        self.depth = 0
+        self.fd = None
+
+    def acquire(self):
+        self.lock.acquire()
+        self.depth += 1
+        if self.depth > 1:
+            return True
+        try:
+            lock_path = get_filepath(self.session['name'], 'metadata.lock')
+            if os.path.isdir(os.path.dirname(lock_path)):
+                self.fd = os.open(lock_path, os.O_RDWR | os.O_CREAT, 0o600)
+                fcntl.flock(self.fd, fcntl.LOCK_EX)
+                _refresh_metadata(self.session)
+        except Exception:
+            self.release()
+            raise
+        return True
+
+    def release(self):
+        if self.depth == 1 and self.fd is not None:
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+            os.close(self.fd)
+            self.fd = None
+        self.depth -= 1
+        self.lock.release()
+
+    def __enter__(self):
+        return self.acquire()
+
+    def __exit__(self, *exc):
+        self.release()
+
+def _apply_op_to_file(f_meta, file_id, op):
+    # apply_op for a single record, used when the rest of the metadata isn't loaded
+    if op['op'] == 'put_file':
+        return _copy_file(op['file']) if op['file']['id'] == file_id else f_meta
+    if op['op'] == 'delete_file':
+        return None if op['id'] == file_id else f_meta
+    if f_meta is None or op['tag'] not in f_meta['tags'] or op.get('new_tag', None) == op['tag']:
+        return f_meta
+    f_meta = _copy_file(f_meta)
+    f_meta['tags'].remove(op['tag'])
+    if op['op'] == 'rename_tag' and op['new_tag'] not in f_meta['tags']:
+        f_meta['tags'].append(op['new_tag'])
+    return f_meta
+
+def get_file_metadata(session, file_id):
+    # Returns one file record, or None. While the metadata isn't loaded a packed
+    # snapshot only has the block holding the record decrypted, then the journal
+    # is replayed over it, so single-file lookups don't load the whole store.
+    with session['metadata_lock']:
+        if session['metadata'] is not None:
+            return session['metadata']['files'].get(file_id, None)
+        path = get_metadata_path(session)
+        if is_packed_metadata(path):
+            try:
+                snapshot, f_meta = read_packed_file(path, session['file_encrypter'], file_id)
+            except IntegrityError as e:
+                raise _integrity_error(session, e)
+            seq = snapshot.get('journal_seq', 0)
+            for op in _read_journal(session)[0]:
+                if op['seq'] > seq:
+                    f_meta = _apply_op_to_file(f_meta, file_id, op)
+            return f_meta
+    metadata = load_metadata(session)
+    with session['metadata_lock']:
+        return metadata['files'].get(file_id, None)
+
+def record_metadata_ops(session, ops):
+    # Applies ops to the cached metadata and queues them for the journal,
+    # call save_metadata once the metadata lock has been released
+    with session['metadata_lock']:
+        for op in ops:
+            apply_op(session['metadata'], session['tag_index'], op, session['store_stats'])
+        record_applied_ops(session, ops)
+
+def record_applied_ops(session, ops):
+    # Queues ops that were already applied to the cached metadata, e.g. by apply_op_with_undo
+    with session['metadata_lock']:
+        for op in ops:
+            session['metadata_seq'] += 1
+            op['seq'] = session['metadata_seq']
+        if not session['metadata_shared']:
+            session['metadata_pending_ops'].extend(ops)
+            return
+        # other workers append as soon as the store lock is released, so shared stores write through here
+        try:
+            _append_journal(session, json.dumps(ops))
+        except Exception:
+            logging.error('failed to append metadata for {}, dropping cached metadata'.format(session['name']))
+            session['metadata'] = None
+            session['tag_index'] = None
+            session['store_stats'] = None
+            raise
+        session['metadata_journal_ops'] += len(ops)
+
+def is_metadata_dirty(session):
+    return bool(session['metadata_pending_ops'])
+
+def save_metadata(session):
+    if session['metadata_shared']:
+        with session['metadata_lock']:
+            if session['metadata'] is not None and session['metadata_journal_ops'] >= session['metadata_compact_ops']:
+                _compact_metadata(session)
+    elif not session['metadata_write_back']:
+        flush_metadata(session)
+
+def flush_metadata(session):
+    with session['metadata_flush_lock']:
+        with session['metadata_lock']:
+            if session['metadata'] is None or not is_metadata_dirty(session):
+                return
+            ops = session['metadata_pending_ops']
+            session['metadata_pending_ops'] = []
+            ops_json = json.dumps(ops)
+        try:
+            _append_journal(session, ops_json)
+        except Exception as e:
+            logging.error('failed to flush metadata for {}'.format(session['name']))
+            logging.error(e)
+            with session['metadata_lock']:
+                session['metadata_pending_ops'][:0] = ops
+            raise
+        session['metadata_journal_ops'] += len(ops)
+        if session['metadata_journal_ops'] >= session['metadata_compact_ops']:
+            _compact_metadata(session)
+
+def _compact_metadata(session):
+    # must hold metadata_flush_lock, or metadata_lock throughout for shared stores
+    with session['metadata_lock']:
+        metadata = session['metadata']
+        if session['metadata_format'] == 'packed':
+            # records are packed outside the lock, rename_tag edits tag lists in place
+            snapshot = dict(metadata,
+                            files={file_id: _copy_file(f_meta) for file_id, f_meta in metadata['files'].items()},
+                            tags=list(metadata['tags']),
+                            journal_seq=session['metadata_seq'])
+        else:
+            snapshot = json.dumps(dict(metadata, journal_seq=session['metadata_seq']))
+    encrypt_metadata(get_metadata_path(session), snapshot, session['file_encrypter'], session['metadata_format'])
+    # ops still pending are already in the snapshot, so replay skips them once appended
+    if os.path.exists(get_journal_path(session)):
+        os.truncate(get_journal_path(session), 0)
+    session['metadata_journal_ops'] = 0
+    session['metadata_journal_offset'] = 0
+    session['metadata_snapshot_stat'] = _stat(get_metadata_path(session))
+    logging.info('compacted metadata journal for {}'.format(session['name']))
+
+def invalidate_metadata(session):
+    flush_metadata(session)
+    with session['metadata_lock']:
+        session['metadata'] = None
+        session['tag_index'] = None
+        session['store_stats'] = None
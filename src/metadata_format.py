@@ -0,0 +1,194 @@
+import json
+import bisect
+import struct
+
+from .encrypter import IntegrityError
+from . import metrics
+
+# Packed metadata snapshot, an alternative to the single encrypted JSON document:
+#   magic (4) | version (1) | index offset (8) | blocks ... | index
+# File records are sorted by id and packed into blocks of about BLOCK_TARGET_SIZE
+# bytes, each block and the index is a length prefixed authenticated record
+# (FileEncrypter.encrypt_record) that can be decrypted on its own. The index holds
+# the top level metadata and the first file id, offset and length of every block,
+# so a single file is found by decrypting the index and the one block holding it.
+PACKED_MAGIC = b'EFSM'
+PACKED_VERSION = 1
+PACKED_HEADER = struct.Struct('<4sBQ')
+LENGTH = struct.Struct('<I')
+SHORT = struct.Struct('<H')
+INT = struct.Struct('<q')
+FLOAT = struct.Struct('<d')
+BLOCK_TARGET_SIZE = 64 * 1024
+
+# Field keys stored as a single byte, anything else is stored by name
+FIELD_KEYS = ['name', 'tags', 'filetype', 'size', 'upload_time', 'stored_size', 'codec', 'blob', 'access_time',
+              'authenticated']
+FIELD_CODES = {key: code for code, key in enumerate(FIELD_KEYS, 1)}
+
+T_NULL, T_FALSE, T_TRUE, T_INT, T_FLOAT, T_STR, T_TAG_REFS, T_JSON = range(8)
+
+def _pack_str(s):
+    data = s.encode('utf-8')
+    return LENGTH.pack(len(data)) + data
+
+def _pack_value(value, tag_refs):
+    if value is None:
+        return bytes([T_NULL])
+    if value is True or value is False:
+        return bytes([T_TRUE if value else T_FALSE])
+    if isinstance(value, int) and -2 ** 63 <= value < 2 ** 63:
+        return bytes([T_INT]) + INT.pack(value)
+    if isinstance(value, float):
+        return bytes([T_FLOAT]) + FLOAT.pack(value)
+    if isinstance(value, str):
+        return bytes([T_STR]) + _pack_str(value)
+    if isinstance(value, list) and all(isinstance(v, str) and v in tag_refs for v in value):
+        return bytes([T_TAG_REFS]) + LENGTH.pack(len(value)) + b''.join(LENGTH.pack(tag_refs[v]) for v in value)
+    return bytes([T_JSON]) + _pack_str(json.dumps(value))
+
+def _pack_record(f_meta, tag_refs):
+    # id | field count | (key code [key] | type | value) ...
+    id_bytes = f_meta['id'].encode('utf-8')
+    fields = [(key, value) for key, value in f_meta.items() if key != 'id']
+    parts = [SHORT.pack(len(id_bytes)), id_bytes, SHORT.pack(len(fields))]
+    for key, value in fields:
+        code = FIELD_CODES.get(key, 0)
+        parts.append(bytes([code]))
+        if code == 0:
+            parts.append(_pack_str(key))
+        parts.append(_pack_value(value, tag_refs))
+    record = b''.join(parts)
+    return LENGTH.pack(len(record)) + record
+
+def _unpack_str(buf, pos):
+    length = LENGTH.unpack_from(buf, pos)[0]
+    pos += LENGTH.size
+    return bytes(buf[pos:pos + length]).decode('utf-8'), pos + length
+
+def _unpack_value(buf, pos, tags):
+    kind = buf[pos]
+    pos += 1
+    if kind == T_NULL:
+        return None, pos
+    if kind in (T_FALSE, T_TRUE):
+        return kind == T_TRUE, pos
+    if kind == T_INT:
+        return INT.unpack_from(buf, pos)[0], pos + INT.size
+    if kind == T_FLOAT:
+        return FLOAT.unpack_from(buf, pos)[0], pos + FLOAT.size
+    if kind == T_STR:
+        return _unpack_str(buf, pos)
+    if kind == T_TAG_REFS:
+        count = LENGTH.unpack_from(buf, pos)[0]
+        pos += LENGTH.size
+        refs = struct.unpack_from('<{}I'.format(count), buf, pos)
+        return [tags[ref] for ref in refs], pos + count * LENGTH.size
+    if kind == T_JSON:
+        value, pos = _unpack_str(buf, pos)
+        return json.loads(value), pos
+    raise ValueError('unknown metadata value type {}'.format(kind))
+
+def _record_id(buf, pos):
+    # pos is the start of a record body, only the id is decoded
+    length = SHORT.unpack_from(buf, pos)[0]
+    return bytes(buf[pos + SHORT.size:pos + SHORT.size + length]).decode('utf-8')
+
+def _unpack_record(buf, pos, tags):
+    file_id = _record_id(buf, pos)
+    pos += SHORT.size + len(file_id.encode('utf-8'))
+    count = SHORT.unpack_from(buf, pos)[0]
+    pos += SHORT.size
+    f_meta = {'id': file_id}
+    for _ in range(count):
+        code = buf[pos]
+        pos += 1
+        if code == 0:
+            key, pos = _unpack_str(buf, pos)
+        else:
+            key = FIELD_KEYS[code - 1]
+        f_meta[key], pos = _unpack_value(buf, pos, tags)
+    return f_meta
+
+def _iter_records(block):
+    # yields the start of each record body in a decrypted block
+    pos = 0
+    while pos < len(block):
+        length = LENGTH.unpack_from(block, pos)[0]
+        yield pos + LENGTH.size
+        pos += LENGTH.size + length
+
+def is_packed_metadata(path):
+    with open(path, 'rb') as f:
+        header = f.read(PACKED_HEADER.size)
+    return len(header) == PACKED_HEADER.size and PACKED_HEADER.unpack(header)[0] == PACKED_MAGIC
+
+def write_packed_metadata(path, metadata, file_encrypter):
+    top = {key: value for key, value in metadata.items() if key != 'files'}
+    tags = top.get('tags', [])
+    tag_refs = {tag: i for i, tag in enumerate(tags)}
+    blocks = []
+    with open(path, 'wb') as out_file:
+        out_file.write(PACKED_HEADER.pack(PACKED_MAGIC, PACKED_VERSION, 0))
+        block, block_size, first_id = [], 0, None
+        for file_id in sorted(metadata['files']) + [None]:
+            if file_id is not None:
+                record = _pack_record(metadata['files'][file_id], tag_refs)
+                if first_id is None:
+                    first_id = file_id
+                block.append(record)
+                block_size += len(record)
+            if block and (block_size >= BLOCK_TARGET_SIZE or file_id is None):
+                data = file_encrypter.encrypt_record(b''.join(block))
+                blocks.append([first_id, out_file.tell(), LENGTH.size + len(data)])
+                out_file.write(LENGTH.pack(len(data)) + data)
+                block, block_size, first_id = [], 0, None
+        index_offset = out_file.tell()
+        index = file_encrypter.encrypt_record(json.dumps({'metadata': top, 'blocks': blocks}).encode('utf-8'))
+        out_file.write(LENGTH.pack(len(index)) + index)
+        out_file.seek(0)
+        out_file.write(PACKED_HEADER.pack(PACKED_MAGIC, PACKED_VERSION, index_offset))
+
+def _read_record(in_file, file_encrypter, offset):
+    in_file.seek(offset)
+    length = LENGTH.unpack(in_file.read(LENGTH.size))[0]
+    try:
+        return file_encrypter.decrypt_record(in_file.read(length))
+    except ValueError:
+        metrics.integrity_failures.inc(kind='metadata')
+        raise IntegrityError('metadata record at {} failed authentication'.format(offset))
+
+def _read_index(in_file, file_encrypter):
+    magic, version, index_offset = PACKED_HEADER.unpack(in_file.read(PACKED_HEADER.size))
+    if magic != PACKED_MAGIC or version != PACKED_VERSION:
+        raise ValueError('unsupported packed metadata version {}'.format(version))
+    return json.loads(_read_record(in_file, file_encrypter, index_offset))
+
+def read_packed_metadata(path, file_encrypter):
+    with metrics.metadata_decrypt_latency.time(format='packed'), open(path, 'rb') as in_file:
+        index = _read_index(in_file, file_encrypter)
+        metadata = index['metadata']
+        tags = metadata.get('tags', [])
+        files = {}
+        for _, offset, _ in index['blocks']:
+            block = memoryview(_read_record(in_file, file_encrypter, offset))
+            for pos in _iter_records(block):
+                f_meta = _unpack_record(block, pos, tags)
+                files[f_meta['id']] = f_meta
+        metadata['files'] = files
+        return metadata
+
+def read_packed_file(path, file_encrypter, file_id):
+    # Returns the top level metadata without files, and the record for file_id or None
+    with metrics.metadata_decrypt_latency.time(format='packed_file'), open(path, 'rb') as in_file:
+        index = _read_index(in_file, file_encrypter)
+        metadata = index['metadata']
+        blocks = index['blocks']
+        i = bisect.bisect_right([block[0] for block in blocks], file_id) - 1
+        if i < 0:
+            return metadata, None
+        block = memoryview(_read_record(in_file, file_encrypter, blocks[i][1]))
+        for pos in _iter_records(block):
+            if _record_id(block, pos) == file_id:
+                return metadata, _unpack_record(block, pos, metadata.get('tags', []))
+        return metadata, None
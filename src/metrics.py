@@ -0,0 +1,117 @@
+import time
+import bisect
+from threading import Lock
+
+# Minimal Prometheus text-format instrumentation, rendered on /metrics
+
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+THROUGHPUT_BUCKETS = (1, 5, 10, 25, 50, 100, 250, 500, 1000, 2500)
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+                          for k, v in labels) + '}'
+
+class Counter:
+    def __init__(self, name, description):
+        self.name = name
+        self.description = description
+        self.values = {}
+        self.lock = Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def render(self):
+        lines = ['# HELP {} {}'.format(self.name, self.description), '# TYPE {} counter'.format(self.name)]
+        with self.lock:
+            for key, value in self.values.items():
+                lines.append('{}{} {}'.format(self.name, _format_labels(key), value))
+        return lines
+
+class Gauge:
+    # Values are read from callback when rendered, it returns [(labels dict, value)]
+    def __init__(self, name, description, callback):
+        self.name = name
+        self.description = description
+        self.callback = callback
+
+    def render(self):
+        lines = ['# HELP {} {}'.format(self.name, self.description), '# TYPE {} gauge'.format(self.name)]
+        for labels, value in self.callback():
+            lines.append('{}{} {}'.format(self.name, _format_labels(tuple(sorted(labels.items()))), value))
+        return lines
+
+class Histogram:
+    def __init__(self, name, description, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.description = description
+        self.buckets = buckets
+        self.values = {}
+        self.lock = Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            counts, total = self.values.get(key, ([0] * (len(self.buckets) + 1), 0))
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            self.values[key] = (counts, total + value)
+
+    def time(self, **labels):
+        return _Timer(self, labels)
+
+    def render(self):
+        lines = ['# HELP {} {}'.format(self.name, self.description), '# TYPE {} histogram'.format(self.name)]
+        with self.lock:
+            for key, (counts, total) in self.values.items():
+                cumulative = 0
+                for bound, count in zip(self.buckets + ('+Inf',), counts):
+                    cumulative += count
+                    lines.append('{}_bucket{} {}'.format(self.name, _format_labels(key + (('le', bound),)), cumulative))
+                lines.append('{}_sum{} {}'.format(self.name, _format_labels(key), total))
+                lines.append('{}_count{} {}'.format(self.name, _format_labels(key), cumulative))
+        return lines
+
+class _Timer:
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.time() - self.start, **self.labels)
+
+registry = []
+
+def register(metric):
+    registry[:] = [m for m in registry if m.name != metric.name]
+    registry.append(metric)
+    return metric
+
+def render():
+    lines = []
+    for metric in registry:
+        try:
+            lines += metric.render()
+        except Exception:
+            continue
+    return '\n'.join(lines) + '\n'
+
+request_latency = register(Histogram('efs_request_duration_seconds', 'Request latency by endpoint'))
+metadata_decrypt_latency = register(Histogram('efs_metadata_decrypt_seconds', 'Time spent decrypting metadata snapshots, by format'))
+metadata_write_latency = register(Histogram('efs_metadata_write_seconds', 'Time spent persisting metadata, by kind'))
+cipher_throughput = register(Histogram('efs_cipher_throughput_mbps', 'Encrypt/decrypt throughput per file in MB/s', THROUGHPUT_BUCKETS))
+cipher_bytes = register(Counter('efs_cipher_bytes_total', 'Bytes passed through encrypt/decrypt'))
+integrity_failures = register(Counter('efs_integrity_failures_total', 'Stored file chunks, headers and metadata that failed authentication'))
+job_queue_wait = register(Histogram('efs_job_queue_wait_seconds', 'Time jobs spend queued before a worker picks them up'))
+
+def observe_cipher(op, nbytes, seconds):
+    cipher_bytes.inc(nbytes, op=op)
+    if seconds > 0:
+        cipher_throughput.observe(nbytes / seconds / 1e6, op=op)
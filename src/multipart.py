@@ -0,0 +1,58 @@
+from werkzeug.sansio.multipart import MultipartDecoder, Field, File, Data, Epilogue, NeedData
+
+from .error import MalformedUpload
+
+# Chunk uploads are read straight off the request stream. werkzeug's form parser
+# spools file parts over 500 KB to a temporary file, which would put the chunk's
+# plaintext on disk before it is encrypted. Here the fields in front of the file
+# part are collected and the file part is then read like a file, so it can be
+# encrypted as it arrives. Clients have to send their fields before the file.
+
+READ_SIZE = 256 * 1024
+
+class MultipartReader:
+    def __init__(self, stream, boundary, max_form_memory_size=None):
+        self.stream = stream
+        self.decoder = MultipartDecoder(boundary.encode('latin-1'), max_form_memory_size)
+        self.pending = b''
+        self.done = False
+
+    def _next_event(self):
+        try:
+            event = self.decoder.next_event()
+            while isinstance(event, NeedData):
+                self.decoder.receive_data(self.stream.read(READ_SIZE) or None)
+                event = self.decoder.next_event()
+        except ValueError:
+            raise MalformedUpload()
+        return event
+
+    def read_fields(self, file_name):
+        # Returns the fields in front of the file part named file_name and
+        # whether there is one, other file parts are skipped
+        fields = {}
+        part = None
+        value = []
+        while True:
+            event = self._next_event()
+            if isinstance(event, Epilogue):
+                return fields, False
+            if isinstance(event, File) and event.name == file_name:
+                return fields, True
+            if isinstance(event, (Field, File)):
+                part = event
+                value = []
+            elif isinstance(event, Data) and isinstance(part, Field):
+                value.append(event.data)
+                if not event.more_data:
+                    fields[part.name] = b''.join(value).decode('utf-8', 'replace')
+
+    def read(self, size):
+        # Reads the file part found by read_fields
+        while not self.pending and not self.done:
+            # only data follows the start of a part, up to its last
+            event = self._next_event()
+            self.pending = event.data
+            self.done = not event.more_data
+        data, self.pending = self.pending[:size], self.pending[size:]
+        return data
@@ -0,0 +1,255 @@
+import os
+import json
+import time
+import fcntl
+import logging
+from threading import Timer, Lock
+
+from flask import Blueprint, request
+
+from .error import MissingSessionName, NoScrubReport
+from .encrypter import IntegrityError, FORMAT_CTR_AUTH
+from .metadata import load_metadata, get_blob_refs
+from .session import sessions, sessions_lock
+from .store import setup_session
+from .jobs import add_scrub_job
+from .util import *
+
+# A scrub walks a store checking every stored file against its metadata record
+# and the authentication tags in the file, and lists what's on disk that no
+# record or upload accounts for. Scrubs run one after another on their own
+# worker and share one limit of SCRUB_RATE, so scrubbing next to uploads and
+# downloads doesn't starve them of disk bandwidth however many stores are due.
+# Nothing is repaired or removed, the report is kept encrypted in the store
+# until the next.
+
+# Files of the store itself, everything else at the top level is a legacy stored file
+STORE_FILES = ('metadata', 'metadata.journal', 'metadata.lock', 'keyinfo', 'scrub', 'scrub.lock')
+STORE_DIRS = ('decrypted', 'blobs')
+# Left behind by interrupted uploads, compressions and metadata writes, or plaintext
+# from before uploads were encrypted as they arrive. Younger ones may still be in use.
+LEFTOVER_SUFFIXES = ('.part', '.compress', '.tmp', '.unencrypted')
+LEFTOVER_AGE = 60 * 60 # 1 hour
+CHECK_INTERVAL = 60 * 10 # 10 minutes
+
+bp = Blueprint('scrub', __name__, url_prefix='/api/store/scrub')
+
+class RateLimit:
+    def __init__(self, rate):
+        # rate in bytes per second, None for no limit
+        self.rate = rate
+        self.next = time.monotonic()
+        self.lock = Lock()
+
+    def consume(self, nbytes):
+        # time spent idle isn't saved up for a burst
+        if not self.rate:
+            return
+        with self.lock:
+            now = time.monotonic()
+            self.next = max(self.next, now) + nbytes / self.rate
+            ahead = self.next - now
+        if ahead > 0:
+            time.sleep(ahead)
+
+rate_limit = RateLimit(None)
+
+def init_rate_limit(rate):
+    rate_limit.rate = rate
+
+def _check_record(file_encrypter, path, f_meta, progress):
+    # Returns a list of problems with the stored file at path, and whether it carries tags
+    problems = []
+    if 'stored_size' in f_meta and f_meta['stored_size'] != os.path.getsize(path):
+        problems.append('stored size {} does not match record {}'.format(os.path.getsize(path), f_meta['stored_size']))
+    try:
+        header = file_encrypter.verify_file(path, progress, f_meta.get('authenticated', False))
+    except IntegrityError as e:
+        return problems + [str(e)], True
+    if 'size' in f_meta and header.original_size != f_meta['size']:
+        problems.append('size {} does not match record {}'.format(header.original_size, f_meta['size']))
+    if f_meta.get('codec', None) != header.codec:
+        problems.append('codec {} does not match record {}'.format(header.codec, f_meta.get('codec', None)))
+    return problems, header.version == FORMAT_CTR_AUTH
+
+def _is_leftover(path, name, now):
+    if not name.endswith(LEFTOVER_SUFFIXES):
+        return False
+    try:
+        return now - os.path.getmtime(path) >= LEFTOVER_AGE
+    except FileNotFoundError:
+        return False
+
+def _list_unaccounted(session, metadata):
+    # must hold metadata_lock, returns orphaned stored files and leftovers relative to the store
+    store_path = get_filepath(session['name'], '')
+    now = time.time()
+    orphans, leftovers = [], []
+    for name in sorted(os.listdir(store_path)):
+        path = os.path.join(store_path, name)
+        if name in STORE_FILES or name in STORE_DIRS:
+            continue
+        if _is_leftover(path, name, now):
+            leftovers.append(name)
+        elif not name.endswith(LEFTOVER_SUFFIXES):
+            f_meta = metadata['files'].get(name, None)
+            if f_meta is None or f_meta.get('blob', None):
+                orphans.append(name)
+    blob_path = os.path.join(store_path, 'blobs')
+    if os.path.isdir(blob_path):
+        for name in sorted(os.listdir(blob_path)):
+            path = os.path.join(blob_path, name)
+            if _is_leftover(path, name, now):
+                leftovers.append('blobs/' + name)
+            elif not name.endswith(LEFTOVER_SUFFIXES) and not get_blob_refs(session['tag_index'], name):
+                orphans.append('blobs/' + name)
+    return orphans, leftovers
+
+def scrub_store(session, job):
+    # Returns the report, or None if another scrub of the store is running
+    lock_fd = os.open(get_filepath(session['name'], 'scrub.lock'), os.O_RDWR | os.O_CREAT, 0o600)
+    try:
+        try:
+            fcntl.flock(lock_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            logging.info('store {} is already being scrubbed'.format(session['name']))
+            return None
+        return _scrub(session, job)
+    finally:
+        os.close(lock_fd)
+
+def _scrub(session, job):
+    start = time.time()
+    file_encrypter = session['file_encrypter']
+    metadata = load_metadata(session)
+    # records sharing a blob are checked against one read of it, records whose
+    # file was never uploaded have nothing stored to check. Records from before
+    # sizes were recorded only show they were uploaded by their stored file.
+    stored = {}
+    not_uploaded = []
+    with session['metadata_lock']:
+        for file_id, f_meta in metadata['files'].items():
+            path = get_stored_filepath(session['name'], f_meta)
+            if 'size' not in f_meta and not f_meta.get('blob', None) and not os.path.exists(path):
+                not_uploaded.append(file_id)
+                continue
+            stored.setdefault(path, []).append(dict(f_meta))
+    sizes = {}
+    for path in stored:
+        try:
+            sizes[path] = os.path.getsize(path)
+        except FileNotFoundError:
+            sizes[path] = 0
+    total = sum(sizes.values())
+    done = 0
+    def progress(nbytes):
+        nonlocal done
+        rate_limit.consume(nbytes)
+        done += nbytes
+        job.update_progress(done, total)
+
+    report = {
+        'start_time': start
+        , 'files': len(metadata['files'])
+        , 'bytes': 0
+        , 'corrupt': []
+        , 'missing': []
+        , 'unauthenticated': []
+        , 'not_uploaded': not_uploaded
+    }
+    for path, records in stored.items():
+        try:
+            problems, authenticated = _check_record(file_encrypter, path, records[0], progress)
+            # a blob's records only differ in what they don't share with it
+            for f_meta in records[1:]:
+                if f_meta.get('size', None) != records[0].get('size', None):
+                    problems.append('record {} size {} does not match blob'.format(f_meta['id'], f_meta.get('size', None)))
+        except FileNotFoundError:
+            # may have been deleted or replaced since the records were read
+            with session['metadata_lock']:
+                current = [f_meta['id'] for f_meta in records
+                           if f_meta['id'] in metadata['files']
+                           and get_stored_filepath(session['name'], metadata['files'][f_meta['id']]) == path]
+            report['missing'].extend(current)
+            continue
+        if problems:
+            # a compression or re-upload may have replaced the file since, checked
+            # again against the current records with the file held in place
+            with session['metadata_lock']:
+                records = [dict(metadata['files'][f_meta['id']]) for f_meta in records
+                           if f_meta['id'] in metadata['files']
+                           and get_stored_filepath(session['name'], metadata['files'][f_meta['id']]) == path]
+                if not records or not os.path.exists(path):
+                    continue
+                problems, authenticated = _check_record(file_encrypter, path, records[0], None)
+        report['bytes'] += sizes[path]
+        for f_meta in records:
+            if problems:
+                report['corrupt'].append({'id': f_meta['id'], 'errors': problems})
+            elif not authenticated:
+                report['unauthenticated'].append(f_meta['id'])
+
+    with session['metadata_lock']:
+        report['orphans'], report['leftovers'] = _list_unaccounted(session, metadata)
+    report['end_time'] = time.time()
+    logging.info('scrubbed {}: {} corrupt, {} missing, {} orphans, {} leftovers in {} seconds'.format(
+        session['name'], len(report['corrupt']), len(report['missing']), len(report['orphans']),
+        len(report['leftovers']), report['end_time'] - start))
+    return report
+
+def _save_report(session, report):
+    path = get_scrub_report_path(session['name'])
+    with open(path + '.tmp', 'wb') as f:
+        f.write(session['file_encrypter'].encrypt_record(json.dumps(report).encode('utf-8')))
+    os.replace(path + '.tmp', path)
+
+def read_report(session):
+    path = get_scrub_report_path(session['name'])
+    if not os.path.exists(path):
+        return None
+    with open(path, 'rb') as f:
+        return json.loads(session['file_encrypter'].decrypt_record(f.read()))
+
+def start_scrub(session):
+    return add_scrub_job(session, lambda job: scrub_store(session, job),
+                         lambda report: _save_report(session, report))
+
+@bp.route('', methods=['GET', 'POST'])
+def scrub_endpoint():
+    if request.method == 'POST':
+        request_data = request.get_json()
+        if not request_data or 'session_name' not in request_data:
+            raise MissingSessionName()
+        session = setup_session(request_data['session_name'])
+        job = start_scrub(session)
+        return job.to_dict(), 202
+    if request.method == 'GET':
+        if 'session_name' not in request.args:
+            raise MissingSessionName()
+        session = setup_session(request.args.get('session_name'))
+        report = read_report(session)
+        if report is None:
+            raise NoScrubReport()
+        return report, 200
+
+def create_scrub_timer(interval):
+    scrub_timer = Timer(min(interval, CHECK_INTERVAL), _scrub_stale_stores, args=(interval,))
+    scrub_timer.name = 'ScrubThread'
+    scrub_timer.daemon = True
+    scrub_timer.start()
+
+def _scrub_stale_stores(interval):
+    # queues a scrub for every logged in store whose last report is older than interval
+    with sessions_lock:
+        active = list(sessions.values())
+    for session in active:
+        if not os.path.exists(get_metadata_path(session)):
+            continue
+        try:
+            last = os.path.getmtime(get_scrub_report_path(session['name']))
+        except FileNotFoundError:
+            last = 0
+        if time.time() - last >= interval:
+            start_scrub(session)
+
+    create_scrub_timer(interval)
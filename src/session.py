@@ -2,14 +2,20 @@ import os
 import json
 import time
 import logging
-from threading import Lock, Timer
+import hmac
+import heapq
+import itertools
+from queue import Queue
+from threading import Lock, RLock, Timer, Thread, Condition
 from uuid import uuid4
-from multiprocessing import Process, Event
 
-from flask import Blueprint, request
+from flask import Blueprint, request, current_app, Response
 
-from .error import SessionNotInitialized, FileIsBeingEncrypted, FileIsBeingDecrypted, SessionExists
-from .encrypter import FileEncrypter
+from .error import SessionNotInitialized, SessionExists, InvalidPassword
+from .encrypter import FileEncrypter, new_keyinfo, legacy_keyinfo, derive_key, check_key, read_keyinfo
+from . import cache, metrics, state
+from .events import EventChannel, SharedEventChannel, stream_events, stream_shared_events, acquire_stream
+from .metadata import flush_metadata, invalidate_metadata, is_metadata_dirty, SharedMetadataLock
 from .util import *
 
 MAX_SESSION_TIME = 60 * 60 # 1 hour
@@ -20,66 +26,129 @@ bp = Blueprint('session', __name__, url_prefix='/api/session')
 sessions = {}
 sessions_lock = Lock()
 
+# Sessions expire MAX_SESSION_TIME after their last login or refresh. Each one has
+# an entry in a heap ordered by the deadline it had when the entry was pushed, a
+# refresh only moves creation_time and the entry is pushed again with the new
+# deadline when it surfaces. The expiry thread sleeps until the front entry is
+# due and removes expired sessions from the map under sessions_lock, tearing them
+# down and deleting their decrypted copies is left to the cleanup thread.
+session_deadlines = []
+deadline_counter = itertools.count()
+expiry_cond = Condition(sessions_lock)
+cleanup_queue = Queue()
+expiry_thread = None
+
+def _file_size(path):
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return 0
+
+def _session_gauge():
+    with sessions_lock:
+        return [({}, len(sessions))]
+
+# Store totals only, session names are the stores' credentials and can't be labels
+def _metadata_bytes_gauge():
+    with sessions_lock:
+        active = list(sessions.values())
+    return [({}, sum(_file_size(get_metadata_path(session)) + _file_size(get_journal_path(session))
+                     for session in active))]
+
+def _metadata_files_gauge():
+    with sessions_lock:
+        active = list(sessions.values())
+    return [({}, sum(len(session['metadata']['files'])
+                     for session in active if session['metadata'] is not None))]
+
+metrics.register(metrics.Gauge('efs_active_sessions', 'Logged in sessions', _session_gauge))
+metrics.register(metrics.Gauge('efs_metadata_bytes', 'Encrypted metadata snapshot plus journal size of logged in stores', _metadata_bytes_gauge))
+metrics.register(metrics.Gauge('efs_metadata_files', 'Files in the loaded metadata of logged in stores', _metadata_files_gauge))
+
+def _deadline(session):
+    return session['creation_time'] + MAX_SESSION_TIME
+
+def _schedule_expiry(session):
+    # must hold sessions_lock
+    deadline = _deadline(session)
+    heapq.heappush(session_deadlines, (deadline, next(deadline_counter), session))
+    if session_deadlines[0][2] is session:
+        expiry_cond.notify()
+
 def get_session(session_name):
     with sessions_lock:
         session = sessions.get(session_name, None)
-        if not session:
-            raise SessionNotInitialized
-        return session
+    if state.backend:
+        session = _sync_session(session_name, session)
+    if not session:
+        raise SessionNotInitialized
+    return session
 
-def get_encrypt_job(session, file_id):
-    with session['lock']:
-        return session['encrypt_jobs'].get(file_id, None)
+def _new_session(session_name, key, keyinfo, creation_time):
+    shared = state.backend is not None
+    session = {
+        'file_encrypter': FileEncrypter(key, current_app.config['ENCRYPTION_CHUNK_SIZE'], current_app.config['ENCRYPTION_THREADS'])
+        , 'name': session_name
+        , 'creation_time': creation_time
+        , 'decrypt_jobs': {}
+        , 'uploads': {}
+        , 'scrub_job': None
+        , 'events': SharedEventChannel(session_name) if shared else EventChannel()
+        , 'lock': Lock()
+        , 'keyinfo': keyinfo
+        , 'metadata': None
+        , 'tag_index': None
+        , 'store_stats': None
+        , 'metadata_seq': 0
+        , 'metadata_journal_ops': 0
+        , 'metadata_pending_ops': []
+        , 'metadata_journal_offset': 0
+        , 'metadata_snapshot_stat': None
+        , 'metadata_flush_lock': Lock()
+        # other workers append to a shared store's journal, so every op is written through
+        , 'metadata_shared': shared
+        , 'metadata_write_back': current_app.config['METADATA_WRITE_BACK'] and not shared
+        , 'metadata_compact_ops': current_app.config['METADATA_COMPACT_OPS']
+        , 'metadata_format': current_app.config['METADATA_FORMAT']
+        , 'deduplicate': current_app.config['DEDUPLICATION']
+    }
+    session['metadata_lock'] = SharedMetadataLock(session) if shared else RLock()
+    return session
 
-def add_encrypt_job(session, file_id, input_path, output_path):
-    encrypt_job = get_encrypt_job(session, file_id)
-    with session['lock']:
-        if encrypt_job:
-            encrypt_job[1].join()
-        event = Event()
-        def encrypt_file_wrapper():
-            try:
-                session['file_encrypter'].encrypt_file(input_path, output_path)
-            except Exception as e:
-                logging.error('failed to encrypt')
-                logging.error(e)
-            finally:
-                event.set()
-                os.remove(input_path)
-        encrypt_proc = Process(target=encrypt_file_wrapper)
-        encrypt_proc.start()
-        session['encrypt_jobs'][file_id] = (event, encrypt_proc)
-
-def get_decrypt_job(session, file_id):
-    with session['lock']:
-        return session['decrypt_jobs'].get(file_id, None)
+def _sync_session(session_name, session):
+    # Another worker may have logged the session in, refreshed, replaced or expired it
+    record = state.backend.get_session(session_name)
+    if record is None:
+        if session:
+            _drop_session(session_name, session)
+        return None
+    if session and hmac.compare_digest(session['file_encrypter'].key, record['key']):
+        session['creation_time'] = record['creation_time']
+        return session
+    new_session = _new_session(session_name, record['key'], record['keyinfo'], record['creation_time'])
+    with sessions_lock:
+        current = sessions.get(session_name, None)
+        if current is session:
+            sessions[session_name] = new_session
+            _schedule_expiry(new_session)
+        else:
+            new_session = current
+    if session and current is session:
+        session['events'].close()
+        session['metadata'] = None
+    return new_session
 
-def add_decrypt_job(session, file_id, input_path, output_path):
-    decrypt_job = get_decrypt_job(session, file_id)
-    with session['lock']:
-        if decrypt_job:
-            decrypt_job[1].join()
-        event = Event()
-        def decrypt_file_wrapper():
-            try:
-                session['file_encrypter'].decrypt_file(input_path, output_path)
-            except Exception as e:
-                logging.error('failed to decrypt')
-                logging.error(e)
-            finally:
-                event.set()
-        decrypt_proc = Process(target=decrypt_file_wrapper)
-        decrypt_proc.start()
-        session['decrypted'].add(output_path)
-        session['decrypt_jobs'][file_id] = (event, decrypt_proc)
-
-def check_file_locked(session, file_id):
-    encrypt_job = get_encrypt_job(session, file_id)
-    if encrypt_job and not encrypt_job[0].is_set():
-        raise FileIsBeingEncrypted
-    decrypt_job = get_decrypt_job(session, file_id)
-    if decrypt_job and not decrypt_job[0].is_set():
-        raise FileIsBeingDecrypted
+def _get_keyinfo(session_name, session):
+    keyinfo = read_keyinfo(get_keyinfo_path(session_name))
+    if keyinfo:
+        return keyinfo
+    if os.path.exists(get_filepath(session_name, 'metadata')):
+        return legacy_keyinfo()
+    if session:
+        # store not created yet, keep the salt the current session will create it with
+        return session['keyinfo']
+    config = current_app.config
+    return new_keyinfo(config['SCRYPT_N'], config['SCRYPT_R'], config['SCRYPT_P'])
 
 @bp.route('', methods=['POST'])
 def sessions_endpoint():
@@ -93,20 +162,22 @@ def sessions_endpoint():
             session = get_session(session_name)
         except:
             pass
-        if session and session['password'] == request_data['password']:
+        keyinfo = _get_keyinfo(session_name, session)
+        key = derive_key(request_data['password'], keyinfo)
+        if not check_key(key, keyinfo):
+            raise InvalidPassword()
+        if session and hmac.compare_digest(session['file_encrypter'].key, key):
             raise SessionExists
-        session = {
-            'file_encrypter': FileEncrypter(request_data['password'])
-            , 'name': session_name
-            , 'creation_time': time.time()
-            , 'encrypt_jobs': {}
-            , 'decrypt_jobs': {}
-            , 'decrypted': set()
-            , 'lock': Lock()
-            , 'password': request_data['password']
-        }
+        if session:
+            # the replaced session may still hold unwritten metadata
+            flush_metadata(session)
+            session['events'].close()
+        session = _new_session(session_name, key, keyinfo, time.time())
+        if state.backend:
+            state.backend.put_session(session_name, key, keyinfo, session['creation_time'])
         with sessions_lock:
             sessions[session_name] = session
+            _schedule_expiry(session)
         return {'status': 'success', 'session_name': session_name}, 201
 
 @bp.route('<session_name>/refresh', methods=['PUT'])
@@ -114,6 +185,8 @@ def session_refresh_endpoint(session_name):
     if request.method == 'PUT':
         session = get_session(session_name)
         session['creation_time'] = time.time()
+        if state.backend:
+            state.backend.touch_session(session_name, session['creation_time'])
         logging.info('Session Refreshed, Time Left: {}'.format((MAX_SESSION_TIME / 60) - (time.time() - session['creation_time'])))
         return { 'status': 'success' }, 200
 
@@ -136,27 +209,159 @@ def session_endpoint(session_name):
                 'reason': 'Session timed out'.format(session_name)
             }, 404
 
-def create_session_clear_timer():
-    session_clear_timer = Timer(CHECK_INTERVAL, _clear_invalid_sessions)
-    session_clear_timer.name = 'ClearSessionThread'
-    session_clear_timer.start()
+@bp.route('<session_name>/events', methods=['GET'])
+def session_events_endpoint(session_name):
+    if request.method == 'GET':
+        session = get_session(session_name)
+        last_event_id = request.headers.get('Last-Event-ID', request.args.get('last_event_id', None))
+        try:
+            last_event_id = int(last_event_id) if last_event_id is not None else None
+        except ValueError:
+            last_event_id = None
+        release = acquire_stream()
+        stream = stream_shared_events if state.backend else stream_events
+        response = Response(stream(session['events'], last_event_id), mimetype='text/event-stream')
+        response.call_on_close(release)
+        response.headers['Cache-Control'] = 'no-cache'
+        response.headers['X-Accel-Buffering'] = 'no'
+        return response
+
+def start_session_expiry():
+    global expiry_thread
+    with sessions_lock:
+        if expiry_thread is not None:
+            return
+        expiry_thread = Thread(target=_expire_sessions, name='SessionExpiryThread', daemon=True)
+        expiry_thread.start()
+    Thread(target=_clean_up_sessions, name='SessionCleanupThread', daemon=True).start()
 
 def _clear_decrypted(session):
     dir_path = get_decrypted_folder(session['name'])
+    if not os.path.isdir(dir_path):
+        return
     for f in os.listdir(dir_path):
         os.remove(os.path.join(dir_path, f))
 
-def _clear_invalid_sessions():
-    global sessions
-    logging.info('clearing invalid sessions')
+def _remove_session(session_name, session):
+    # must hold sessions_lock, the session's heap entry is skipped once it surfaces
+    if sessions.get(session_name, None) is not session:
+        return False
+    del sessions[session_name]
+    return True
+
+def _drop_session(session_name, session):
     with sessions_lock:
-        to_delete = []
-        for k, session in sessions.items():
-            if time.time() - session['creation_time'] >= MAX_SESSION_TIME:
-                to_delete.append(k)
-        for k in to_delete:
-            _clear_decrypted(sessions[k])
-            del sessions[k]
-    logging.info('cleared {} sessions'.format(len(to_delete)))
-
-    create_session_clear_timer()
+        _remove_session(session_name, session)
+    _close_session(session)
+
+def _close_session(session):
+    with session['lock']:
+        session_jobs = list(session['decrypt_jobs'].values())
+        if session['scrub_job']:
+            session_jobs.append(session['scrub_job'])
+    for job in session_jobs:
+        job.cancelled.set()
+    try:
+        invalidate_metadata(session)
+    except Exception:
+        logging.error('dropping unflushed metadata for session {}'.format(session['name']))
+    session['events'].close()
+    cleanup_queue.put(session['name'])
+
+def _clean_up_sessions():
+    while True:
+        session_name = cleanup_queue.get()
+        with sessions_lock:
+            # logged in again since, the new session keeps using the decrypted copies
+            if session_name in sessions:
+                continue
+        try:
+            cache.decrypted_cache.clear_session(session_name)
+            _clear_decrypted({'name': session_name})
+        except Exception as e:
+            logging.error('failed to clear decrypted files of session {}'.format(session_name))
+            logging.error(e)
+
+def _pop_due_sessions(now):
+    # must hold sessions_lock, returns the sessions past their deadline
+    due = []
+    while session_deadlines and session_deadlines[0][0] <= now:
+        _, _, session = heapq.heappop(session_deadlines)
+        if sessions.get(session['name'], None) is not session:
+            continue
+        if _deadline(session) > now:
+            # refreshed since the entry was pushed
+            heapq.heappush(session_deadlines, (_deadline(session), next(deadline_counter), session))
+            continue
+        due.append(session)
+    return due
+
+def _expire_shared(due):
+    # A refresh on another worker only reaches the shared record, due sessions
+    # still alive there are rescheduled. Returns the ones that expired.
+    try:
+        expired = state.backend.expire_sessions(time.time() - MAX_SESSION_TIME)
+    except Exception as e:
+        logging.error('failed to expire shared sessions')
+        logging.error(e)
+        return due
+    # stores of sessions this worker never loaded still have decrypted copies to remove
+    for session_name in expired:
+        cleanup_queue.put(session_name)
+    alive, gone = [], []
+    for session in due:
+        record = None if session['name'] in expired else state.backend.get_session(session['name'])
+        if record is None:
+            gone.append(session)
+        else:
+            session['creation_time'] = record['creation_time']
+            alive.append(session)
+    with sessions_lock:
+        for session in alive:
+            if sessions.get(session['name'], None) is session:
+                _schedule_expiry(session)
+    return gone
+
+def _expire_sessions():
+    next_sweep = time.time() + CHECK_INTERVAL
+    while True:
+        with expiry_cond:
+            while True:
+                now = time.time()
+                due = _pop_due_sessions(now)
+                if due or (state.backend and now >= next_sweep):
+                    break
+                timeout = session_deadlines[0][0] - now if session_deadlines else None
+                if state.backend:
+                    timeout = min(timeout, next_sweep - now) if timeout is not None else next_sweep - now
+                expiry_cond.wait(timeout)
+        if state.backend:
+            next_sweep = time.time() + CHECK_INTERVAL
+            due = _expire_shared(due)
+        expired = []
+        with sessions_lock:
+            for session in due:
+                if _remove_session(session['name'], session):
+                    expired.append(session)
+        for session in expired:
+            _close_session(session)
+        if expired:
+            logging.info('expired {} sessions'.format(len(expired)))
+
+def create_metadata_flush_timer(interval):
+    metadata_flush_timer = Timer(interval, _flush_dirty_metadata, args=(interval,))
+    metadata_flush_timer.name = 'MetadataFlushThread'
+    metadata_flush_timer.start()
+
+def _flush_dirty_metadata(interval):
+    with sessions_lock:
+        dirty_sessions = [s for s in sessions.values() if is_metadata_dirty(s)]
+    for session in dirty_sessions:
+        try:
+            flush_metadata(session)
+        except Exception:
+            pass
+    if dirty_sessions:
+        logging.info('flushed metadata for {} sessions'.format(len(dirty_sessions)))
+
+    create_metadata_flush_timer(interval)
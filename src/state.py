@@ -0,0 +1,348 @@
+import os
+import json
+import time
+import sqlite3
+import logging
+import threading
+from hashlib import sha256
+
+from .encrypter import FileEncrypter
+
+# State that has to be visible to every worker process when the app runs under
+# a multi-process server. With no backend (STATE_BACKEND = 'memory') sessions,
+# jobs and uploads only live in the dicts of the process that created them.
+# The SQLite backend keeps the session records, job status, job events and upload
+# progress in one local database every worker opens, each worker still builds its
+# own FileEncrypter, locks and metadata cache from the session record.
+STATE_BACKENDS = ('memory', 'sqlite')
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS sessions (
+    name TEXT PRIMARY KEY,
+    key BLOB NOT NULL,
+    keyinfo TEXT NOT NULL,
+    creation_time REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    session_name TEXT NOT NULL,
+    file_id TEXT,
+    kind TEXT NOT NULL,
+    status TEXT NOT NULL,
+    pid INTEGER NOT NULL,
+    cancel_requested INTEGER NOT NULL DEFAULT 0,
+    end_time REAL,
+    job TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS jobs_session ON jobs (session_name, file_id);
+CREATE TABLE IF NOT EXISTS events (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    session_name TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    time REAL NOT NULL,
+    data TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS events_session ON events (session_name, id);
+CREATE TABLE IF NOT EXISTS uploads (
+    session_name TEXT NOT NULL,
+    file_id TEXT NOT NULL,
+    part_path TEXT NOT NULL,
+    nonce BLOB NOT NULL,
+    total_chunks INTEGER NOT NULL,
+    file_size INTEGER NOT NULL,
+    received BLOB NOT NULL,
+    received_count INTEGER NOT NULL,
+    end_offset INTEGER NOT NULL,
+    finalizing INTEGER NOT NULL,
+    PRIMARY KEY (session_name, file_id)
+);
+CREATE TABLE IF NOT EXISTS upload_blocks (
+    session_name TEXT NOT NULL,
+    file_id TEXT NOT NULL,
+    nonce BLOB NOT NULL,
+    block INTEGER NOT NULL,
+    length INTEGER NOT NULL,
+    digest BLOB NOT NULL,
+    PRIMARY KEY (session_name, file_id, block)
+);
+CREATE TABLE IF NOT EXISTS upload_tags (
+    session_name TEXT NOT NULL,
+    file_id TEXT NOT NULL,
+    nonce BLOB NOT NULL,
+    chunk INTEGER NOT NULL,
+    length INTEGER NOT NULL,
+    tag BLOB NOT NULL,
+    PRIMARY KEY (session_name, file_id, chunk)
+);
+'''
+
+ACTIVE_JOB_STATUSES = ('queued', 'running')
+
+backend = None
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+class SQLiteStateBackend:
+    def __init__(self, path, secret):
+        self.path = path
+        # session keys are stored wrapped with a key derived from SESSION_SECRET
+        self.wrapper = FileEncrypter(sha256(secret.encode('utf-8')).digest())
+        self.local = threading.local()
+        if not os.path.exists(path):
+            os.close(os.open(path, os.O_RDWR | os.O_CREAT, 0o600))
+        self._db().executescript(SCHEMA)
+
+    def _db(self):
+        # one connection per thread, sqlite3 connections can't be shared between them
+        db = getattr(self.local, 'db', None)
+        if db is None:
+            db = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            db.row_factory = sqlite3.Row
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute('PRAGMA synchronous=NORMAL')
+            self.local.db = db
+        return db
+
+    def _transaction(self, fn, *args):
+        # BEGIN IMMEDIATE takes the write lock up front so read-modify-write is atomic across workers
+        db = self._db()
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            result = fn(db, *args)
+        except Exception:
+            db.execute('ROLLBACK')
+            raise
+        db.execute('COMMIT')
+        return result
+
+    def put_session(self, name, key, keyinfo, creation_time):
+        self._db().execute(
+            'INSERT OR REPLACE INTO sessions (name, key, keyinfo, creation_time) VALUES (?, ?, ?, ?)',
+            (name, self.wrapper.encrypt_record(key), json.dumps(keyinfo), creation_time))
+
+    def get_session(self, name):
+        row = self._db().execute('SELECT * FROM sessions WHERE name = ?', (name,)).fetchone()
+        if row is None:
+            return None
+        try:
+            key = self.wrapper.decrypt_record(row['key'])
+        except ValueError:
+            # written under a different SESSION_SECRET, e.g. before a restart
+            self.delete_session(name)
+            return None
+        return {
+            'name': name,
+            'key': key,
+            'keyinfo': json.loads(row['keyinfo']),
+            'creation_time': row['creation_time'],
+        }
+
+    def has_session(self, name):
+        return self._db().execute('SELECT 1 FROM sessions WHERE name = ?', (name,)).fetchone() is not None
+
+    def touch_session(self, name, creation_time):
+        self._db().execute('UPDATE sessions SET creation_time = ? WHERE name = ?', (creation_time, name))
+
+    def delete_session(self, name):
+        def delete(db):
+            db.execute('DELETE FROM sessions WHERE name = ?', (name,))
+            db.execute('DELETE FROM jobs WHERE session_name = ?', (name,))
+            db.execute('DELETE FROM events WHERE session_name = ?', (name,))
+            db.execute('DELETE FROM uploads WHERE session_name = ?', (name,))
+            db.execute('DELETE FROM upload_blocks WHERE session_name = ?', (name,))
+            db.execute('DELETE FROM upload_tags WHERE session_name = ?', (name,))
+        self._transaction(delete)
+
+    def expire_sessions(self, cutoff):
+        def expire(db):
+            names = [row['name'] for row in db.execute(
+                'SELECT name FROM sessions WHERE creation_time < ?', (cutoff,))]
+            for name in names:
+                db.execute('DELETE FROM sessions WHERE name = ?', (name,))
+                db.execute('DELETE FROM jobs WHERE session_name = ?', (name,))
+                db.execute('DELETE FROM events WHERE session_name = ?', (name,))
+                db.execute('DELETE FROM uploads WHERE session_name = ?', (name,))
+                db.execute('DELETE FROM upload_blocks WHERE session_name = ?', (name,))
+                db.execute('DELETE FROM upload_tags WHERE session_name = ?', (name,))
+            db.execute('DELETE FROM jobs WHERE end_time < ?', (cutoff,))
+            db.execute('DELETE FROM events WHERE time < ?', (cutoff,))
+            return names
+        return self._transaction(expire)
+
+    def put_job(self, job):
+        self._db().execute(
+            'INSERT INTO jobs (id, session_name, file_id, kind, status, pid, end_time, job) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?, ?) '
+            'ON CONFLICT (id) DO UPDATE SET status = excluded.status, end_time = excluded.end_time, job = excluded.job',
+            (job['id'], job['session_name'], job['file_id'], job['kind'], job['status'],
+             os.getpid(), job['end_time'], json.dumps(job)))
+
+    def _job(self, row):
+        job = json.loads(row['job'])
+        if job['status'] in ACTIVE_JOB_STATUSES and not _pid_alive(row['pid']):
+            # the worker that ran it is gone
+            job['status'] = 'failed'
+        return job
+
+    def get_job(self, job_id):
+        row = self._db().execute('SELECT * FROM jobs WHERE id = ?', (job_id,)).fetchone()
+        return self._job(row) if row else None
+
+    def list_jobs(self, session_name):
+        rows = self._db().execute(
+            'SELECT * FROM jobs WHERE session_name = ? AND status IN (?, ?)',
+            (session_name,) + ACTIVE_JOB_STATUSES)
+        return [self._job(row) for row in rows]
+
+    def get_active_job(self, session_name, file_id, kind):
+        for row in self._db().execute(
+                'SELECT * FROM jobs WHERE session_name = ? AND file_id = ? AND kind = ? AND status IN (?, ?)',
+                (session_name, file_id, kind) + ACTIVE_JOB_STATUSES):
+            job = self._job(row)
+            if job['status'] in ACTIVE_JOB_STATUSES:
+                return job
+        return None
+
+    def put_event(self, session_name, kind, data):
+        self._db().execute(
+            'INSERT INTO events (session_name, kind, time, data) VALUES (?, ?, ?, ?)',
+            (session_name, kind, time.time(), json.dumps(data)))
+
+    def get_events(self, session_name, after_id):
+        # Returns the (id, kind, data) events of the session after after_id, or
+        # those after the latest one when after_id is None
+        db = self._db()
+        if after_id is None:
+            row = db.execute('SELECT MAX(id) FROM events WHERE session_name = ?', (session_name,)).fetchone()
+            return [], row[0] or 0
+        events = [(row['id'], row['kind'], json.loads(row['data'])) for row in db.execute(
+            'SELECT id, kind, data FROM events WHERE session_name = ? AND id > ? ORDER BY id',
+            (session_name, after_id))]
+        return events, events[-1][0] if events else after_id
+
+    def cancel_job(self, job_id):
+        self._db().execute('UPDATE jobs SET cancel_requested = 1 WHERE id = ?', (job_id,))
+
+    def is_job_cancel_requested(self, job_id):
+        row = self._db().execute('SELECT cancel_requested FROM jobs WHERE id = ?', (job_id,)).fetchone()
+        return bool(row and row['cancel_requested'])
+
+    def _upload(self, row):
+        if row is None:
+            return None
+        return {
+            'session_name': row['session_name'],
+            'file_id': row['file_id'],
+            'part_path': row['part_path'],
+            'nonce': row['nonce'],
+            'total_chunks': row['total_chunks'],
+            'file_size': row['file_size'],
+            'received': bytearray(row['received']),
+            'received_count': row['received_count'],
+            'end': row['end_offset'],
+            'finalizing': bool(row['finalizing']),
+        }
+
+    def _get_upload(self, db, session_name, file_id):
+        return self._upload(db.execute(
+            'SELECT * FROM uploads WHERE session_name = ? AND file_id = ?', (session_name, file_id)).fetchone())
+
+    def get_upload(self, session_name, file_id):
+        return self._get_upload(self._db(), session_name, file_id)
+
+    def start_upload(self, session_name, file_id, part_path, total_chunks, file_size, create):
+        # create makes the .part file and returns its nonce, it runs inside the
+        # transaction so only one worker creates it
+        def start(db):
+            upload = self._get_upload(db, session_name, file_id)
+            if upload is None:
+                db.execute('DELETE FROM upload_blocks WHERE session_name = ? AND file_id = ?', (session_name, file_id))
+                db.execute('DELETE FROM upload_tags WHERE session_name = ? AND file_id = ?', (session_name, file_id))
+                db.execute(
+                    'INSERT OR REPLACE INTO uploads VALUES (?, ?, ?, ?, ?, ?, ?, 0, 0, 0)',
+                    (session_name, file_id, part_path, create(), total_chunks, file_size,
+                     bytes((total_chunks + 7) // 8)))
+                upload = self._get_upload(db, session_name, file_id)
+            return upload
+        return self._transaction(start)
+
+    def mark_chunk_received(self, upload, chunk, end):
+        # Returns True for exactly one caller, once every chunk has arrived
+        def mark(db):
+            current = self._get_upload(db, upload['session_name'], upload['file_id'])
+            if current is None or current['nonce'] != upload['nonce']:
+                return False
+            received = current['received']
+            if not received[chunk // 8] & (1 << (chunk % 8)):
+                received[chunk // 8] |= 1 << (chunk % 8)
+                current['received_count'] += 1
+            current['end'] = max(current['end'], end)
+            complete = current['received_count'] >= current['total_chunks'] and not current['finalizing']
+            db.execute(
+                'UPDATE uploads SET received = ?, received_count = ?, end_offset = ?, finalizing = ? '
+                'WHERE session_name = ? AND file_id = ?',
+                (bytes(received), current['received_count'], current['end'],
+                 int(current['finalizing'] or complete), upload['session_name'], upload['file_id']))
+            upload.update(current, finalizing=current['finalizing'] or complete)
+            return complete
+        return self._transaction(mark)
+
+    def reset_upload_finalizing(self, upload):
+        self._db().execute(
+            'UPDATE uploads SET finalizing = 0 WHERE session_name = ? AND file_id = ? AND nonce = ?',
+            (upload['session_name'], upload['file_id'], upload['nonce']))
+
+    def put_upload_blocks(self, upload, blocks):
+        self._db().executemany(
+            'INSERT OR REPLACE INTO upload_blocks VALUES (?, ?, ?, ?, ?, ?)',
+            [(upload['session_name'], upload['file_id'], upload['nonce'], block, length, digest)
+             for block, (length, digest) in blocks.items()])
+
+    def get_upload_blocks(self, upload):
+        rows = self._db().execute(
+            'SELECT block, length, digest FROM upload_blocks WHERE session_name = ? AND file_id = ? AND nonce = ?',
+            (upload['session_name'], upload['file_id'], upload['nonce']))
+        return {row['block']: (row['length'], row['digest']) for row in rows}
+
+    def put_upload_tags(self, upload, tags):
+        self._db().executemany(
+            'INSERT OR REPLACE INTO upload_tags VALUES (?, ?, ?, ?, ?, ?)',
+            [(upload['session_name'], upload['file_id'], upload['nonce'], chunk, length, tag)
+             for chunk, (length, tag) in tags.items()])
+
+    def get_upload_tags(self, upload):
+        rows = self._db().execute(
+            'SELECT chunk, length, tag FROM upload_tags WHERE session_name = ? AND file_id = ? AND nonce = ?',
+            (upload['session_name'], upload['file_id'], upload['nonce']))
+        return {row['chunk']: (row['length'], row['tag']) for row in rows}
+
+    def end_upload(self, upload):
+        def end(db):
+            db.execute(
+                'DELETE FROM uploads WHERE session_name = ? AND file_id = ? AND nonce = ?',
+                (upload['session_name'], upload['file_id'], upload['nonce']))
+            db.execute(
+                'DELETE FROM upload_blocks WHERE session_name = ? AND file_id = ? AND nonce = ?',
+                (upload['session_name'], upload['file_id'], upload['nonce']))
+            db.execute(
+                'DELETE FROM upload_tags WHERE session_name = ? AND file_id = ? AND nonce = ?',
+                (upload['session_name'], upload['file_id'], upload['nonce']))
+        self._transaction(end)
+
+def init_backend(kind, path, secret):
+    global backend
+    if kind not in STATE_BACKENDS:
+        raise ValueError('unknown STATE_BACKEND {}'.format(kind))
+    if kind == 'sqlite' and backend is None:
+        if not secret:
+            raise ValueError('STATE_BACKEND sqlite needs SESSION_SECRET shared by every worker')
+        backend = SQLiteStateBackend(path, secret)
+        logging.info('sharing session state through {}'.format(path))
+    return backend
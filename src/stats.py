@@ -0,0 +1,108 @@
+import bisect
+
+# Usage totals of a store, built from the cached metadata on the first stats
+# request and kept next to the tag index on the session from then on. Every op
+# applied to the metadata takes the records it touches out of the totals before
+# it runs and adds them back after, so later requests only read these instead of
+# walking the files. Files sharing a blob count its stored size once in the
+# store total, the per filetype and per tag totals count it for each record.
+
+def _access_time(f_meta):
+    return f_meta.get('access_time', None) or f_meta.get('upload_time', 0)
+
+def _add(totals, key, f_meta, sign):
+    entry = totals.setdefault(key, {'files': 0, 'size': 0, 'stored_size': 0})
+    entry['files'] += sign
+    entry['size'] += sign * f_meta.get('size', 0)
+    entry['stored_size'] += sign * f_meta.get('stored_size', 0)
+    if entry['files'] == 0:
+        del totals[key]
+
+class StoreStats:
+    def __init__(self, files=()):
+        self.files = 0
+        self.size = 0
+        self.stored_size = 0
+        self.uploaded = 0
+        # blob -> [records referencing it, stored size counted for it]
+        self.blobs = {}
+        self.filetypes = {}
+        self.tags = {}
+        # (size, id) and (access time, id) of uploaded files, ascending
+        self.by_size = []
+        self.by_access = []
+        for f_meta in files:
+            self._update(f_meta, 1)
+            if 'size' in f_meta:
+                self.by_size.append((f_meta['size'], f_meta['id']))
+                self.by_access.append((_access_time(f_meta), f_meta['id']))
+        self.by_size.sort()
+        self.by_access.sort()
+
+    def add(self, f_meta):
+        if f_meta is None:
+            return
+        self._update(f_meta, 1)
+        if 'size' in f_meta:
+            bisect.insort(self.by_size, (f_meta['size'], f_meta['id']))
+            bisect.insort(self.by_access, (_access_time(f_meta), f_meta['id']))
+
+    def remove(self, f_meta):
+        if f_meta is None:
+            return
+        self._update(f_meta, -1)
+        if 'size' in f_meta:
+            for ordered, key in ((self.by_size, (f_meta['size'], f_meta['id'])),
+                                 (self.by_access, (_access_time(f_meta), f_meta['id']))):
+                i = bisect.bisect_left(ordered, key)
+                if i < len(ordered) and ordered[i] == key:
+                    del ordered[i]
+
+    def _update(self, f_meta, sign):
+        self.files += sign
+        self.size += sign * f_meta.get('size', 0)
+        if 'size' in f_meta:
+            self.uploaded += sign
+        stored_size = f_meta.get('stored_size', 0)
+        blob = f_meta.get('blob', None)
+        if not blob:
+            self.stored_size += sign * stored_size
+        elif sign > 0:
+            entry = self.blobs.setdefault(blob, [0, 0])
+            entry[0] += 1
+            # records of a blob only disagree while a compression is being recorded
+            self.stored_size += stored_size - entry[1]
+            entry[1] = stored_size
+        elif blob in self.blobs:
+            entry = self.blobs[blob]
+            entry[0] -= 1
+            if entry[0] == 0:
+                self.stored_size -= entry[1]
+                del self.blobs[blob]
+        _add(self.filetypes, f_meta.get('filetype', None), f_meta, sign)
+        for tag in set(f_meta.get('tags', ())):
+            _add(self.tags, tag, f_meta, sign)
+
+    def to_dict(self, files, limit):
+        def summary(file_id):
+            f_meta = files[file_id]
+            return {
+                'id': file_id,
+                'name': f_meta.get('name', None),
+                'filetype': f_meta.get('filetype', None),
+                'size': f_meta['size'],
+                'stored_size': f_meta.get('stored_size', None),
+                'upload_time': f_meta.get('upload_time', None),
+                'access_time': f_meta.get('access_time', None),
+            }
+        return {
+            'files': self.files,
+            'uploaded_files': self.uploaded,
+            'size': self.size,
+            'stored_size': self.stored_size,
+            'blobs': len(self.blobs),
+            'filetypes': {str(filetype): dict(entry) for filetype, entry in self.filetypes.items()},
+            'tags': {tag: dict(entry) for tag, entry in self.tags.items()},
+            'largest': [summary(file_id) for _, file_id in reversed(self.by_size[-limit:])] if limit else [],
+            'least_recently_used': [summary(file_id) for _, file_id in self.by_access[:limit]],
+        }
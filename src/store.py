@@ -1,21 +1,48 @@
 import json
 import time
 import os
-import tempfile
+import mimetypes
+import base64
+import bisect
 import logging
+import itertools
+from urllib.parse import quote
 
 from uuid import uuid4
 
-from flask import Blueprint, request, send_file, jsonify
+from flask import Blueprint, request, send_file, jsonify, current_app, Response
+from werkzeug.datastructures import ContentRange
+from werkzeug.exceptions import HTTPException, RequestedRangeNotSatisfiable, RequestEntityTooLarge
 
 from .util import *
-from .session import get_session, check_file_locked, get_encrypt_job, add_encrypt_job, \
-                     add_decrypt_job, get_decrypt_job
+from .encrypter import get_key_check, write_keyinfo, IntegrityError, FORMAT_CTR_AUTH
+from .metadata import BASE_METADATA, encrypt_metadata, load_metadata, save_metadata, \
+                      record_metadata_ops, filter_files, get_tag_counts, apply_op_with_undo, \
+                      undo_op, record_applied_ops, get_file_metadata, get_store_stats, get_blob_refs
+from .session import get_session
+from .upload import start_upload, write_chunk, mark_chunk_received, end_upload, get_upload, \
+                    get_upload_status, commit_upload, reset_finalizing, get_content_id, finish_part, \
+                    needs_read_back
+from .blobs import store_blob, release_blob
+from .multipart import MultipartReader
+from . import cache, state, compression
+from .jobs import check_file_locked, add_decrypt_job, add_compress_job, add_finish_job
 from .error import MissingSessionName, NoJSONMetadata, FileStoreDNE, \
                    FileStoreExists, FailedToWriteMetadata, InvalidFileID, NoFile, \
-                   InvalidTag, FileUploadError, FileIsBeingDecrypted
-
-BASE_METADATA = {'files': {}, 'tags': []}
+                   InvalidTag, FileUploadError, FileIsBeingDecrypted, InvalidQuery, NoUpload, \
+                   InvalidBatchOp, FileCorrupted, MetadataAfterFile
+
+SORT_KEYS = ('name', 'filetype', 'size', 'upload_time', 'access_time')
+DEFAULT_PAGE_SIZE = 100
+DEFAULT_STATS_LIMIT = 10
+# Like relatime, a download only records its access_time once the recorded one
+# is this old, so repeated downloads don't each append to the journal
+ACCESS_TIME_RESOLUTION = 60 * 60 # 1 hour
+PAGINATION_ARGS = ('limit', 'cursor', 'sort')
+LIST_ARGS = ('tags', 'exclude_tags', 'name_prefix', 'q', 'fields') + PAGINATION_ARGS
+# Types of the fields batch items may carry, lists are lists of tags
+BATCH_FIELD_TYPES = {'op': str, 'id': str, 'name': str, 'filetype': str, 'tag': str, 'new_tag': str,
+                     'tags': list, 'add': list, 'remove': list}
 
 bp = Blueprint('store', __name__, url_prefix='/api/store')
 
@@ -27,21 +54,18 @@ def _create_file(file_id, name, tags, filetype):
         'filetype': filetype
     }
 
-def encrypt_metadata(path, metadata, file_encrypter):
-    with open(path + '.unencrypted', 'w') as f:
-        json.dump(metadata, f)
-
-    file_encrypter.encrypt_file(path + '.unencrypted', path)
-    os.remove(path + '.unencrypted')
-
-def setup_session_and_meta(session_name):
+def setup_session(session_name):
     if not session_name:
         raise MissingSessionName()
     session = get_session(session_name)
     filepath = get_metadata_path(session)
     if not os.path.exists(filepath):
         raise FileStoreDNE()
-    metadata = session['file_encrypter'].decrypt_json(filepath)
+    return session
+
+def setup_session_and_meta(session_name):
+    session = setup_session(session_name)
+    metadata = load_metadata(session)
 
     return session, metadata
 
@@ -59,81 +83,156 @@ def store_endpoint():
 
         os.mkdir('{}/{}'.format(get_data_filepath(), session['name']))
         os.mkdir('{}/{}/decrypted'.format(get_data_filepath(), session['name']))
-        unencrypted_filepath = '{}.unencrypted'.format(filepath)
-        with open(unencrypted_filepath, 'w') as unencrypted_file:
-            try:
-                json.dump(BASE_METADATA, unencrypted_file)
-            except Exception as e:
-                print(e)
-                raise FailedToWriteMetadata()
-        session['file_encrypter'].encrypt_file(unencrypted_filepath, filepath)
-        os.remove(unencrypted_filepath)
+        keyinfo = dict(session['keyinfo'], check=get_key_check(session['file_encrypter'].key))
+        write_keyinfo(get_keyinfo_path(session['name']), keyinfo)
+        session['keyinfo'] = keyinfo
+        try:
+            encrypt_metadata(filepath, BASE_METADATA, session['file_encrypter'], session['metadata_format'])
+        except Exception as e:
+            print(e)
+            raise FailedToWriteMetadata()
         return {'status': 'success'}, 200
 
 
+def _split_arg(args, name):
+    return set(tag for tag in args.get(name, '').split(',') if tag)
+
+def _search_files(files, args):
+    name_prefix = args.get('name_prefix', None)
+    query = args.get('q', '').lower()
+    if not name_prefix and not query:
+        return files
+    return {
+        fid: f for fid, f in files.items()
+        if (not name_prefix or f['name'].startswith(name_prefix))
+            and (not query or query in f['name'].lower())
+    }
+
+def _project_file(f_meta, fields):
+    if not fields:
+        return f_meta
+    return {key: f_meta[key] for key in fields | {'id'} if key in f_meta}
+
+def _sort_value(f_meta, sort_key):
+    # files missing the field (e.g. not uploaded yet) sort first
+    value = f_meta.get(sort_key, None)
+    return [value is not None, value if value is not None else '', f_meta['id']]
+
+def _paginate_files(files, args):
+    sort_key = args.get('sort', 'name')
+    descending = sort_key.startswith('-')
+    sort_key = sort_key.lstrip('-')
+    if sort_key not in SORT_KEYS:
+        raise InvalidQuery('sort', args.get('sort'))
+    try:
+        limit = int(args.get('limit', DEFAULT_PAGE_SIZE))
+    except ValueError:
+        raise InvalidQuery('limit', args.get('limit'))
+    if limit <= 0:
+        raise InvalidQuery('limit', args.get('limit'))
+
+    ordered = sorted(files.values(), key=lambda f: _sort_value(f, sort_key), reverse=descending)
+    start = 0
+    if args.get('cursor', None):
+        try:
+            cursor = json.loads(base64.urlsafe_b64decode(args.get('cursor').encode('ascii')))
+        except Exception:
+            raise InvalidQuery('cursor', args.get('cursor'))
+        # cursor is the sort value of the last file on the previous page
+        keys = [_sort_value(f, sort_key) for f in ordered]
+        try:
+            if descending:
+                start = len(keys) - bisect.bisect_left(keys[::-1], cursor)
+            else:
+                start = bisect.bisect_right(keys, cursor)
+        except TypeError:
+            raise InvalidQuery('cursor', args.get('cursor'))
+
+    page = ordered[start:start + limit]
+    next_cursor = None
+    if start + limit < len(ordered):
+        next_cursor = base64.urlsafe_b64encode(
+            json.dumps(_sort_value(page[-1], sort_key)).encode('utf-8')).decode('ascii')
+    return page, next_cursor
+
 @bp.route('/metadata/file', methods=['GET', 'POST'])
 def store_file_metadata_endpoint():
     if request.method == 'GET':
-        _, metadata = setup_session_and_meta(request.args.get('session_name', None))
-        # common case
-        if not request.args.get('tags', None) and not request.args.get('exclude_tags', None):
-            return jsonify(metadata['files']), 200
-
-        tags = set() if 'tags' not in request.args else set(request.args.get('tags').split(','))
-        exclude_tags = set() if 'exclude_tags' not in request.args else set(request.args.get('exclude_tags').split(','))
-
-        filtered_files = {}
-        for fid, f in metadata['files'].items():
-            tag_set = set(f['tags'])
-            if tags.issubset(tag_set) and exclude_tags.isdisjoint(tag_set):
-                filtered_files[fid] = f
-        return jsonify(filtered_files), 200
+        session, metadata = setup_session_and_meta(request.args.get('session_name', None))
+        with session['metadata_lock']:
+            # common case
+            if not any(request.args.get(arg, None) for arg in LIST_ARGS):
+                return jsonify(metadata['files']), 200
+
+            tags = _split_arg(request.args, 'tags')
+            exclude_tags = _split_arg(request.args, 'exclude_tags')
+            if tags or exclude_tags:
+                files = filter_files(session, tags, exclude_tags)
+            else:
+                files = metadata['files']
+            files = _search_files(files, request.args)
+
+            fields = _split_arg(request.args, 'fields')
+            if not any(request.args.get(arg, None) for arg in PAGINATION_ARGS):
+                return jsonify({fid: _project_file(f, fields) for fid, f in files.items()}), 200
+            page, next_cursor = _paginate_files(files, request.args)
+            return jsonify({
+                'files': [_project_file(f, fields) for f in page],
+                'next_cursor': next_cursor
+            }), 200
     elif request.method == 'POST':
         request_data = request.get_json()
         if 'session_name' not in request_data:
             raise MissingSessionName()
         session, metadata = setup_session_and_meta(request_data.get('session_name', None))
 
-        new_id = uuid4()
-        while new_id in metadata['files']:
-            new_id = uuid4()
-        new_id = str(new_id)
-
-        metadata['tags'] = list(set(metadata['tags']) | set(request_data['tags']))
-        metadata['files'][new_id] = _create_file(
-            new_id,
-            request_data['name'],
-            request_data['tags'],
-            request_data['filetype'])
-        encrypt_metadata(get_metadata_path(session), metadata, session['file_encrypter'])
+        with session['metadata_lock']:
+            new_id = str(uuid4())
+            while new_id in metadata['files']:
+                new_id = str(uuid4())
+
+            record_metadata_ops(session, [{
+                'op': 'put_file',
+                'file': _create_file(
+                    new_id,
+                    request_data['name'],
+                    request_data['tags'],
+                    request_data['filetype'])
+            }])
+        save_metadata(session)
 
         return new_id
 
 @bp.route('/metadata/file/<file_id>', methods=['GET', 'PATCH'])
 def get_file_metadata_endpoint(file_id):
     if request.method == 'GET':
-        _, metadata = setup_session_and_meta(request.args.get('session_name', None))
-        if file_id not in metadata['files']:
+        session = setup_session(request.args.get('session_name', None))
+        f_meta = get_file_metadata(session, file_id)
+        if f_meta is None:
             raise InvalidFileID(file_id)
-        return metadata['files'][file_id], 200
+        return f_meta, 200
     elif request.method == 'PATCH':
         request_data = request.get_json()
         session, metadata = setup_session_and_meta(request_data.get('session_name', None))
-        if file_id not in metadata['files']:
-            raise InvalidFileID(file_id)
-        metadata['tags'] = list(set(metadata['tags']) | set(request_data.get('tags', [])))
-        f_meta = metadata['files'][file_id]
-        for key in ['tags', 'name', 'filetype']:
-            f_meta[key] = request_data.get(key, f_meta[key])
-
-        encrypt_metadata(get_metadata_path(session), metadata, session['file_encrypter'])
+        with session['metadata_lock']:
+            if file_id not in metadata['files']:
+                raise InvalidFileID(file_id)
+            f_meta = dict(metadata['files'][file_id])
+            for key in ['tags', 'name', 'filetype']:
+                f_meta[key] = request_data.get(key, f_meta[key])
+            record_metadata_ops(session, [{'op': 'put_file', 'file': f_meta}])
+
+        save_metadata(session)
         return f_meta, 200
 
 @bp.route('/metadata/tag', methods=['GET'])
 def store_tag_metadata_endpoint():
     if request.method == 'GET':
-        _, metadata = setup_session_and_meta(request.args.get('session_name', None))
-        return jsonify(metadata['tags']), 200
+        session, metadata = setup_session_and_meta(request.args.get('session_name', None))
+        with session['metadata_lock']:
+            if request.args.get('counts', '').lower() in ('1', 'true', 'yes'):
+                return jsonify(get_tag_counts(session)), 200
+            return jsonify(metadata['tags']), 200
 
 @bp.route('/metadata/tag/<tag_name>', methods=['PUT', 'DELETE'])
 def store_change_tag_metadata_endpoint(tag_name):
@@ -141,41 +240,125 @@ def store_change_tag_metadata_endpoint(tag_name):
     if request.method == 'PUT':
         session, metadata = setup_session_and_meta(request_data.get('session_name', None))
         new_tag = request_data['new_tag']
-        try:
-            metadata['tags'].remove(tag_name)
-        except ValueError:
-            raise InvalidTag(tag_name)
-        if new_tag not in metadata['tags']:
-            metadata['tags'].append(new_tag)
-        for file_id, f_meta in metadata['files'].items():
-            try:
-                f_meta['tags'].remove(tag_name)
-            except ValueError:
-                continue
-            if new_tag not in f_meta['tags']:
-                f_meta['tags'].append(request_data['new_tag'])
-        encrypt_metadata(get_metadata_path(session), metadata, session['file_encrypter'])
+        with session['metadata_lock']:
+            if tag_name not in metadata['tags']:
+                raise InvalidTag(tag_name)
+            record_metadata_ops(session, [{'op': 'rename_tag', 'tag': tag_name, 'new_tag': new_tag}])
+        save_metadata(session)
         return 'successfully updated tag {} to {}'.format(tag_name, request_data['new_tag']), 200
     if request.method == 'DELETE':
         session, metadata = setup_session_and_meta(request_data.get('session_name', None))
-        try:
-            metadata['tags'].remove(tag_name)
-        except ValueError:
+        with session['metadata_lock']:
+            if tag_name not in metadata['tags']:
+                raise InvalidTag(tag_name)
+            record_metadata_ops(session, [{'op': 'delete_tag', 'tag': tag_name}])
+        save_metadata(session)
+        return 'successfully deleted tag {}'.format(tag_name), 200
+
+def _build_batch_op(metadata, item):
+    # Validates one batch item against the metadata as it stands after the
+    # items before it, returning the op to apply and the item's result
+    kind = item.get('op', None)
+    if kind == 'create':
+        new_id = str(uuid4())
+        while new_id in metadata['files']:
+            new_id = str(uuid4())
+        f_meta = _create_file(new_id, item['name'], item.get('tags', []), item['filetype'])
+        return {'op': 'put_file', 'file': f_meta}, {'id': new_id}
+    if kind in ('patch', 'tag', 'delete'):
+        file_id = item.get('id', None)
+        if file_id not in metadata['files']:
+            raise InvalidFileID(file_id)
+        if kind == 'delete':
+            return {'op': 'delete_file', 'id': file_id}, {'id': file_id}
+        f_meta = dict(metadata['files'][file_id])
+        if kind == 'patch':
+            for key in ['tags', 'name', 'filetype']:
+                f_meta[key] = item.get(key, f_meta[key])
+        else:
+            remove_tags = set(item.get('remove', []))
+            f_meta['tags'] = [tag for tag in f_meta['tags'] if tag not in remove_tags]
+            f_meta['tags'] += [tag for tag in item.get('add', []) if tag not in f_meta['tags']]
+        return {'op': 'put_file', 'file': f_meta}, {'id': file_id, 'file': f_meta}
+    if kind in ('rename_tag', 'delete_tag'):
+        tag_name = item.get('tag', None)
+        if tag_name not in metadata['tags']:
             raise InvalidTag(tag_name)
-        for file_id, f_meta in metadata['files'].items():
+        if kind == 'rename_tag':
+            return {'op': 'rename_tag', 'tag': tag_name, 'new_tag': item['new_tag']}, {'tag': item['new_tag']}
+        return {'op': 'delete_tag', 'tag': tag_name}, {'tag': tag_name}
+    raise InvalidBatchOp(kind)
+
+def _check_batch_item(item):
+    if not isinstance(item, dict):
+        raise InvalidBatchOp(item)
+    for key, kind in BATCH_FIELD_TYPES.items():
+        value = item.get(key, None)
+        if value is None:
+            continue
+        if not isinstance(value, kind) or (kind is list and not all(isinstance(tag, str) for tag in value)):
+            raise InvalidQuery(key, value)
+
+def _batch_failed(results, i, error, count):
+    results.append({'index': i, 'status': 'failed', 'code': error.code, 'error': error.description})
+    results += [{'index': j, 'status': 'skipped'} for j in range(i + 1, count)]
+    return {'status': 'failed', 'results': results}, error.code
+
+@bp.route('/metadata/batch', methods=['POST'])
+def store_batch_metadata_endpoint():
+    if request.method == 'POST':
+        request_data = request.get_json()
+        session, metadata = setup_session_and_meta(request_data.get('session_name', None))
+        items = request_data.get('operations', [])
+
+        if not isinstance(items, list):
+            raise InvalidQuery('operations', items)
+        # Items are type checked before any is applied, so a malformed one can't
+        # fail halfway through applying the batch
+        for i, item in enumerate(items):
             try:
-                f_meta['tags'].remove(tag_name)
-            except ValueError:
-                continue
-        encrypt_metadata(get_metadata_path(session), metadata, session['file_encrypter'])
-        return 'successfully deleted tag {}'.format(tag_name), 200
+                _check_batch_item(item)
+            except HTTPException as e:
+                return _batch_failed([{'index': j, 'status': 'skipped'} for j in range(i)], i, e, len(items))
+
+        # All items apply or none do, and the whole batch is persisted once
+        results = []
+        with session['metadata_lock']:
+            applied = []
+            try:
+                for i, item in enumerate(items):
+                    try:
+                        op, result = _build_batch_op(metadata, item)
+                    except KeyError as e:
+                        raise InvalidBatchOp(item.get('op', None), e)
+                    applied.append((op, apply_op_with_undo(metadata, session['tag_index'], op, session['store_stats'])))
+                    results.append(dict(result, index=i, status='success'))
+                record_applied_ops(session, [op for op, _ in applied])
+            except Exception as e:
+                for _, undo in reversed(applied):
+                    undo_op(metadata, session['tag_index'], undo, session['store_stats'])
+                if not isinstance(e, HTTPException):
+                    raise
+                for result in results:
+                    result['status'] = 'rolled_back'
+                return _batch_failed(results, i, e, len(items))
+        save_metadata(session)
+        return {'status': 'success', 'results': results}, 200
 
 @bp.route('/file', methods=['POST'])
 def store_file_endpoint():
     if request.method == 'POST':
-        if 'metadata' not in request.form:
+        if request.mimetype != 'multipart/form-data' or 'boundary' not in request.mimetype_params:
             raise NoJSONMetadata()
-        request_data = json.loads(request.form['metadata'])
+        if request.max_content_length is not None and (request.content_length or 0) > request.max_content_length:
+            raise RequestEntityTooLarge()
+        # the chunk is encrypted as it's read off the request, never spooled to disk
+        reader = MultipartReader(request.stream, request.mimetype_params['boundary'], request.max_form_memory_size)
+        fields, has_file = reader.read_fields('file')
+        if 'metadata' not in fields:
+            # the file part is read as it arrives, fields after it are never seen
+            raise MetadataAfterFile() if has_file else NoJSONMetadata()
+        request_data = json.loads(fields['metadata'])
         session, metadata = setup_session_and_meta(request_data.get('session_name', None))
 
         chunk = int(request_data['chunk'])
@@ -183,30 +366,204 @@ def store_file_endpoint():
         total_chunks = int(request_data['total_chunks'])
         file_size = int(request_data.get('file_size', -1))
         file_id = request_data['file_id']
+        codec = request_data.get('codec', current_app.config['COMPRESSION_CODEC'])
+        if codec and codec != 'none' and codec not in compression.available_codecs():
+            raise InvalidQuery('codec', codec)
 
-        if 'file' not in request.files:
+        if not has_file:
             raise NoFile()
 
         path = get_filepath(session['name'], file_id)
         part_path = path + '.part'
         logging.info('Path: {}'.format(path))
         logging.info('Partial Path: {}'.format(part_path))
-        with open(part_path, 'ab') as f:
-            f.seek(chunk_offset)
-            uploaded_file = request.files['file']
-            f.write(uploaded_file.read())
-        logging.info('File Size: {}, {}'.format(os.path.getsize(part_path), file_size))
-        if chunk + 1 == total_chunks:
-            check_file_locked(session, file_id)
-            if file_size != -1 and os.path.getsize(part_path) != file_size:
-                os.remove(part_path)
-                raise FileUploadError(file_id, 'file size mismatch')
-            else:
-                logging.info('Encrypting file')
-                add_encrypt_job(session, file_id, part_path, path)
+        upload = start_upload(session, file_id, part_path, total_chunks, file_size)
+        length = write_chunk(session, upload, file_id, chunk, chunk_offset, reader)
+        if mark_chunk_received(upload, chunk, chunk_offset, length):
+            job = _finish_upload(session, file_id, upload, path, codec)
+            if job:
+                return {'status': 'success', 'job': job.to_dict()}, 202
 
         return {'status': 'success'}, 200
 
+def _finish_upload(session, file_id, upload, path, codec):
+    # Returns the job finishing the upload when its .part file has to be read back
+    part_path = upload['part_path']
+    try:
+        check_file_locked(session, file_id)
+    except Exception:
+        # let a retried chunk finalize once the file is unlocked
+        reset_finalizing(upload)
+        raise
+    cache.decrypted_cache.discard(session['name'], file_id)
+    logging.info('File Size: {}, {}'.format(upload['end'], upload['file_size']))
+    # the upload is only dropped once its .part file is gone, a new upload of the
+    # file id creates the .part file again
+    if upload['file_size'] != -1 and upload['end'] != upload['file_size']:
+        os.remove(part_path)
+        end_upload(session, file_id, upload)
+        raise FileUploadError(file_id, 'file size mismatch')
+    # chunks that didn't line up with auth chunks or content blocks are read back
+    # on a worker, the upload stays finalizing until the job is done
+    if needs_read_back(session, upload):
+        return add_finish_job(session, file_id, lambda: _complete_upload(session, file_id, upload, path, codec),
+                              lambda: reset_finalizing(upload))
+    _complete_upload(session, file_id, upload, path, codec)
+    return None
+
+def _complete_upload(session, file_id, upload, path, codec):
+    part_path = upload['part_path']
+    metadata = load_metadata(session)
+    try:
+        finish_part(session, upload)
+        blob = get_content_id(session, upload) if session['deduplicate'] else None
+    except Exception:
+        end_upload(session, file_id, upload)
+        raise
+    filetype = None
+    stored_codec = None
+    with session['metadata_lock']:
+        try:
+            if blob:
+                path = store_blob(session, part_path, blob)
+            else:
+                commit_upload(session, upload, path)
+        finally:
+            end_upload(session, file_id, upload)
+        if file_id in metadata['files']:
+            f_meta = metadata['files'][file_id]
+            filetype = f_meta['filetype']
+            previous_blob = f_meta.get('blob', None)
+            # a reused blob may already be compressed, or be from before authentication tags
+            header = session['file_encrypter'].get_header(path)
+            stored_codec = header.codec
+            record_metadata_ops(session, [{
+                'op': 'put_file',
+                'file': dict(f_meta,
+                             size=upload['end'],
+                             stored_size=os.path.getsize(path),
+                             codec=stored_codec,
+                             blob=blob,
+                             upload_time=time.time(),
+                             authenticated=header.version == FORMAT_CTR_AUTH)
+            }])
+            if previous_blob != blob:
+                release_blob(session, previous_blob)
+            if blob and not previous_blob:
+                _remove_file(get_filepath(session['name'], file_id))
+    save_metadata(session)
+    if filetype is not None and stored_codec is None and compression.choose_codec(codec, filetype):
+        add_compress_job(session, file_id, path, codec, header.version == FORMAT_CTR_AUTH,
+                         lambda: bool(_compressed_records(session, file_id, blob)),
+                         lambda result: _record_compression(session, file_id, blob, result))
+
+def _compressed_records(session, file_id, blob):
+    # must hold metadata_lock, returns the records still stored uncompressed at the
+    # file or blob being compressed
+    metadata = session['metadata']
+    if metadata is None:
+        return []
+    if blob:
+        records = [metadata['files'][fid] for fid in sorted(get_blob_refs(session['tag_index'], blob))]
+    else:
+        f_meta = metadata['files'].get(file_id, None)
+        records = [f_meta] if f_meta and not f_meta.get('blob', None) else []
+    return [f_meta for f_meta in records if f_meta.get('codec', None) is None]
+
+def _record_compression(session, file_id, blob, result):
+    # must hold metadata_lock, every record sharing the blob now points at the compressed copy
+    record_metadata_ops(session, [{
+        'op': 'put_file',
+        'file': dict(f_meta, **result)
+    } for f_meta in _compressed_records(session, file_id, blob)])
+
+def _remove_file(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+@bp.route('/file/<file_id>/upload', methods=['GET'])
+def get_file_upload_endpoint(file_id):
+    if request.method == 'GET':
+        if 'session_name' not in request.args:
+            raise MissingSessionName()
+        session, metadata = setup_session_and_meta(request.args.get('session_name', None))
+
+        upload = get_upload(session, file_id)
+        if upload:
+            return dict(get_upload_status(upload), file_id=file_id), 200
+        f_meta = metadata['files'].get(file_id, {'id': file_id})
+        if os.path.exists(get_stored_filepath(session['name'], f_meta)):
+            return {'file_id': file_id, 'complete': True, 'missing_chunks': []}, 200
+        raise NoUpload(file_id)
+
+def _should_stream(args):
+    if state.backend:
+        # decrypted copies are tracked per worker process, so shared deployments always stream
+        return True
+    stream = args.get('stream', None)
+    if stream is None:
+        return current_app.config['STREAM_DOWNLOADS']
+    return stream.lower() in ('1', 'true', 'yes')
+
+def _record_access(session, metadata, file_id):
+    now = time.time()
+    with session['metadata_lock']:
+        f_meta = metadata['files'].get(file_id, None)
+        if f_meta is None or now - f_meta.get('access_time', 0) < ACCESS_TIME_RESOLUTION:
+            return
+        record_metadata_ops(session, [{'op': 'put_file', 'file': dict(f_meta, access_time=now)}])
+    save_metadata(session)
+
+def _send_decrypted(cached_path, download_name):
+    # send_file leaves sending a decrypted copy to the server's wsgi.file_wrapper,
+    # which is os.sendfile under gunicorn. Behind nginx the copy is sent by nginx
+    # itself, which opens it after this returns, so an eviction in between 404s.
+    prefix = current_app.config['X_ACCEL_REDIRECT_PREFIX']
+    if not prefix:
+        return send_file(cached_path, download_name=download_name)
+    response = Response(mimetype=mimetypes.guess_type(download_name)[0] or 'application/octet-stream')
+    response.headers['X-Accel-Redirect'] = '{}/{}'.format(
+        prefix.rstrip('/'), quote(os.path.relpath(cached_path, get_data_filepath())))
+    response.headers.set('Content-Disposition', 'inline', filename=download_name)
+    return response
+
+def _stream_file(session, file_id, filepath, download_name, authenticated, byte_range=None):
+    file_encrypter = session['file_encrypter']
+    try:
+        size = file_encrypter.get_decrypted_size(filepath, authenticated)
+    except IntegrityError as e:
+        raise FileCorrupted(file_id, e)
+    start, stop = 0, size
+    partial = False
+    # only single ranges are served partially, anything else gets the whole file
+    if byte_range is not None and len(byte_range.ranges) == 1:
+        bounds = byte_range.range_for_length(size)
+        if bounds is None:
+            raise RequestedRangeNotSatisfiable(length=size)
+        start, stop = bounds
+        partial = True
+
+    # the first chunk is checked before any header goes out so a corrupted file is
+    # an error response, later chunks that fail can only cut the response short
+    chunks = file_encrypter.decrypt_stream(filepath, start, stop, authenticated)
+    try:
+        first = next(chunks, b'')
+    except IntegrityError as e:
+        raise FileCorrupted(file_id, e)
+    response = Response(
+        itertools.chain((first,), chunks),
+        mimetype=mimetypes.guess_type(download_name)[0] or 'application/octet-stream',
+        direct_passthrough=True)
+    response.content_length = stop - start
+    response.accept_ranges = 'bytes'
+    response.headers.set('Content-Disposition', 'attachment', filename=download_name)
+    if partial:
+        response.status_code = 206
+        response.content_range = ContentRange('bytes', start, stop, size)
+    return response
+
 @bp.route('/file/<file_id>', methods=['GET', 'DELETE'])
 def get_file_endpoint(file_id):
     if request.method == 'GET':
@@ -219,11 +576,19 @@ def get_file_endpoint(file_id):
         check_file_locked(session, file_id)
         file_metadata = metadata['files'][file_id]
 
-        filepath = get_filepath(session['name'], file_id)
+        filepath = get_stored_filepath(session['name'], file_metadata)
+        download_name = '{}.{}'.format(file_metadata['name'], file_metadata['filetype'])
+        cached_path = cache.decrypted_cache.get(session['name'], file_id)
+        if cached_path:
+            _record_access(session, metadata, file_id)
+            return _send_decrypted(cached_path, download_name)
+        if _should_stream(request.args) or request.range is not None:
+            response = _stream_file(session, file_id, filepath, download_name,
+                                    file_metadata.get('authenticated', False), request.range)
+            _record_access(session, metadata, file_id)
+            return response
         outpath = '{}.{}'.format(get_decrypted_filepath(session['name'], file_id), file_metadata['filetype'])
-        if outpath in session['decrypted']:
-            return send_file(outpath, download_name='{}.{}'.format(file_metadata['name'], file_metadata['filetype']))
-        add_decrypt_job(session, file_id, filepath, outpath)
+        add_decrypt_job(session, file_id, filepath, outpath, file_metadata.get('authenticated', False))
         raise FileIsBeingDecrypted
     if request.method == 'DELETE':
         request_data = request.get_json()
@@ -232,20 +597,36 @@ def get_file_endpoint(file_id):
         if file_id not in metadata['files']:
             raise InvalidFileID(file_id)
         check_file_locked(session, file_id)
-        file_metadata = metadata['files'][file_id]
-
-        filepath = get_filepath(session['name'], file_id)
-        try:
-            os.remove(filepath)
-        except:
-            pass
-
-        del metadata['files'][file_id]
-        encrypt_metadata(get_metadata_path(session), metadata, session['file_encrypter'])
+        cache.decrypted_cache.discard(session['name'], file_id)
+
+        with session['metadata_lock']:
+            if file_id not in metadata['files']:
+                raise InvalidFileID(file_id)
+            file_metadata = metadata['files'][file_id]
+            record_metadata_ops(session, [{'op': 'delete_file', 'id': file_id}])
+            # a blob is only dropped with the last file referencing it
+            if file_metadata.get('blob', None):
+                release_blob(session, file_metadata['blob'])
+            else:
+                _remove_file(get_filepath(session['name'], file_id))
+        save_metadata(session)
 
         return {'status': 'success'}, 200
 
 
+@bp.route('/stats', methods=['GET'])
+def store_stats_endpoint():
+    if request.method == 'GET':
+        session, metadata = setup_session_and_meta(request.args.get('session_name', None))
+        try:
+            limit = int(request.args.get('limit', DEFAULT_STATS_LIMIT))
+        except ValueError:
+            raise InvalidQuery('limit', request.args.get('limit'))
+        if limit < 0:
+            raise InvalidQuery('limit', request.args.get('limit'))
+        with session['metadata_lock']:
+            return get_store_stats(session).to_dict(metadata['files'], limit), 200
+
 @bp.route('/file/<file_id>/loaded', methods=['GET'])
 def get_file_loaded_endpoint(file_id):
     if request.method == 'GET':
@@ -256,8 +637,4 @@ def get_file_loaded_endpoint(file_id):
         if file_id not in metadata['files']:
             raise InvalidFileID(file_id)
         check_file_locked(session, file_id)
-        file_metadata = metadata['files'][file_id]
-
-        filepath = get_filepath(session['name'], file_id)
-        outpath = '{}.{}'.format(get_decrypted_filepath(session['name'], file_id), file_metadata['filetype'])
-        return outpath in session['decrypted']
+        return jsonify(cache.decrypted_cache.get(session['name'], file_id, count=False) is not None)
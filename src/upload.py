@@ -0,0 +1,179 @@
+import os
+import logging
+from threading import Lock
+
+from .error import FileUploadError, UploadFinalizing
+from .encrypter import has_chunk_tags
+from . import state
+
+# In-progress uploads live on the session keyed by file id. Chunks may arrive
+# concurrently and in any order, each is encrypted at its offset straight into
+# the .part file as it is read off the request and flagged in a bitmap of
+# received chunks. No plaintext is written to disk and finishing the upload only
+# patches the size, appends the authentication tags the chunks were sealed with
+# and renames. Chunks that don't line up with auth chunks, or with content blocks
+# when deduplicating, leave parts of the .part file to be read back to finish it.
+# With a shared state backend the upload lives there instead, so chunks of one
+# upload can land on different worker processes. When the store deduplicates,
+# the content block digests of each chunk are recorded alongside.
+
+class _LimitedReader:
+    def __init__(self, in_file, limit):
+        self.in_file = in_file
+        self.limit = limit
+
+    def read(self, size):
+        data = self.in_file.read(min(size, self.limit))
+        self.limit -= len(data)
+        return data
+
+def _create_upload(file_encrypter, part_path, total_chunks, file_size):
+    nonce = file_encrypter.create_encrypted_file(part_path, file_size)
+    return {
+        'part_path': part_path
+        , 'nonce': nonce
+        , 'total_chunks': total_chunks
+        , 'file_size': file_size
+        , 'received': bytearray((total_chunks + 7) // 8)
+        , 'received_count': 0
+        , 'end': 0
+        , 'finalizing': False
+        , 'blocks': {}
+        , 'tags': {}
+        , 'lock': Lock()
+    }
+
+def get_upload(session, file_id):
+    if state.backend:
+        return state.backend.get_upload(session['name'], file_id)
+    with session['lock']:
+        return session['uploads'].get(file_id, None)
+
+def start_upload(session, file_id, part_path, total_chunks, file_size):
+    if state.backend:
+        upload = state.backend.start_upload(
+            session['name'], file_id, part_path, total_chunks, file_size,
+            lambda: session['file_encrypter'].create_encrypted_file(part_path, file_size))
+    else:
+        with session['lock']:
+            upload = session['uploads'].get(file_id, None)
+            if upload is None:
+                upload = _create_upload(session['file_encrypter'], part_path, total_chunks, file_size)
+                session['uploads'][file_id] = upload
+    # the .part file is being finished and renamed, it's only replaced once end_upload drops it
+    if upload['finalizing']:
+        raise UploadFinalizing(file_id)
+    if upload['total_chunks'] != total_chunks or upload['file_size'] != file_size:
+        raise FileUploadError(file_id, 'chunk layout does not match upload in progress')
+    return upload
+
+def end_upload(session, file_id, upload):
+    if state.backend:
+        state.backend.end_upload(upload)
+        return
+    with session['lock']:
+        if session['uploads'].get(file_id, None) is upload:
+            del session['uploads'][file_id]
+
+def is_chunk_received(upload, chunk):
+    return bool(upload['received'][chunk // 8] & (1 << (chunk % 8)))
+
+def get_missing_chunks(upload):
+    if state.backend:
+        # a snapshot read from the backend
+        return [chunk for chunk in range(upload['total_chunks']) if not is_chunk_received(upload, chunk)]
+    with upload['lock']:
+        return [chunk for chunk in range(upload['total_chunks']) if not is_chunk_received(upload, chunk)]
+
+def write_chunk(session, upload, file_id, chunk, chunk_offset, in_file):
+    # Encrypts the plaintext read from in_file until EOF into the .part file,
+    # streamed through so a chunk never has to fit in memory. Returns its length.
+    if chunk < 0 or chunk >= upload['total_chunks']:
+        raise FileUploadError(file_id, 'chunk {} out of range'.format(chunk))
+    if upload['file_size'] != -1:
+        # nothing past the file's end is written, one more byte means the chunk is too long
+        in_file = _LimitedReader(in_file, max(upload['file_size'] - chunk_offset, 0))
+    length, tags, blocks = session['file_encrypter'].write_encrypted_stream(
+        upload['part_path'], upload['nonce'], chunk_offset, in_file, session['deduplicate'])
+    if upload['file_size'] != -1 and in_file.in_file.read(1):
+        raise FileUploadError(file_id, 'chunk {} exceeds file size'.format(chunk))
+    if tags:
+        if state.backend:
+            state.backend.put_upload_tags(upload, tags)
+        else:
+            with upload['lock']:
+                upload['tags'].update(tags)
+    if blocks:
+        if state.backend:
+            state.backend.put_upload_blocks(upload, blocks)
+        else:
+            with upload['lock']:
+                upload['blocks'].update(blocks)
+    return length
+
+def _get_tags(upload):
+    if state.backend:
+        return state.backend.get_upload_tags(upload)
+    with upload['lock']:
+        return dict(upload['tags'])
+
+def _get_blocks(upload):
+    if state.backend:
+        return state.backend.get_upload_blocks(upload)
+    with upload['lock']:
+        return dict(upload['blocks'])
+
+def needs_read_back(session, upload):
+    # Whether finish_part or get_content_id have to read the .part file back
+    if not has_chunk_tags(upload['end'], _get_tags(upload)):
+        return True
+    return session['deduplicate'] and session['file_encrypter'].content_id(upload['end'], _get_blocks(upload)) is None
+
+def finish_part(session, upload):
+    # Writes the final size and tags of the .part file, before end_upload drops its state
+    session['file_encrypter'].finish_encrypted_file(upload['part_path'], upload['end'], _get_tags(upload))
+
+def commit_upload(session, upload, path):
+    os.replace(upload['part_path'], path)
+
+def get_content_id(session, upload):
+    # Returns the content id of the finished .part file's plaintext. Uploads whose
+    # chunks didn't line up with content blocks are read back to hash them.
+    file_encrypter = session['file_encrypter']
+    content_id = file_encrypter.content_id(upload['end'], _get_blocks(upload))
+    if content_id is None:
+        logging.info('hashing {} after upload, chunks were not block aligned'.format(upload['part_path']))
+        content_id = file_encrypter.file_content_id(upload['part_path'])
+    return content_id
+
+def mark_chunk_received(upload, chunk, chunk_offset, length):
+    # Returns True for exactly one caller, once every chunk has arrived
+    if state.backend:
+        return state.backend.mark_chunk_received(upload, chunk, chunk_offset + length)
+    with upload['lock']:
+        if not is_chunk_received(upload, chunk):
+            upload['received'][chunk // 8] |= 1 << (chunk % 8)
+            upload['received_count'] += 1
+        upload['end'] = max(upload['end'], chunk_offset + length)
+        if upload['received_count'] < upload['total_chunks'] or upload['finalizing']:
+            return False
+        upload['finalizing'] = True
+        return True
+
+def reset_finalizing(upload):
+    # lets a retried chunk finalize the upload again
+    if state.backend:
+        state.backend.reset_upload_finalizing(upload)
+        return
+    with upload['lock']:
+        upload['finalizing'] = False
+
+def get_upload_status(upload):
+    missing = get_missing_chunks(upload)
+    return {
+        'total_chunks': upload['total_chunks'],
+        'received_chunks': upload['total_chunks'] - len(missing),
+        'missing_chunks': missing,
+        'complete': not missing,
+        'finalizing': bool(upload['finalizing']),
+    }
@@ -17,3 +17,21 @@ def get_decrypted_filepath(filestore, name):
 
 def get_metadata_path(session):
     return get_filepath(session['name'], 'metadata')
+
+def get_journal_path(session):
+    return get_metadata_path(session) + '.journal'
+
+def get_keyinfo_path(filestore):
+    return get_filepath(filestore, 'keyinfo')
+
+def get_scrub_report_path(filestore):
+    return get_filepath(filestore, 'scrub')
+
+def get_blob_path(filestore, blob):
+    return get_filepath(filestore, 'blobs/{}'.format(blob))
+
+def get_stored_filepath(filestore, f_meta):
+    # files stored before deduplication have no blob and live at their id
+    if f_meta.get('blob', None):
+        return get_blob_path(filestore, f_meta['blob'])
+    return get_filepath(filestore, f_meta['id'])
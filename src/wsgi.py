@@ -0,0 +1,6 @@
+from . import create_app
+
+# Entry point for production servers, e.g.
+#   gunicorn --workers 4 --threads 16 --bind 0.0.0.0:5000 src.wsgi:app
+# Run several workers with STATE_BACKEND=sqlite and the same SESSION_SECRET.
+app = create_app()
@@ -0,0 +1,30 @@
+import uuid
+
+import pytest
+
+from src import create_app
+from src.session import get_session
+
+@pytest.fixture
+def app(tmp_path, monkeypatch):
+    monkeypatch.setenv('DATA_FILEPATH', str(tmp_path))
+    return create_app({
+        'TESTING': True,
+        'STATE_BACKEND': 'memory',
+        'SCRUB_INTERVAL': None,
+        'SCRUB_RATE': None,
+        'SCRYPT_N': 2 ** 10,
+        'LOG_LEVEL': 'WARNING'
+    })
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
+
+@pytest.fixture
+def store(client):
+    # a logged in session with an empty store
+    name = uuid.uuid4().hex
+    client.post('/api/session', json={'name': name, 'password': 'password'})
+    client.post('/api/store', json={'session_name': name})
+    return get_session(name)
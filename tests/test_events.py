@@ -0,0 +1,21 @@
+from src import events
+
+def test_event_streams_are_limited(client, store):
+    events.init_streams(1)
+    url = '/api/session/{}/events'.format(store['name'])
+    first = client.get(url, buffered=False)
+    assert next(iter(first.response)) == b'retry: 3000\n\n'
+    assert client.get(url).status_code == 503
+    first.close()
+    second = client.get(url, buffered=False)
+    assert second.status_code == 200
+    second.close()
+
+def test_events_are_streamed(client, store):
+    url = '/api/session/{}/events'.format(store['name'])
+    response = client.get(url, buffered=False)
+    stream = iter(response.response)
+    next(stream)
+    store['events'].publish('queued', {'id': 'job'})
+    assert next(stream) == b'id: 1\nevent: queued\ndata: {"id": "job"}\n\n'
+    response.close()
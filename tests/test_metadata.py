@@ -0,0 +1,38 @@
+from src.metadata import build_tag_index, apply_op, apply_op_with_undo, undo_op, filter_files, get_tag_counts
+from src.stats import StoreStats
+
+def _session():
+    metadata = {
+        'files': {
+            'f1': {'id': 'f1', 'name': 'a', 'filetype': 'txt', 'tags': ['x', 'y']},
+            'f2': {'id': 'f2', 'name': 'b', 'filetype': 'txt', 'tags': ['x']},
+        },
+        'tags': ['x', 'y']
+    }
+    return {'metadata': metadata, 'tag_index': build_tag_index(metadata)}
+
+def test_rename_tag_to_itself():
+    session = _session()
+    op = {'op': 'rename_tag', 'tag': 'x', 'new_tag': 'x'}
+    apply_op(session['metadata'], session['tag_index'], op)
+    # replaying the journal applies the op again
+    apply_op(session['metadata'], session['tag_index'], op)
+    assert set(filter_files(session, {'x'}, set())) == {'f1', 'f2'}
+    assert get_tag_counts(session) == {'x': 2, 'y': 1}
+    assert session['metadata']['files']['f1']['tags'] == ['x', 'y']
+    assert session['tag_index'] == build_tag_index(session['metadata'])
+
+def test_rename_tag_to_itself_in_batch():
+    session = _session()
+    stats = StoreStats(session['metadata']['files'].values())
+    undo = apply_op_with_undo(session['metadata'], session['tag_index'],
+                              {'op': 'rename_tag', 'tag': 'x', 'new_tag': 'x'}, stats)
+    assert get_tag_counts(session) == {'x': 2, 'y': 1}
+    undo_op(session['metadata'], session['tag_index'], undo, stats)
+    assert session['tag_index'] == build_tag_index(session['metadata'])
+
+def test_rename_tag():
+    session = _session()
+    apply_op(session['metadata'], session['tag_index'], {'op': 'rename_tag', 'tag': 'x', 'new_tag': 'y'})
+    assert get_tag_counts(session) == {'y': 2}
+    assert session['tag_index'] == build_tag_index(session['metadata'])
@@ -0,0 +1,45 @@
+import os
+
+from src.metadata import load_metadata, record_metadata_ops, save_metadata
+from src.scrub import scrub_store
+from src.util import get_filepath
+
+class Job:
+    def update_progress(self, done, total):
+        pass
+
+def _put_legacy_file(session, file_id, data):
+    # records written before sizes were kept only carry these fields
+    load_metadata(session)
+    record_metadata_ops(session, [{'op': 'put_file', 'file': {
+        'id': file_id, 'name': file_id, 'tags': [], 'filetype': 'txt'}}])
+    save_metadata(session)
+    if data is not None:
+        session['file_encrypter'].encrypt_bytes(data, get_filepath(session['name'], file_id))
+
+def test_scrub_checks_legacy_records(store):
+    _put_legacy_file(store, 'f1', b'first')
+    _put_legacy_file(store, 'f2', b'second')
+    _put_legacy_file(store, 'f3', None)
+    with open(get_filepath(store['name'], 'f2'), 'r+b') as f:
+        f.seek(-1, os.SEEK_END)
+        last = f.read(1)
+        f.seek(-1, os.SEEK_END)
+        f.write(bytes([last[0] ^ 1]))
+    report = scrub_store(store, Job())
+    assert report['not_uploaded'] == ['f3']
+    assert report['missing'] == []
+    assert [f_meta['id'] for f_meta in report['corrupt']] == ['f2']
+    assert report['unauthenticated'] == []
+    assert report['bytes'] == sum(os.path.getsize(get_filepath(store['name'], fid)) for fid in ('f1', 'f2'))
+
+def test_scrub_reports_missing_uploaded_file(store):
+    _put_legacy_file(store, 'f1', b'first')
+    with store['metadata_lock']:
+        f_meta = dict(store['metadata']['files']['f1'], size=5)
+        record_metadata_ops(store, [{'op': 'put_file', 'file': f_meta}])
+    save_metadata(store)
+    os.remove(get_filepath(store['name'], 'f1'))
+    report = scrub_store(store, Job())
+    assert report['missing'] == ['f1']
+    assert report['not_uploaded'] == []
@@ -0,0 +1,28 @@
+import os
+
+from src.metadata import load_metadata, record_metadata_ops, save_metadata, invalidate_metadata
+from src.util import get_filepath
+
+def test_stats_count_legacy_records(client, store):
+    load_metadata(store)
+    # records written before sizes were kept, one uploaded and one not
+    record_metadata_ops(store, [{'op': 'put_file', 'file': {
+        'id': file_id, 'name': file_id, 'tags': ['x'], 'filetype': 'txt'}} for file_id in ('f1', 'f2')])
+    save_metadata(store)
+    path = get_filepath(store['name'], 'f1')
+    store['file_encrypter'].encrypt_bytes(b'legacy data', path)
+    invalidate_metadata(store)
+
+    stats = client.get('/api/store/stats?session_name={}'.format(store['name'])).get_json()
+    assert stats['files'] == 2
+    assert stats['uploaded_files'] == 1
+    assert stats['size'] == len(b'legacy data')
+    assert stats['stored_size'] == os.path.getsize(path)
+    assert stats['tags']['x']['size'] == len(b'legacy data')
+
+    # the sizes are recorded, so they aren't read again on the next load
+    invalidate_metadata(store)
+    f_meta = load_metadata(store)['files']['f1']
+    assert f_meta['size'] == len(b'legacy data')
+    assert f_meta['stored_size'] == os.path.getsize(path)
+    assert 'size' not in load_metadata(store)['files']['f2']
@@ -0,0 +1,75 @@
+import io
+import json
+import time
+
+from src import jobs
+
+def _upload(client, store, file_id, data, chunk_size, **fields):
+    total_chunks = -(-len(data) // chunk_size)
+    for chunk in range(total_chunks):
+        offset = chunk * chunk_size
+        response = client.post('/api/store/file', data={
+            'metadata': json.dumps({
+                'session_name': store['name'],
+                'chunk': chunk,
+                'chunk_offset': offset,
+                'total_chunks': total_chunks,
+                'file_size': len(data),
+                'file_id': file_id,
+                **fields
+            }),
+            'file': (io.BytesIO(data[offset:offset + chunk_size]), 'upload.bin'),
+        }, content_type='multipart/form-data')
+    return response
+
+def _new_file(client, store):
+    return client.post('/api/store/metadata/file', json={
+        'session_name': store['name'], 'name': 'upload', 'tags': [], 'filetype': 'bin'}).data.decode()
+
+def test_aligned_upload_finishes_in_request(client, store):
+    file_id = _new_file(client, store)
+    data = bytes(range(256)) * 8192
+    response = _upload(client, store, file_id, data, 1024 * 1024)
+    assert response.status_code == 200
+    response = client.get('/api/store/file/{}?session_name={}&stream=1'.format(file_id, store['name']))
+    assert response.data == data
+
+def test_unaligned_upload_finishes_in_job(client, store):
+    file_id = _new_file(client, store)
+    data = bytes(range(256)) * 8192 + b'tail'
+    response = _upload(client, store, file_id, data, 64 * 1024)
+    assert response.status_code == 202
+    job = jobs.pool.get(response.get_json()['job']['id'])
+    if job:
+        job.event.wait()
+    status = client.get('/api/store/file/{}/upload?session_name={}'.format(file_id, store['name'])).get_json()
+    assert status['complete']
+    response = client.get('/api/store/file/{}?session_name={}&stream=1'.format(file_id, store['name']))
+    assert response.data == data
+    f_meta = client.get('/api/store/metadata/file/{}?session_name={}'.format(file_id, store['name'])).get_json()
+    assert f_meta['size'] == len(data)
+
+def test_compressed_upload_is_recorded(client, store):
+    file_id = _new_file(client, store)
+    data = b'compress me ' * 100000
+    assert _upload(client, store, file_id, data, 1024 * 1024, codec='zlib').status_code == 200
+    url = '/api/store/metadata/file/{}?session_name={}'.format(file_id, store['name'])
+    for _ in range(100):
+        f_meta = client.get(url).get_json()
+        if f_meta.get('codec', None):
+            break
+        time.sleep(0.05)
+    assert f_meta['codec'] == 'zlib'
+    assert f_meta['stored_size'] < len(data)
+    response = client.get('/api/store/file/{}?session_name={}&stream=1'.format(file_id, store['name']))
+    assert response.data == data
+
+def test_metadata_after_file_is_rejected(client, store):
+    file_id = _new_file(client, store)
+    metadata = json.dumps({'session_name': store['name'], 'chunk': 0, 'chunk_offset': 0,
+                           'total_chunks': 1, 'file_size': 3, 'file_id': file_id})
+    body = ('--b\r\nContent-Disposition: form-data; name="file"; filename="a"\r\n\r\nabc\r\n'
+            '--b\r\nContent-Disposition: form-data; name="metadata"\r\n\r\n{}\r\n--b--\r\n').format(metadata)
+    response = client.post('/api/store/file', data=body, content_type='multipart/form-data; boundary=b')
+    assert response.status_code == 400
+    assert 'before its file part' in response.get_json()['description']